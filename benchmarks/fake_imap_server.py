@@ -0,0 +1,418 @@
+import re
+import socketserver
+import threading
+import time
+from email.parser import BytesHeaderParser
+
+
+# What the fake server says it can do
+CAPABILITIES = "IMAP4rev1 UIDPLUS"
+
+# A command's tag, name and the rest of it, e.g. 'A001 UID FETCH 1:* (FLAGS)'
+COMMAND = re.compile(r'^(\S+) (UID )?(\S+) ?(.*)$', re.IGNORECASE)
+
+# A literal at the end of a line, e.g. '{1234}' (or '{1234+}', the non-synchronizing kind)
+LITERAL = re.compile(rb'\{(\d+)(\+?)\}\r\n$')
+
+# FETCH items, e.g. 'BODY.PEEK[HEADER.FIELDS (SUBJECT FROM)]'
+FETCH_ITEM = re.compile(r'[A-Z0-9.]+(?:\[[^\]]*\])?(?:<[\d.]+>)?', re.IGNORECASE)
+
+# SEARCH criteria tokens: quoted strings, parentheses and atoms
+SEARCH_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\()|(\))|([^\s()"]+)')
+
+
+class Message(object):
+
+    def __init__(self, uid, content, flags=(), internaldate=None):
+        self.uid = uid
+        self.content = content
+        self.flags = set(flags)
+        self.internaldate = internaldate or time.time()
+        self.headers = None
+
+    def header(self, name):
+        if self.headers is None:
+            self.headers = BytesHeaderParser().parsebytes(self.content)
+        return str(self.headers.get(name, ""))
+
+    def header_block(self):
+        end = self.content.find(b"\r\n\r\n")
+        if end != -1:
+            return self.content[:end + 4]
+        end = self.content.find(b"\n\n")
+        if end != -1:
+            return self.content[:end + 2]
+        return self.content
+
+
+class Folder(object):
+
+    def __init__(self, uidvalidity):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = []
+
+    def add(self, content, flags=(), internaldate=None):
+        message = Message(self.uidnext, content, flags, internaldate)
+        self.uidnext += 1
+        self.messages.append(message)
+        return message
+
+
+class FakeImapServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """ A stand-in IMAP server on the loopback interface, with just enough of IMAP4rev1 (and UIDPLUS) for
+    digest_emails.py: LOGIN, SELECT, SEARCH, FETCH, STORE, COPY, EXPUNGE and APPEND, with or without UID. Anyone can
+    log in, and all logins see the same folders. Every command can be held up by latency seconds, to stand in for a
+    server that's further away. round_trips counts the commands, by name.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, port=0):
+        socketserver.TCPServer.__init__(self, ("127.0.0.1", port), ImapHandler)
+        self.latency = latency
+        self.folders = {}
+        self.round_trips = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def folder(self, name):
+        if name.upper() == "INBOX":
+            name = "INBOX"
+        if name not in self.folders:
+            self.folders[name] = Folder(len(self.folders) + 1)
+        return self.folders[name]
+
+    def total_round_trips(self):
+        return sum(self.round_trips.values())
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class ImapHandler(socketserver.StreamRequestHandler):
+
+    # Responses are buffered, and sent all together once a command is done (with Nagle's algorithm, a line at a
+    # time would wait on the client's delayed ACKs)
+    wbufsize = -1
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.selected = None
+
+    def send(self, line):
+        if isinstance(line, str):
+            line = line.encode("utf-8")
+        self.wfile.write(line + b"\r\n")
+
+    def read_command(self):
+        """ A command line, with any literals in it read too (and put in as bytes)
+        :rtype: (the line as a str with the literals taken out, list of the literals), or None at the end
+        """
+        line = self.rfile.readline()
+        if line == b"":
+            return None
+        text = b""
+        literals = []
+        while True:
+            literal = LITERAL.search(line)
+            if literal is None:
+                text += line.rstrip(b"\r\n")
+                break
+            text += line[:literal.start()] + b"{}"
+            if literal.group(2) != b"+":
+                self.send("+ Ready for literal data")
+                self.wfile.flush()
+            literals.append(self.rfile.read(int(literal.group(1))))
+            line = self.rfile.readline()
+        return text.decode("utf-8"), literals
+
+    def handle(self):
+        self.send("* OK [CAPABILITY " + CAPABILITIES + "] Fake IMAP server ready")
+        while True:
+            self.wfile.flush()
+            command = self.read_command()
+            if command is None:
+                return
+            text, literals = command
+            parsed = COMMAND.match(text)
+            if parsed is None:
+                self.send("* BAD Unparseable command")
+                continue
+            tag, uid, name, arguments = parsed.groups()
+            name = name.upper()
+            with self.server.lock:
+                key = ("UID " if uid else "") + name
+                self.server.round_trips[key] = self.server.round_trips.get(key, 0) + 1
+            if self.server.latency > 0:
+                time.sleep(self.server.latency)
+            handler = getattr(self, "do_" + name.lower(), None)
+            if handler is None:
+                self.send(tag + " BAD Unknown command " + name)
+                continue
+            try:
+                with self.server.lock:
+                    ok = handler(arguments, uid is not None, literals)
+            except Exception as e:
+                self.send(tag + " BAD " + str(e).replace("\r", " ").replace("\n", " "))
+                continue
+            if name == "LOGOUT":
+                self.send(tag + " OK LOGOUT completed")
+                return
+            self.send(tag + " OK " + (ok or name + " completed"))
+
+    # Commands - each sends its untagged responses, and returns what goes after the tagged OK (or None)
+
+    def do_capability(self, arguments, by_uid, literals):
+        self.send("* CAPABILITY " + CAPABILITIES)
+
+    def do_noop(self, arguments, by_uid, literals):
+        pass
+
+    def do_logout(self, arguments, by_uid, literals):
+        self.send("* BYE Fake IMAP server logging out")
+
+    def do_login(self, arguments, by_uid, literals):
+        return "[CAPABILITY " + CAPABILITIES + "] LOGIN completed"
+
+    def do_select(self, arguments, by_uid, literals):
+        folder = self.server.folder(unquote(arguments))
+        self.selected = folder
+        self.send("* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)")
+        self.send("* %d EXISTS" % len(folder.messages))
+        self.send("* 0 RECENT")
+        self.send("* OK [UIDVALIDITY %d] UIDs valid" % folder.uidvalidity)
+        self.send("* OK [UIDNEXT %d] Predicted next UID" % folder.uidnext)
+        return "[READ-WRITE] SELECT completed"
+
+    do_examine = do_select
+
+    def do_status(self, arguments, by_uid, literals):
+        name, items = arguments.rsplit(" (", 1)
+        folder = self.server.folder(unquote(name))
+        values = {"MESSAGES": len(folder.messages), "UIDNEXT": folder.uidnext, "UIDVALIDITY": folder.uidvalidity,
+                  "RECENT": 0, "UNSEEN": len([message for message in folder.messages
+                                              if "\\Seen" not in message.flags])}
+        self.send("* STATUS %s (%s)" % (name, " ".join("%s %d" % (item, values[item.upper()])
+                                                      for item in items.rstrip(")").split())))
+
+    def do_close(self, arguments, by_uid, literals):
+        self.expunge(send=False)
+        self.selected = None
+
+    def do_expunge(self, arguments, by_uid, literals):
+        self.expunge(send=True)
+
+    def expunge(self, send):
+        kept = []
+        for message in self.selected.messages:
+            if "\\Deleted" not in message.flags:
+                kept.append(message)
+            elif send:
+                # Sequence numbers shift down as messages go, so this one's is just after those kept so far
+                self.send("* %d EXPUNGE" % (len(kept) + 1))
+        self.selected.messages = kept
+
+    def do_search(self, arguments, by_uid, literals):
+        tokens = search_tokens(arguments)
+        if len(tokens) >= 2 and tokens[0].upper() == "CHARSET":
+            tokens = tokens[2:]
+        found = []
+        for seq, message in enumerate(self.selected.messages, 1):
+            if matches_all(tokens, message, seq, len(self.selected.messages), self.selected):
+                found.append(message.uid if by_uid else seq)
+        self.send("* SEARCH" + "".join(" %d" % n for n in found))
+
+    def do_fetch(self, arguments, by_uid, literals):
+        message_set, items = arguments.split(" ", 1)
+        items = [item.upper() for item in FETCH_ITEM.findall(items)]
+        if by_uid and "UID" not in items:
+            items.insert(0, "UID")
+        for seq, message in self.in_set(message_set, by_uid):
+            parts = []
+            for item in items:
+                parts.append(self.fetch_item(item, message))
+            self.wfile.write(("* %d FETCH (" % seq).encode("utf-8") + b" ".join(parts) + b")\r\n")
+
+    def fetch_item(self, item, message):
+        if item == "UID":
+            return b"UID %d" % message.uid
+        if item == "FLAGS":
+            return ("FLAGS (" + " ".join(sorted(message.flags)) + ")").encode("utf-8")
+        if item == "INTERNALDATE":
+            return ('INTERNALDATE "' + time.strftime("%d-%b-%Y %H:%M:%S +0000", time.gmtime(message.internaldate))
+                    + '"').encode("utf-8")
+        if item == "RFC822.SIZE":
+            return b"RFC822.SIZE %d" % len(message.content)
+        if item in ("RFC822", "BODY[]", "BODY.PEEK[]"):
+            if not item.startswith("BODY.PEEK"):
+                message.flags.add("\\Seen")
+            return literal(item.replace(".PEEK", ""), message.content)
+        if item in ("RFC822.HEADER", "BODY[HEADER]", "BODY.PEEK[HEADER]"):
+            return literal(item.replace(".PEEK", ""), message.header_block())
+        fields = re.match(r'BODY(?:\.PEEK)?\[HEADER\.FIELDS \((.*)\)\]', item)
+        if fields is not None:
+            return literal(item.replace(".PEEK", ""), header_fields(message, fields.group(1).split()))
+        raise ValueError("Can't fetch " + item)
+
+    def do_store(self, arguments, by_uid, literals):
+        message_set, action, flags = arguments.split(" ", 2)
+        flags = set(flags.strip("()").split())
+        action = action.upper()
+        for seq, message in self.in_set(message_set, by_uid):
+            if action.startswith("+FLAGS"):
+                message.flags |= flags
+            elif action.startswith("-FLAGS"):
+                message.flags -= flags
+            else:
+                message.flags = set(flags)
+            if not action.endswith(".SILENT"):
+                self.send("* %d FETCH (%sFLAGS (%s))" % (seq, ("UID %d " % message.uid) if by_uid else "",
+                                                         " ".join(sorted(message.flags))))
+
+    def do_copy(self, arguments, by_uid, literals):
+        message_set, folder_name = arguments.split(" ", 1)
+        folder = self.server.folder(unquote(folder_name))
+        source_uids, copy_uids = [], []
+        for seq, message in self.in_set(message_set, by_uid):
+            copied = folder.add(message.content, message.flags - {"\\Deleted"}, message.internaldate)
+            source_uids.append(str(message.uid))
+            copy_uids.append(str(copied.uid))
+        return "[COPYUID %d %s %s] COPY completed" % (folder.uidvalidity, ",".join(source_uids), ",".join(copy_uids))
+
+    def do_append(self, arguments, by_uid, literals):
+        tokens = search_tokens(arguments.replace("{}", ""))
+        folder = self.server.folder(tokens[0])
+        flags = ()
+        if "(" in tokens:
+            flags = tokens[tokens.index("(") + 1:tokens.index(")")]
+        appended = folder.add(literals[0], flags)
+        return "[APPENDUID %d %d] APPEND completed" % (folder.uidvalidity, appended.uid)
+
+    def in_set(self, message_set, by_uid):
+        """
+        :rtype: list of (sequence number, message) in message_set, which is sequence numbers or UIDs
+        """
+        messages = self.selected.messages
+        if len(messages) == 0:
+            return []
+        highest = messages[-1].uid if by_uid else len(messages)
+        wanted = set_matcher(message_set, highest)
+        return [(seq, message) for seq, message in enumerate(messages, 1)
+                if wanted(message.uid if by_uid else seq)]
+
+
+def literal(name, content):
+    return name.encode("utf-8") + b" {%d}\r\n" % len(content) + content
+
+
+def header_fields(message, names):
+    wanted = set(name.upper() for name in names)
+    lines = []
+    keep = False
+    for line in message.header_block().splitlines(True):
+        if line[:1] in (b" ", b"\t"):
+            if keep:
+                lines.append(line)
+            continue
+        keep = line.split(b":", 1)[0].decode("latin-1").upper() in wanted
+        if keep:
+            lines.append(line)
+    return b"".join(lines) + b"\r\n"
+
+
+def unquote(text):
+    text = text.strip()
+    if text.startswith('"') and text.endswith('"'):
+        return text[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return text
+
+
+def set_matcher(message_set, highest):
+    ranges = []
+    for part in message_set.split(","):
+        if ":" in part:
+            low, high = part.split(":")
+            low = highest if low == "*" else int(low)
+            high = highest if high == "*" else int(high)
+            ranges.append((min(low, high), max(low, high)))
+        else:
+            n = highest if part == "*" else int(part)
+            ranges.append((n, n))
+    return lambda n: any(low <= n <= high for low, high in ranges)
+
+
+def search_tokens(text):
+    tokens = []
+    for quoted, opening, closing, atom in SEARCH_TOKEN.findall(text):
+        if opening:
+            tokens.append("(")
+        elif closing:
+            tokens.append(")")
+        elif atom:
+            tokens.append(atom)
+        else:
+            tokens.append(quoted.replace('\\"', '"').replace('\\\\', '\\'))
+    return tokens
+
+
+def matches_all(tokens, message, seq, count, folder):
+    tokens = list(tokens)
+    while len(tokens) > 0:
+        if not matches_one(tokens, message, seq, count, folder):
+            return False
+    return True
+
+
+def matches_one(tokens, message, seq, count, folder):
+    """ Takes one search key (and its arguments) off the front of tokens
+    :rtype: whether message matches it
+    """
+    key = tokens.pop(0)
+    upper = key.upper()
+    if key == "(":
+        result = True
+        while tokens[0] != ")":
+            result = matches_one(tokens, message, seq, count, folder) and result
+        tokens.pop(0)
+        return result
+    if upper == "ALL":
+        return True
+    if upper == "NOT":
+        return not matches_one(tokens, message, seq, count, folder)
+    if upper == "OR":
+        first = matches_one(tokens, message, seq, count, folder)
+        second = matches_one(tokens, message, seq, count, folder)
+        return first or second
+    if upper in ("DELETED", "SEEN", "ANSWERED", "FLAGGED", "DRAFT"):
+        return "\\" + upper.capitalize() in message.flags
+    if upper in ("UNDELETED", "UNSEEN", "UNANSWERED", "UNFLAGGED", "UNDRAFT"):
+        return "\\" + upper[2:].capitalize() not in message.flags
+    if upper == "KEYWORD":
+        return tokens.pop(0) in message.flags
+    if upper == "UID":
+        return set_matcher(tokens.pop(0), folder.messages[-1].uid)(message.uid)
+    if upper in ("SUBJECT", "FROM", "TO", "CC"):
+        return tokens.pop(0).lower() in message.header(upper.capitalize()).lower()
+    if upper == "HEADER":
+        name = tokens.pop(0)
+        return tokens.pop(0).lower() in message.header(name).lower()
+    if upper == "LARGER":
+        return len(message.content) > int(tokens.pop(0))
+    if upper == "SMALLER":
+        return len(message.content) < int(tokens.pop(0))
+    if re.match(r'^[\d*:,]+$', key):
+        return set_matcher(key, count)(seq)
+    raise ValueError("Can't search for " + key)
@@ -0,0 +1,103 @@
+import ast
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from fake_imap_server import FakeImapServer
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def fixture_emails():
+    """ The notification emails the digesters' tests use (the module level strings that are whole emails), and the
+    Reddit sample emails, with CRLF line endings as they'd be on an IMAP server
+    :rtype: list of bytes
+    """
+    emails = []
+    for test_module in sorted(glob.glob(os.path.join(REPO, "digesters", "*", "test_*.py"))):
+        with open(test_module, encoding="utf-8") as file_io:
+            tree = ast.parse(file_io.read())
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) \
+                    and isinstance(node.value.value, str) and is_an_email(node.value.value):
+                emails.append(node.value.value.encode("utf-8"))
+    for sample in sorted(glob.glob(os.path.join(REPO, "digesters", "reddit", "*.txt"))):
+        with open(sample, "rb") as file_io:
+            emails.append(file_io.read())
+    return [b"\r\n".join(email.splitlines()) for email in emails]
+
+
+def is_an_email(text):
+    header, _, body = text.partition("\n\n")
+    return body != "" and ("\nSubject:" in header or header.startswith("Subject:"))
+
+
+def run_once(size, emails, latency, extra_args):
+    """ Seed a fresh fake IMAP server with size notification emails, then run digest_emails.py against it, in an
+    empty directory (so there's no state from before)
+    :rtype: dict of what was measured
+    """
+    server = FakeImapServer(latency=latency).start()
+    inbox = server.folder("INBOX")
+    for i in range(size):
+        inbox.add(emails[i % len(emails)])
+    server.folder("Digests")
+
+    work_dir = tempfile.mkdtemp(prefix="imapdigester-bench-")
+    # The fake server is on whichever port was free - what digest_emails.py's --*-port options are there for
+    account = ["--imap", "127.0.0.1", "--port", str(server.port), "--no-ssl", "--user", "bench", "--pw", "bench"]
+    command = [sys.executable, os.path.join(REPO, "digest_emails.py"), "--digest-folder", "Digests",
+               "--implicate", "bench@example.com"] \
+        + [arg.replace("--", "--notifications-", 1) for arg in account] \
+        + [arg.replace("--", "--digest-", 1) for arg in account] + extra_args
+    try:
+        started = time.time()
+        process = subprocess.Popen(command, cwd=work_dir, stdout=subprocess.DEVNULL)
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        seconds = time.time() - started
+    finally:
+        server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "messages": size,
+        "exit_code": process.returncode,
+        "seconds": round(seconds, 3),
+        "round_trips": server.total_round_trips(),
+        "round_trips_by_command": server.round_trips,
+        "peak_rss_mb": round(usage.ru_maxrss / 1024.0, 1),  # ru_maxrss is in KB on Linux
+        "left_in_inbox": len(server.folder("INBOX").messages),
+        "digests": len(server.folder("Digests").messages)
+    }
+
+
+if __name__ == '__main__':
+
+    parser = OptionParser(usage="%prog [options] [-- extra digest_emails.py options]")
+    parser.add_option("--sizes", dest="sizes", default="100,1000,10000",
+                      help="How many notification emails to seed the inbox with, per run (100,1000,10000 by default)")
+    parser.add_option("--latency-ms", type="float", dest="latency_ms", default=0.0,
+                      help="Milliseconds the fake IMAP server waits before answering each command (0 by default)")
+    parser.add_option("--json", action="store_true", dest="json",
+                      help="Print the results as JSON lines, rather than a table")
+
+    (options, args) = parser.parse_args()
+
+    emails = fixture_emails()
+    if not options.json:
+        print("%8s %9s %12s %13s %6s" % ("messages", "seconds", "round trips", "peak RSS MB", "exit"))
+    for size in [int(size) for size in options.sizes.split(",")]:
+        result = run_once(size, emails, options.latency_ms / 1000.0, args)
+        if options.json:
+            print(json.dumps(result, sort_keys=True))
+        else:
+            print("%8d %9.2f %12d %13.1f %6d" % (result["messages"], result["seconds"], result["round_trips"],
+                                                  result["peak_rss_mb"], result["exit_code"]))
+        sys.stdout.flush()
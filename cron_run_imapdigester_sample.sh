@@ -23,6 +23,8 @@ do_it() {
 
      # --digest-cert-check-skip  (you're using a self-signed imap server)
      # --notifications-cert-check-skip  (you're using a self-signed imap server)
+     # --daemon  (keep running and wait for notifications with IMAP IDLE, instead of a cron tick per run. Start
+     #            this script once, say at boot, rather than from cron)
 
 }
 
@@ -1,6 +1,8 @@
 import getpass
-import imp
 import os
+import socket
+import ssl
+from email.parser import BytesHeaderParser
 from optparse import OptionParser
 from socket import gaierror
 
@@ -9,24 +11,38 @@ import sys
 import time
 from imapclient import IMAPClient
 
-from digesters.digestion_processor import DigestionProcessor
+from digesters.digester_registry import DigesterRegistry
+from digesters.digestion_processor import DigestHashes, DigestionProcessor, DigestUids, UidCheckpoint
+from imap_connection import SharedConnection
+from instrumentation import Instrumentation, span
+from metastore import MetaStore
+from utils import Utils
 
 
-def get_command():
+old_imapclient = (imapclient.__version__ == "0.13")
+
+# The subjects of command emails, in the order they are acted on (one of them a run)
+COMMANDS = ['git-pull', 'pause', 'resume']
+
+
+def get_command(digest_folder):
     retval = None
+    command_emails = find_command_emails(digest_folder)
 
-    if check_for_command('git-pull'):
+    if check_for_command(digest_folder, command_emails, 'git-pull'):
         with open("imapdigester_commands_next_time.sh", 'w+') as f:
             f.write("\ngit pull\nfind . -name \"*.pyc\" -exec rm -rf {} \;\n")
         retval = "BASH-OPERATIONS"
 
-    elif check_for_command('pause'):
+    elif check_for_command(digest_folder, command_emails, 'pause'):
         with open("pause_if_present.txt", 'w') as f:
             f.write("")
         retval = "PAUSE"
 
-    elif check_for_command('resume'):
-        os.remove('pause_if_present.txt')
+    elif check_for_command(digest_folder, command_emails, 'resume'):
+        if os.path.isfile("pause_if_present.txt"):
+            os.remove('pause_if_present.txt')
+        retval = "RESUME"
 
     elif os.path.isfile("pause_if_present.txt"):
         retval = "PAUSE"
@@ -34,14 +50,306 @@ def get_command():
     return retval
 
 
-def check_for_command(cmd):
-    messages = digest_folder.search('SUBJECT "%s"' % cmd)
-    response = digest_folder.fetch(messages, ['FLAGS', 'RFC822.SIZE'])
-    retval = False
+def find_command_emails(digest_folder):
+    """ One SEARCH for emails with any of the COMMANDS in their subject, and (if there are any) one FETCH of their
+    subjects, to tell which is which
+    :rtype: dict of command -> UIDs of the emails for it
+    """
+    command_emails = {}
+    with span("imap.commands"):
+        criteria = ['OR'] * (len(COMMANDS) - 1)
+        for cmd in COMMANDS:
+            criteria += ['SUBJECT', cmd]
+        messages = digest_folder.search(criteria + ['UNDELETED'])
+        if len(messages) == 0:
+            return command_emails
+        response = digest_folder.fetch(messages, ['BODY.PEEK[HEADER.FIELDS (SUBJECT)]'])
     for msgid, data in response.items():
-        digest_folder.delete_messages([msgid])
-        retval = True
-    return retval
+        header_block = b''
+        for key, value in data.items():
+            if key.startswith(b'BODY[HEADER'):
+                header_block = value
+        # What IMAP's SEARCH SUBJECT does: a case-insensitive substring match
+        subject = DigestionProcessor.decoded_header(BytesHeaderParser().parsebytes(header_block)['Subject']).lower()
+        for cmd in COMMANDS:
+            if cmd in subject:
+                command_emails.setdefault(cmd, []).append(msgid)
+    return command_emails
+
+
+def check_for_command(digest_folder, command_emails, cmd):
+    """ Delete the emails for cmd (found by find_command_emails()), if there are any
+    :rtype: True if there were
+    """
+    messages = command_emails.get(cmd, [])
+    if len(messages) == 0:
+        return False
+    digest_folder.delete_messages(messages)
+    return True
+
+
+def imap_kwargs(use_ssl, cert_check_skip, port=None):
+    kwargs = {"use_uid": True, "ssl": use_ssl, "port": port}
+    if not old_imapclient and cert_check_skip:
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        kwargs["ssl_context"] = context
+    return kwargs
+
+
+def log_in_to_notifications(options, or_exit=True):
+    """
+    :param or_exit: exit (with status 10) if the server can't be found or logged in to, rather than raise the error
+    """
+    kwargs = imap_kwargs(options.notifications_ssl, options.notifications_cert_check_skip, options.notifications_port)
+
+    try:
+        notification_folder = IMAPClient(options.notifications_imap, **kwargs)
+    except gaierror:
+        if not or_exit:
+            raise
+        print("CAN'T FIND IMAP SERVER")
+        exit(10)
+    try:
+        notification_folder.login(options.notifications_user, options.notifications_pw)
+    except:
+        time.sleep(5)
+        notification_folder = IMAPClient(options.notifications_imap, **kwargs)
+        try:
+            notification_folder.login(options.notifications_user, options.notifications_pw)
+        except:
+            if not or_exit:
+                raise
+            print("CAN'T LOG IN TO IMAP SERVER")
+            exit(10)
+    return notification_folder
+
+
+def connect_to_notifications(options, notification_folder=None, or_exit=True):
+    """ Log in to the notification server (unless notification_folder is already), and select the notification folder
+    :rtype: the IMAPClient, and what select_folder() said about the folder
+    """
+    if notification_folder is None:
+        notification_folder = log_in_to_notifications(options, or_exit)
+    notification_folder_info = notification_folder.select_folder(options.notifications_folder_name)
+    return notification_folder, notification_folder_info
+
+
+def connect_to_digest(options):
+    """ Log in to the digest server, and select the digest folder
+    :rtype: the IMAPClient, and what select_folder() said about the folder
+    """
+    digest_folder = IMAPClient(options.digest_imap,
+                               **imap_kwargs(options.digest_ssl, options.digest_cert_check_skip, options.digest_port))
+
+    try:
+        digest_folder.login(options.digest_user, options.digest_pw)
+    except:
+        time.sleep(5)
+        digest_folder.login(options.digest_user, options.digest_pw)
+    digest_folder_info = digest_folder.select_folder(options.digest_folder_name)
+    return digest_folder, digest_folder_info
+
+
+def same_account(options):
+    return options.notifications_imap == options.digest_imap and options.notifications_user == options.digest_user \
+        and options.notifications_ssl == options.digest_ssl and options.notifications_port == options.digest_port
+
+
+def connect(options, notification_client=None, or_exit=True):
+    """ Log in to the notification and digest servers, and select the two folders. When they're in the same account,
+    that's one connection (and one login), shared by the two
+    :param notification_client: an IMAPClient already logged in to the notification server, if there is one
+    :param or_exit: exit if the notification server can't be found or logged in to, rather than raise the error
+    :rtype: the notification folder, what select_folder() said about it, the digest folder, and what it said about that
+    """
+    with span("imap.connect"):
+        return connect_to_both(options, notification_client, or_exit)
+
+
+def connect_to_both(options, notification_client=None, or_exit=True):
+    if not same_account(options):
+        notification_folder, notification_folder_info = connect_to_notifications(options, notification_client, or_exit)
+        digest_folder, digest_folder_info = connect_to_digest(options)
+        return notification_folder, notification_folder_info, digest_folder, digest_folder_info
+
+    connection = SharedConnection(notification_client or log_in_to_notifications(options, or_exit))
+    notification_folder = connection.folder(options.notifications_folder_name)
+    digest_folder = connection.folder(options.digest_folder_name)
+    notification_folder_info = notification_folder.select_folder()
+    digest_folder_info = digest_folder.select_folder()
+    return notification_folder, notification_folder_info, digest_folder, digest_folder_info
+
+
+def nothing_new(notification_client, options):
+    """ Ask the notification server (with a STATUS, no SELECT) whether there is anything in the notification folder,
+    or with --uid-checkpoint, anything that has arrived since the last run
+    """
+    with span("imap.status"):
+        status = notification_client.folder_status(options.notifications_folder_name,
+                                                   ['MESSAGES', 'UIDNEXT', 'UIDVALIDITY'])
+    if status[b'MESSAGES'] == 0:
+        return True
+    if options.uid_checkpoint:
+        return UidCheckpoint(MetaStore("notifications_checkpoint"), status[b'UIDVALIDITY'],
+                             status[b'UIDNEXT']).nothing_new()
+    return False
+
+
+def load_digesters():
+    """
+    :rtype: DigesterRegistry of the digesters that my_digesters_setup.py adds (none of them made yet, if it adds them
+    by name)
+    """
+    digesters = DigesterRegistry()
+
+    if os.path.isfile("my_digesters_setup.py"):
+        from my_digesters_setup import add_digesters
+    else:
+        print("#################################################################")
+        print("##                                                             ##")
+        print("##                        IMAP Digester                        ##")
+        print("##                        -------------                        ##")
+        print("##                                                             ##")
+        print("##   You should really copy `my_digesters_setup_template.py`   ##")
+        print("##   to `my_digesters_setup.py` and customize it for you.      ##")
+        print("##                                                             ##")
+        print("#################################################################")
+        # Copy my_digesters_setup_template.py to the my_digesters_setup.py,
+        # if you're wanting to customize the digesters.
+        from my_digesters_setup_sample import add_digesters
+
+    # Get Digesters from my_digesters_setup.py
+    add_digesters(digesters)
+    return digesters
+
+
+def make_processor(options, notification_folder, notification_folder_info, digest_folder, digest_folder_info):
+    worker_pool = None
+    if options.workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        worker_pool = ProcessPoolExecutor(options.workers)
+
+    uid_checkpoint = None
+    if options.uid_checkpoint:
+        uid_checkpoint = UidCheckpoint(MetaStore("notifications_checkpoint"), notification_folder_info[b'UIDVALIDITY'],
+                                       notification_folder_info.get(b'UIDNEXT'))
+
+    return DigestionProcessor(notification_folder, digest_folder, load_digesters(), options.print_summary,
+                              options.sender_to_implicate, options.move_unmatched, options.digest_folder_name,
+                              fetch_batch_size=options.fetch_batch_size, headers_first=options.headers_first,
+                              uid_checkpoint=uid_checkpoint, state_journal=MetaStore.journal,
+                              worker_pool=worker_pool, digest_hashes=DigestHashes(MetaStore("digest_hashes")),
+                              digest_uids=DigestUids(MetaStore("digest_uids"), digest_folder_info[b'UIDVALIDITY']),
+                              move_unmatched_as_is=options.move_unmatched_as_is, same_account=same_account(options))
+
+
+def expunge(folder, which):
+    try:
+        with span("imap.expunge"):
+            folder.expunge()
+    except IMAPClient.AbortError as e:
+        print("Error expunging " + which + " folder: " + str(e))
+
+
+def log_out(notification_folder, digest_folder, expunge_first):
+    """ Expunge both folders (if expunge_first), and only then log out of either, as they might be the one connection
+    """
+    if expunge_first:
+        expunge(digest_folder, "digest")
+        expunge(notification_folder, "notification")
+    digest_folder.logout()
+    notification_folder.logout()
+
+
+def wait_for_new_mail(notification_folder, timeout):
+    """ Wait (at most timeout seconds) for something to happen in the notification folder.
+    IMAP IDLE is used if the server has it, otherwise it is a sleep and then a NOOP (which keeps the connection alive)
+    """
+    if notification_folder.has_capability('IDLE'):
+        notification_folder.idle()
+        try:
+            notification_folder.idle_check(timeout=timeout)
+        finally:
+            notification_folder.idle_done()
+    else:
+        time.sleep(timeout)
+        notification_folder.noop()
+
+
+def reconnect(options):
+    """ Connect again, after a connection problem. Until that works, it's tried again, waiting twice as long each time
+    (up to --poll-interval seconds)
+    :rtype: what connect() returns
+    """
+    delay = 1
+    while True:
+        time.sleep(delay)
+        try:
+            return connect(options, or_exit=False)
+        except (IMAPClient.Error, socket.error) as e:
+            print("Can't reconnect yet: " + str(e))
+            delay = min(delay * 2, max(1, options.poll_interval))
+
+
+def run_as_daemon(options):
+    """ Keep the IMAP connection(s) and all the digesters (with their state) between cycles. A cycle happens
+    when IDLE says something arrived, or every --poll-interval seconds. Digests are rewritten at most once per
+    --rewrite-interval seconds, however many notifications arrive in that time. Command emails are looked for once
+    per --poll-interval seconds, rather than on every cycle.
+    :rtype: the command that stopped the daemon
+    """
+    notification_folder, notification_folder_info, digest_folder, digest_folder_info = connect(options)
+    processor = None
+    rewrite_due = False
+    last_rewrite = 0
+    last_command_check = 0
+
+    while True:
+        try:
+            if time.time() - last_command_check >= options.poll_interval:
+                command = get_command(digest_folder)
+                last_command_check = time.time()
+            elif os.path.isfile("pause_if_present.txt"):
+                command = "PAUSE"
+            else:
+                command = None
+            if command == "BASH-OPERATIONS":
+                if processor is not None:
+                    processor.shut_down_workers()
+                expunge(digest_folder, "digest")
+                digest_folder.logout()
+                notification_folder.logout()
+                return command
+
+            if command in (None, "RESUME"):
+                if processor is None:
+                    processor = make_processor(options, notification_folder, notification_folder_info,
+                                               digest_folder, digest_folder_info)
+                if processor.digest_notifications() > 0:
+                    rewrite_due = True
+                if rewrite_due and time.time() - last_rewrite >= options.rewrite_interval:
+                    if processor.rewrite_digests(just_new=True):
+                        expunge(digest_folder, "digest")
+                        expunge(notification_folder, "notification")
+                    rewrite_due = False
+                    last_rewrite = time.time()
+                    if options.timings is not None:
+                        Instrumentation.current.write_report(options.timings)
+
+            wait = options.poll_interval
+            if rewrite_due:
+                wait = min(wait, max(1, options.rewrite_interval - (time.time() - last_rewrite)))
+            wait_for_new_mail(notification_folder, wait)
+
+        except (IMAPClient.Error, socket.error) as e:
+            print("IMAP connection problem, reconnecting: " + str(e))
+            notification_folder, notification_folder_info, digest_folder, digest_folder_info = reconnect(options)
+            if processor is not None:
+                processor.reconnected(notification_folder, notification_folder_info, digest_folder,
+                                      digest_folder_info)
+
 
 if __name__ == '__main__' and __package__ is None:
     from os import sys, path
@@ -49,8 +357,6 @@ if __name__ == '__main__' and __package__ is None:
 
 if __name__ == '__main__':
 
-    imp.reload(sys)
-
     # Command Line Args
 
     parser = OptionParser()
@@ -66,6 +372,8 @@ if __name__ == '__main__':
                       help="Skip Certificate check notification imap server (say self-signed)")
     parser.add_option("--notifications-no-ssl", action="store_false", dest="notifications_ssl", default=True,
                       help="SSL True/False (port 993) for notifications IMAP? (True by default)")
+    parser.add_option("--notifications-port", type="int", dest="notifications_port",
+                      help="Port for notifications IMAP, if not the usual one (993, or 143 without SSL)")
     parser.add_option("--digest-imap", dest="digest_imap",
                       help="IMAP to use for outgoing digest (rewrite) mail server (SSL assumed)")
     parser.add_option("--digest-user", dest="digest_user", help="User ID for outgoing digest (rewrite) mail server")
@@ -77,15 +385,49 @@ if __name__ == '__main__':
                       help="Skip Certificate check digest imap server (say self-signed)")
     parser.add_option("--digest-no-ssl", action="store_false", dest="digest_ssl", default=True,
                       help="SSL True/False (port 993) for digest IMAP? (True by default)")
+    parser.add_option("--digest-port", type="int", dest="digest_port",
+                      help="Port for digest IMAP, if not the usual one (993, or 143 without SSL)")
     parser.add_option("--implicate", dest="sender_to_implicate",
                       help="Who to name in digest emails, e.g. imapdigester@example.com")
     parser.add_option("--move-unmatched", action="store_true", dest="move_unmatched",
                       help="Move unmatched emails to digest inbox")
+    parser.add_option("--move-unmatched-as-is", action="store_true", dest="move_unmatched_as_is",
+                      help="With --move-unmatched, tag unmatched emails with the ImapDigesterUnmatched keyword rather "
+                           "than [I:D] in the subject, so that the server can MOVE them (when the two folders are in "
+                           "the same account)")
     parser.add_option("--print-summary", action="store_true", dest="print_summary", help="Print Summary")
+    parser.add_option("--fetch-batch-size", type="int", dest="fetch_batch_size", default=100,
+                      help="How many notification emails to download per IMAP FETCH (100 by default)")
+    parser.add_option("--headers-first", action="store_true", dest="headers_first",
+                      help="Fetch only headers first, and download just the emails a digester wants (or all of them "
+                           "with --move-unmatched)")
+    parser.add_option("--uid-checkpoint", action="store_true", dest="uid_checkpoint",
+                      help="Remember the last notification email handled, and only look at newer ones next time")
+    parser.add_option("--status-first", action="store_true", dest="status_first",
+                      help="Check the notification folder with IMAP STATUS first, and stop there if there's nothing in "
+                           "it (or nothing new, with --uid-checkpoint). Command emails are then only looked for when "
+                           "there are notifications")
+    parser.add_option("--daemon", action="store_true", dest="daemon",
+                      help="Keep running, waiting for new notifications with IMAP IDLE (instead of a run per cron tick)")
+    parser.add_option("--poll-interval", type="int", dest="poll_interval", default=60,
+                      help="Daemon mode: seconds between checks, if IDLE isn't there or nothing happens (60 by default)")
+    parser.add_option("--rewrite-interval", type="int", dest="rewrite_interval", default=30,
+                      help="Daemon mode: rewrite digest emails at most once per this many seconds (30 by default)")
+    parser.add_option("--workers", type="int", dest="workers", default=1,
+                      help="Parse notification emails (their HTML, mostly) in this many processes (1 by default)")
+    parser.add_option("--html-parser", dest="html_parser",
+                      help="BeautifulSoup parser for notification HTML: lxml (the default, if it's installed) or "
+                           "html.parser")
+    parser.add_option("--sqlite-store", action="store_true", dest="sqlite_store",
+                      help="Keep digesters' state in .store/state.sqlite, rather than a pickle file for each thing")
+    parser.add_option("--journal-state", action="store_true", dest="journal_state",
+                      help="Write all the digesters' state from a run together at the end of it, crash-safely")
+    parser.add_option("--timings", dest="timings",
+                      help="Append how long each stage of the run took (and how much was fetched, etc) to this file, "
+                           "as a line of JSON (per cycle, in daemon mode). - for standard out")
 
     (options, args) = parser.parse_args()
 
-    old_imapclient = (imapclient.__version__ == "0.13")
     if old_imapclient and (options.digest_cert_check_skip or options.notifications_cert_check_skip):
         print("Can't do certificate check skipping on IMAPClient 0.13 with command line options " \
               "--digest-cert-check-skip or --notifications-cert-check-skip")
@@ -102,90 +444,51 @@ if __name__ == '__main__':
             print("Enter digest user password:")
             options.digest_pw = getpass.getpass()
 
-    # Read and mark for deletion items from notification inbox.
-    notification_folder = None
-    kwargs = {"use_uid": True, "ssl": options.notifications_ssl}
-    if not old_imapclient and options.notifications_cert_check_skip:
-        notifications_context = None
-        notifications_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-        notifications_context.check_hostname = False
-        notifications_context.verify_mode = ssl.CERT_NONE
-        kwargs["ssl_context"] = notifications_context
+    if options.html_parser is not None:
+        Utils.html_parser = options.html_parser
+    if options.sqlite_store:
+        MetaStore.use_sqlite()
+    if options.journal_state:
+        MetaStore.use_journal()
+    MetaStore.use_template_cache()
+    if options.timings is not None:
+        Instrumentation.use()
+
+    if options.daemon:
+        command = run_as_daemon(options)
+        if command == "BASH-OPERATIONS":
+            sys.exit(202)  ## HTTP 'accepted' (FYI)
+        sys.exit(0)
+
+    notification_client = None
+    if options.status_first:
+        with span("imap.connect"):
+            notification_client = log_in_to_notifications(options)
+        if nothing_new(notification_client, options):
+            notification_client.logout()
+            if options.timings is not None:
+                Instrumentation.current.write_report(options.timings)
+            sys.exit(0)
 
-    try:
-        notification_folder = IMAPClient(options.notifications_imap, **kwargs)
-    except gaierror:
-        print("CAN'T FIND IMAP SERVER")
-        exit(10)
-    try:
-        notification_folder.login(options.notifications_user, options.notifications_pw)
-    except:
-        time.sleep(5)
-        notification_folder = IMAPClient(options.notifications_imap, **kwargs)
+    # Read and mark for deletion items from notification inbox.
+    notification_folder, notification_folder_info, digest_folder, digest_folder_info = connect(options,
+                                                                                               notification_client)
+
+    command = get_command(digest_folder)
+    deleted = False
+    if command in (None, "RESUME"):
+        processor = make_processor(options, notification_folder, notification_folder_info, digest_folder,
+                                   digest_folder_info)
         try:
-            notification_folder.login(options.notifications_user, options.notifications_pw)
-        except:
-            print("CAN'T LOG IN TO IMAP SERVER")
-            exit(10)
-    time.sleep(1)
-    notification_folder.select_folder(options.notifications_folder_name)
-
-    kwargs = {"use_uid": True, "ssl": options.digest_ssl}
-    if not old_imapclient and options.digest_cert_check_skip:
-        digest_context = None
-        digest_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-        digest_context.check_hostname = False
-        digest_context.verify_mode = ssl.CERT_NONE
-        kwargs["ssl_context"] = digest_context
-    digest_folder = IMAPClient(options.digest_imap, **kwargs)
-
-    try:
-        digest_folder.login(options.digest_user, options.digest_pw)
-    except:
-        time.sleep(5)
-        digest_folder.login(options.digest_user, options.digest_pw)
-    digest_folder.select_folder(options.digest_folder_name)    
-
-    command = get_command()
-    if command is None:
-        digesters = []
+            deleted = processor.doit()
+        finally:
+            processor.shut_down_workers()
 
-        if os.path.isfile("my_digesters_setup.py"):
-            from my_digesters_setup import add_digesters
-        else:
-            print("#################################################################")
-            print("##                                                             ##")
-            print("##                        IMAP Digester                        ##")
-            print("##                        -------------                        ##")
-            print("##                                                             ##")
-            print("##   You should really copy `my_digesters_setup_template.py`   ##")
-            print("##   to `my_digesters_setup.py` and customize it for you.      ##")
-            print("##                                                             ##")
-            print("#################################################################")
-            # Copy my_digesters_setup_template.py to the my_digesters_setup.py,
-            # if you're wanting to customize the digesters.
-            from my_digesters_setup_sample import add_digesters
-
-        # Get Digesters from my_digesters_setup.py
-        add_digesters(digesters)
-
-        DigestionProcessor(notification_folder, digest_folder, digesters, options.print_summary,
-                           options.sender_to_implicate, options.move_unmatched, options.digest_folder_name)\
-            .doit()
+    # Nothing to expunge if nothing was deleted (no notification was digested, and no command email acted on)
+    log_out(notification_folder, digest_folder, deleted or command is not None)
 
-    try:
-        digest_folder.expunge()
-    except IMAPClient.AbortError as e:
-        print("Error expunging digest folder:")
-        e.print_exc()
-
-    digest_folder.logout()
-
-    try:
-        notification_folder.expunge()
-    except IMAPClient.AbortError as e:
-        print("Error expunging notification folder")
-    notification_folder.logout()
+    if options.timings is not None:
+        Instrumentation.current.write_report(options.timings)
 
     if command is "BASH-OPERATIONS":
         sys.exit(202)  ## HTTP 'accepted' (FYI)
@@ -2,8 +2,64 @@ import os
 from abc import ABCMeta, abstractmethod
 from random import random
 
+from bs4 import SoupStrainer
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
+
+from instrumentation import span
+from metastore import MetaStore
+from utils import Utils
+
+
+class TimedTemplate(Template):
+
+    def render(self, *args, **kwargs):
+        with span("template.render"):
+            return super(TimedTemplate, self).render(*args, **kwargs)
+
+
+class ElementsStrainer(SoupStrainer):
+    """ A SoupStrainer that keeps any element matching one of a list of (tag name, attrs), with everything inside it.
+    A "class" in attrs matches any one of an element's classes, as with BeautifulSoup's find().
+    SoupStrainer's own arguments can only say one such (tag name, attrs), so this overrides allow_tag_creation(), the
+    hook that BeautifulSoup 4.13 on documents for that (hence the version the README has you install). An older
+    BeautifulSoup doesn't ask it, and parses the whole of the html, as if there were no strainer.
+    """
+
+    def __init__(self, elements):
+        super(ElementsStrainer, self).__init__()
+        self.elements = elements
+
+    def wanted(self, name, attrs):
+        for wanted_name, wanted_attrs in self.elements:
+            if name == wanted_name and all(self.attr_matches(attrs.get(attr), value)
+                                           for attr, value in wanted_attrs.items()):
+                return True
+        return False
+
+    @staticmethod
+    def attr_matches(actual, wanted):
+        if isinstance(actual, str) and " " in actual:
+            actual = actual.split()
+        if isinstance(actual, list):
+            return wanted in actual
+        return actual == wanted
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return self.wanted(name, attrs)
+
 
 class BaseDigester(object, metaclass=ABCMeta):
+
+    # True for digesters that split process_new_notification() into extract_notification() and apply_notification()
+    extracts_notifications = False
+
+    # For digesters that only look at some elements of the html: a (tag name, attrs) for each of them, like
+    # ("div", {"id": "chats"}), so that make_soup() parses just those (and what's inside them). None for all of it.
+    needed_html_elements = None
+
+    # Shared by all digesters, made by get_template() when first needed
+    template_environment = None
+
     def __init__(self):
         self._notification_boundary_rand = str(random())
 
@@ -23,10 +79,29 @@ class BaseDigester(object, metaclass=ABCMeta):
         """
         pass
 
+    @staticmethod
+    def extract_notification(rfc822content, msg, html_message, text_message):
+        """
+        The first half of process_new_notification(), for digesters that set extracts_notifications: the (CPU heavy)
+        parsing, which changes nothing. With --workers this runs in a worker process, so there's no digester to hand,
+        and what it returns has to be picklable.
+        :rtype: whatever apply_notification() needs, or None if it can't be processed
+        """
+        pass
+
+    def apply_notification(self, extracted):
+        """
+        The second half of process_new_notification(): record what extract_notification() returned. Always run in the
+        main process, and in UID order.
+        :rtype: True or False based on whether the email was processed or not
+        """
+        pass
+
     @abstractmethod
     def rewrite_digest_emails(self, digest_folder_proxy, has_previous_message, previously_seen, sender_to_implicate):
         """
-        Rewrite (or write, or don't at all) the digest email, in the digest email account
+        Rewrite (or write, or don't at all) the digest email, in the digest email account. Only called on runs in which
+        this digester was handed a notification (see DigestionProcessor.rewrite_digests())
         :param sender_to_implicate: The From message is set to this "Firstname Secondname" <email@addr>
         :param previously_seen: True if the current digest email has been read
         :param has_previous_message:  True is there is a current digest for this at all (could have been deleted)
@@ -62,6 +137,61 @@ class BaseDigester(object, metaclass=ABCMeta):
         """
         pass
 
+    def prepare_for_next_run(self):
+        """
+        Called after rewrite_digest_emails, in case this digester is kept in memory for another run (daemon mode).
+        Forget whatever was 'new' this time, so that it isn't treated as new again next time.
+        """
+        pass
+
+    def needs_html_message(self):
+        """
+        :rtype: False if process_new_notification() makes no use of html_message (it'll be passed None then)
+        """
+        return True
+
+    def needs_text_message(self):
+        """
+        :rtype: False if process_new_notification() makes no use of text_message (it'll be passed None then)
+        """
+        return True
+
+    @classmethod
+    def make_soup(cls, html_message, from_encoding=None):
+        """
+        :rtype: BeautifulSoup of the html, or of just the needed_html_elements of it
+        """
+        with span("html.parse"):
+            if cls.needed_html_elements is None:
+                return Utils.make_soup(html_message, from_encoding)
+            return Utils.make_soup(html_message, from_encoding, ElementsStrainer(cls.needed_html_elements))
+
+    @staticmethod
+    def get_template(name):
+        """
+        :param name: the template's path under digesters/, like "jira/template.html"
+        :rtype: the jinja2 Template, compiled once per process (or not at all, if an earlier run already did, and
+        MetaStore.use_template_cache() was called)
+        """
+        if BaseDigester.template_environment is None:
+            bytecode_cache = None
+            if MetaStore.template_cache is not None:
+                os.makedirs(MetaStore.template_cache, exist_ok=True)
+                bytecode_cache = FileSystemBytecodeCache(MetaStore.template_cache)
+            BaseDigester.template_environment = Environment(
+                loader=FileSystemLoader(os.path.dirname(os.path.abspath(__file__))),
+                bytecode_cache=bytecode_cache,
+                auto_reload=False)
+            BaseDigester.template_environment.template_class = TimedTemplate
+        with span("template.load"):
+            return BaseDigester.template_environment.get_template(name)
+
+    def subordinate_digesters(self):
+        """
+        :rtype: digesters that this one hands notifications to, each with its own matching_incoming_headers(), if any
+        """
+        return []
+
     @staticmethod
     def remove_lines_that_are_fully_whitespace(email):
         return os.linesep.join([s for s in email.splitlines() if s.strip()])
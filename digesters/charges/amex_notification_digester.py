@@ -1,13 +1,15 @@
 import re
 import arrow
 import sys
-from bs4 import BeautifulSoup
 from decimal import Decimal
 
 from digesters.charges.base_charge_card_digester import BaseChargeCardDigester
 
 
 class AmexNotificationDigester(BaseChargeCardDigester):
+
+    extracts_notifications = True
+
     def __init__(self, charges):
         super(AmexNotificationDigester, self).__init__()
         self.charges = charges
@@ -21,6 +23,10 @@ class AmexNotificationDigester(BaseChargeCardDigester):
                 "From: \"American Express\" <americanexpress@member.americanexpress.com>"]
 
     def process_new_notification(self, rfc822content, msg, html_message, text_message):
+        return self.apply_notification(self.extract_notification(rfc822content, msg, html_message, text_message))
+
+    @staticmethod
+    def extract_notification(rfc822content, msg, html_message, text_message):
 
         when = arrow.get(msg['Date'].split(',', 1)[1].strip(), 'D MMM YYYY HH:mm:ss ZZ').timestamp
 
@@ -29,12 +35,18 @@ class AmexNotificationDigester(BaseChargeCardDigester):
         # Specifically - merchant name is missing from the plain text half
 
         if html_message:
-            soup = BeautifulSoup(html_message, 'html.parser')
+            soup = AmexNotificationDigester.make_soup(html_message)
             text = soup.find("body").get_text()
             text = " ".join(text.split())  # rmv line breaks, squish double spaces
         else:
             text = text_message
 
+        return when, text, text_message
+
+    def apply_notification(self, extracted):
+
+        when, text, text_message = extracted
+
         # Then again, Location: for 'card not present' is only in the plain text half
 
         processed = self.maybe_card_not_present_purchase(text_message, when)
@@ -2,13 +2,15 @@ import re
 
 import arrow
 import dateutil
-from bs4 import BeautifulSoup
 from decimal import Decimal
 
 from digesters.charges.base_charge_card_digester import BaseChargeCardDigester
 
 
 class BankOfAmericaNotificationDigester(BaseChargeCardDigester):
+
+    extracts_notifications = True
+
     def __init__(self, charges):
         super(BankOfAmericaNotificationDigester, self).__init__()
         self.charges = charges
@@ -21,15 +23,29 @@ class BankOfAmericaNotificationDigester(BaseChargeCardDigester):
         return ['From: "Bank of America" <onlinebanking@ealerts.bankofamerica.com>']
 
     def process_new_notification(self, rfc822content, msg, html_message, text_message):
+        return self.apply_notification(self.extract_notification(rfc822content, msg, html_message, text_message))
+
+    @staticmethod
+    def extract_notification(rfc822content, msg, html_message, text_message):
 
         email_date = arrow.get(msg['Date'].split(',', 1)[1].strip(), 'D MMM YYYY HH:mm:ss ZZ')
 
         if html_message:
-            self.get_charges(html_message, email_date)
-            return True
+            return BankOfAmericaNotificationDigester.get_charges(html_message, email_date)
+        return None
+
+    def apply_notification(self, extracted):
+
+        if extracted is None:
+            return False
 
+        for when, charge in extracted:
+            chg = self.make_or_get_charge_entry(when)
+            chg.update(charge)
+        return True
 
-    def get_charges(self, html_message, email_date):
+    @staticmethod
+    def get_charges(html_message, email_date):
 
         # Fix HTML corruption
         # matches = re.findall("([a-z])-[\r\n]+([a-z])", html_message)
@@ -38,27 +54,30 @@ class BankOfAmericaNotificationDigester(BaseChargeCardDigester):
         # html_message = "\n".join([line for line in html_message.split("\n") if not line.startswith("body[yahoo]")])
         # ... but HTML corruption doesn't seem to faze the lxml parser.
 
-        soup = BeautifulSoup(html_message, 'lxml', from_encoding="iso-8859-1")
+        soup = BankOfAmericaNotificationDigester.make_soup(html_message, from_encoding="iso-8859-1")
         text = soup.find("body").get_text()
         text = " ".join(text.split())  # rmv line breaks, squish double spaces
         text = text[text.index("Amount:"):]
         # This comes after the Amounts (transaction):
         text = text[:text.index("View details If you don't recognize this transaction")]
         text = text.replace(" Amount:", "\nAmount:")
+        charges = []
         for ix, line in enumerate(text.split("\n")):
             a_charge = re.search('Amount: \$ (.*) Credit card: .* ending in - (.*) Where: at (.*) Type: .* Transaction date: (.*)', line)
             if a_charge:
-                amt, card, vendor, when = self.pull_out_fields(a_charge)
+                amt, card, vendor, when = BankOfAmericaNotificationDigester.pull_out_fields(a_charge)
 
                 when.replace(hour=email_date.hour, minute=email_date.minute, second=email_date.second)
                 when = when.shift(seconds=ix)
 
-                chg = self.make_or_get_charge_entry(when.timestamp)
-                chg["type"] = "Charge"
-                chg["amt"] = Decimal(amt)
-                chg["curr"] = "$"
-                chg["vendor"] = vendor
-                chg["card"] = "BofA " + card
+                charges.append((when.timestamp, {
+                    "type": "Charge",
+                    "amt": Decimal(amt),
+                    "curr": "$",
+                    "vendor": vendor,
+                    "card": "BofA " + card
+                }))
+        return charges
 
 
     def make_or_get_charge_entry(self, when):
@@ -67,7 +86,8 @@ class BankOfAmericaNotificationDigester(BaseChargeCardDigester):
         return self.charges[when]
 
 
-    def pull_out_fields(self, a_charge):
+    @staticmethod
+    def pull_out_fields(a_charge):
         amt = a_charge.group(1)
         card = a_charge.group(2)
         vendor = a_charge.group(3).strip()
@@ -1,8 +1,6 @@
-import re
 from time import gmtime
 
 import arrow
-from jinja2 import Template
 
 from digesters.base_digester import BaseDigester
 from digesters.charges.amex_notification_digester import AmexNotificationDigester
@@ -12,6 +10,7 @@ from digesters.charges.capitalone_notification_digester import CapitalOneNotific
 from digesters.charges.chase_notification_digester import ChaseNotificationDigester
 from digesters.charges.citibank_notification_digester import CitibankNotificationDigester
 from digesters.charges.jpm_notification_digester import JPMorganNotificationDigester
+from digesters.header_matcher import HeaderMatcher
 
 
 class ChargeCardDigester(BaseDigester):
@@ -20,6 +19,7 @@ class ChargeCardDigester(BaseDigester):
         super(ChargeCardDigester, self).__init__()
         self.store_writer = store_writer
         self.digesters = []
+        self.header_matcher = None  # for the card specific digesters, made when first needed (after the with_*()s)
 
         self.charge_summary = store_writer.get_from_binary("charges")
 
@@ -30,33 +30,31 @@ class ChargeCardDigester(BaseDigester):
             self.charge_summary["charges"] = {}
             self.charge_summary["most_recent_seen"] = arrow.utcnow().replace(days=-365)
 
-    def with_chase(self):
-        self.digesters.append(ChaseNotificationDigester(self.new_charge_summary))
+    def with_card(self, digester):
+        self.digesters.append(digester)
+        self.header_matcher = None
         return self
 
+    def with_chase(self):
+        return self.with_card(ChaseNotificationDigester(self.new_charge_summary))
+
     def with_barclaycard(self):
-        self.digesters.append(BarclaycardNotificationDigester(self.new_charge_summary))
-        return self
+        return self.with_card(BarclaycardNotificationDigester(self.new_charge_summary))
 
     def with_bofa(self):
-        self.digesters.append(BankOfAmericaNotificationDigester(self.new_charge_summary))
-        return self
+        return self.with_card(BankOfAmericaNotificationDigester(self.new_charge_summary))
 
     def with_capitalone(self):
-        self.digesters.append(CapitalOneNotificationDigester(self.new_charge_summary))
-        return self
+        return self.with_card(CapitalOneNotificationDigester(self.new_charge_summary))
 
     def with_jpmorgan(self):
-        self.digesters.append(JPMorganNotificationDigester(self.new_charge_summary))
-        return self
+        return self.with_card(JPMorganNotificationDigester(self.new_charge_summary))
 
     def with_amex(self):
-        self.digesters.append(AmexNotificationDigester(self.new_charge_summary))
-        return self
+        return self.with_card(AmexNotificationDigester(self.new_charge_summary))
 
     def with_citi(self):
-        self.digesters.append(CitibankNotificationDigester(self.new_charge_summary))
-        return self
+        return self.with_card(CitibankNotificationDigester(self.new_charge_summary))
 
     def print_summary(self):
         for digester in self.digesters:
@@ -109,34 +107,11 @@ class ChargeCardDigester(BaseDigester):
             chg["when_str"] = arrow.get(when).to('local').format("MMM---DD HH:mm" if all_the_same_year
                                                                  else "MMM---DD YYYY HH:mm")
 
-        templ = """
-<table>
-  <tr style="background-color: #acf;">
-    <th>Type</th><th>Vendor</th><th>When</th><th>Curr</th><th>Amt</th><th>Card</th>
-  </tr>
-{% for when, chg in charges|dictsort(false, by='key')|reverse %}
-{%if when == most_recent_seen and not loop.first%}
-  <tr>
-    <td colspan="6" style="color:red; text-align: center; border-bottom: 1pt solid red; border-top: 1pt solid red;">
-      ^ New Charges Since You Last checked ^
-    </td>
-  </tr>
-{% endif %}
-  <tr style="{{loop.cycle('','background-color: #def;')}}">
-    <td>{{ chg['type'] }}</td>
-    <td>{{ chg['vendor'] }}</td>
-    <td>{{ chg['when_str'].replace('---','&nbsp;') }}</td>
-    <td>{{ chg['curr']  }}</td>
-    <td style="text-align: right;"><b>{{ chg['amt'] }}</b></td>
-    <td>{{ chg['card'] }}</td>
-  </tr>
-{% endfor %}
-</table>"""
-
         # print ">>> charges: " + simplejson.dumps(self.charge_summary["charges"], sort_keys=True) + "\n\n"
 
-        email_html = Template(templ).render(charges=self.charge_summary["charges"],
-                                            most_recent_seen=self.charge_summary["most_recent_seen"])
+        templ = self.get_template("charges/template.html")
+        email_html = templ.render(charges=self.charge_summary["charges"],
+                                  most_recent_seen=self.charge_summary["most_recent_seen"])
 
         email_html = self.remove_lines_that_are_fully_whitespace(email_html)
 
@@ -147,16 +122,22 @@ class ChargeCardDigester(BaseDigester):
         # Save
         self.store_writer.store_as_binary("charges", self.charge_summary)
 
+    def prepare_for_next_run(self):
+        # cleared in place, as the card specific digesters add to this very dict
+        self.new_charge_summary.clear()
+
+    def subordinate_digesters(self):
+        return self.digesters
+
     def process_new_notification(self, rfc822content, msg, html_message, text_message):
-        processed = False
-        for digester in self.digesters:
-            if not processed:
-                matching_headers =  digester.matching_incoming_headers()
-                for matching_header in matching_headers:
-                    if re.search(matching_header, rfc822content) is not None:
-                        processed = digester.process_new_notification(rfc822content, msg, html_message, text_message)
-                        break
-        return processed
+        # DigestionProcessor hands notifications straight to the card specific digesters, this is for anything else.
+        # Like there, if one that matches doesn't process it, the next one that matches is tried.
+        if self.header_matcher is None:
+            self.header_matcher = HeaderMatcher(self.digesters)
+        for digester, sub_digester in self.header_matcher.matches(rfc822content):
+            if digester.process_new_notification(rfc822content, msg, html_message, text_message):
+                return True
+        return False
 
     def make_new_raw_charge_email(self, email_html, when, sender_to_implicate):
         new_message = 'Subject: ' + self.matching_digest_subject() + '\n'
@@ -86,6 +86,9 @@ class ChaseNotificationDigester(BaseChargeCardDigester):
         when = arrow.get(rstrip, 'MM/DD/YYYY h:mm:ss A').replace(tzinfo=dateutil.tz.gettz(tz)).timestamp
         return amt, curr, vendor, when
 
+    def needs_html_message(self):
+        return False
+
     def matching_incoming_headers(self):
         return ["Subject: (.*) Alert from Chase"]
 
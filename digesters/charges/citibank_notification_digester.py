@@ -14,6 +14,9 @@ class CitibankNotificationDigester(BaseChargeCardDigester):
     def print_summary(self):
         print("New Citibank Charges: " + str(self.new_citi))
 
+    def needs_html_message(self):
+        return False
+
     def matching_incoming_headers(self):
         return ["From: Citi Alerts <alerts@citibank.com>"]
 
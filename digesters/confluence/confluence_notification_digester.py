@@ -5,14 +5,16 @@ import re
 from email.header import decode_header
 import arrow
 import simplejson
-from bs4 import BeautifulSoup
-from jinja2 import Template
 from collections import Counter
 
 from digesters.base_digester import BaseDigester
+from digesters.time_sorted_dict import TimeSortedDict
 
 
 class ConfluenceNotificationDigester(BaseDigester):
+
+    extracts_notifications = True
+
     def __init__(self, store_writer, from_email_address, confluence_short_name):
         super(ConfluenceNotificationDigester, self).__init__()
         self.confluence_short_name = confluence_short_name
@@ -20,9 +22,7 @@ class ConfluenceNotificationDigester(BaseDigester):
         self.store_writer = store_writer
         self.new_message_count = 0
         self.new_articles = 0
-        self.confluence_notifications = self.store_writer.get_from_binary("confluence-notifications")
-        if self.confluence_notifications is None:
-            self.confluence_notifications = {}
+        self.confluence_notifications = TimeSortedDict.from_store(self.store_writer.get_from_binary("confluence-notifications"))
 
         self.most_recently_seen = self.store_writer.get_from_binary("most-recently-seen")
         if self.most_recently_seen is None:
@@ -30,15 +30,21 @@ class ConfluenceNotificationDigester(BaseDigester):
 
         self.new_notifications = {}
 
+        self.prepare_for_next_run()
+
+    def prepare_for_next_run(self):
         self.previously_notified_article_count = len(self.confluence_notifications)
         if self.previously_notified_article_count > 0:
-            self.previously_notified_article_most_recent = max(self.confluence_notifications)
+            self.previously_notified_article_most_recent = self.confluence_notifications.newest()
         else:
             self.previously_notified_article_most_recent = 0
 
     def process_new_notification(self, rfc822content, msg, html_message, text_message):
+        return self.apply_notification(self.extract_notification(rfc822content, msg, html_message, text_message))
+
+    @staticmethod
+    def extract_notification(rfc822content, msg, html_message, text_message):
 
-        self.new_message_count += 1
         when = arrow.get(msg['Date'].split(',', 1)[1].strip(), 'D MMM YYYY HH:mm:ss ZZ').timestamp
 
         from_ = msg['From']
@@ -48,7 +54,7 @@ class ConfluenceNotificationDigester(BaseDigester):
 
         try:
             if html_message:
-                soup = BeautifulSoup(html_message, 'html.parser')
+                soup = ConfluenceNotificationDigester.make_soup(html_message)
                 # print "soup:" + str(soup.prettify())
                 event_text = soup.find("td", {"id": "header-text-container"}).text
                 doc_elem = soup.find("td", {"id": "page-title-pattern-header-container"}).find("span").find("a")
@@ -72,12 +78,18 @@ class ConfluenceNotificationDigester(BaseDigester):
                 if "edited a page" in event_text:
                     if "?" in doc_url:
                         doc_url = doc_url[:doc_url.find("?")]
-                    added = len(soup.findAll("span", {"class", "diff-html-added"}))
-                    added += len(soup.findAll("span", {"class", "x_diff-html-added"}))
-                    removed = len(soup.findAll("span", {"class", "diff-html-removed"}))
-                    removed += len(soup.findAll("span", {"class", "x_diff-html-removed"}))
-                    changed = len(soup.findAll("span", {"class", "diff-html-changed"}))
-                    changed += len(soup.findAll("span", {"class", "x_diff-html-changed"}))
+                    # One pass over the spans, rather than one per class. A span counts once for each of the
+                    # diff-html-* and x_diff-html-* classes that it has.
+                    diffs = Counter()
+                    for span in soup.find_all("span", class_=True):
+                        classes = set(span["class"])
+                        for diff in ("added", "removed", "changed"):
+                            for prefix in ("", "x_"):
+                                if prefix + "diff-html-" + diff in classes:
+                                    diffs[diff] += 1
+                    added = diffs["added"]
+                    removed = diffs["removed"]
+                    changed = diffs["changed"]
                     excerpt = "Page nodes added: " + str(added) \
                                                    + ", removed: " + str(removed) \
                                                    + ", changed: " + str(changed)
@@ -92,7 +104,7 @@ class ConfluenceNotificationDigester(BaseDigester):
                         excerpt += "..."
 
 
-                self.confluence_notifications[when] = {
+                return when, {
                      "doc_url": doc_url,
                      "who": who,
                      "space": space,
@@ -100,15 +112,24 @@ class ConfluenceNotificationDigester(BaseDigester):
                      "event": event_text,
                      "excerpt": excerpt
                 }
-
-                # print simplejson.dumps(self.confluence_notifications[when], sort_keys=True) + "\n\n"
-
-                return True
         except AttributeError:
             print("AttributeError processing confluence message")
             pass
 
-        return False
+        return None
+
+    def apply_notification(self, extracted):
+
+        self.new_message_count += 1
+        if extracted is None:
+            return False
+
+        when, notification = extracted
+        self.confluence_notifications[when] = notification
+
+        # print simplejson.dumps(self.confluence_notifications[when], sort_keys=True) + "\n\n"
+
+        return True
 
     def rewrite_digest_emails(self, digest_folder_proxy, has_previous_message, previously_seen, sender_to_implicate):
 
@@ -120,28 +141,9 @@ class ConfluenceNotificationDigester(BaseDigester):
             if self.previously_notified_article_count > 0:
                 self.most_recently_seen = self.previously_notified_article_most_recent
 
-        templ = """<html><body>{% if not_first_email %}<span>You have previously read notifications up to: {{most_recent_seen_str}}</span>{% endif %}
-        <table>
-          <tr style="background-color: #acf;">
-            <th>Notifications</th>
-          </tr>
-        {% for when, notif in notifs_to_print|dictsort(false, by='key')|reverse %}{% if notif['line_here'] %}          <tr><td colspan="2" style="border-bottom: 1pt solid red; border-top: 1pt solid red;"><center>^ New Notifications Since You Last Checked ^</center></td></tr>{% endif %}          <tr style="{{loop.cycle('','background-color: #def;')}}">
-            <td>
-              What: {{notif['event']}}<br/>
-              Space: {{notif['space']}}:<br/>
-              Page: <a href="{{notif['doc_url']}}">{{notif['doc_text'].replace('\n','<br/>')}}</a><br/>
-              Excerpt: {{notif['excerpt'].replace('\n','<br/>')}}
-            </td>
-          </tr>{% endfor %}
-        </table></body></html>""".replace("\n        ", "\n")
-
-        template = Template(templ)
-
-        cnt = 0
-        for when in sorted(iter(self.confluence_notifications.keys()), reverse=True):
-            cnt += 1
-            if 90 < cnt:  # only show thirty
-                self.confluence_notifications.pop(when, None)
+        template = self.get_template("confluence/template.html")
+
+        self.confluence_notifications.keep_newest(90)  # only show ninety
 
         num_messages_since_last_seen = self.add_line_for_notifications_seen_already()
 
@@ -161,12 +163,10 @@ class ConfluenceNotificationDigester(BaseDigester):
 
     def add_line_for_notifications_seen_already(self):
         num_messages_since_last_seen = 0
-        line_here_done = False
-        for ts0, notif in sorted(iter(self.confluence_notifications.items()), reverse=False):
-            if self.most_recently_seen != 0 and ts0 >= self.most_recently_seen and line_here_done is False:
-                notif['line_here'] = True
-                line_here_done = True
-                num_messages_since_last_seen += 1
+        first_unseen = self.confluence_notifications.first_since(self.most_recently_seen)
+        if self.most_recently_seen != 0 and first_unseen is not None:
+            self.confluence_notifications[first_unseen]['line_here'] = True
+            num_messages_since_last_seen += 1
         if self.most_recently_seen == 0:
             num_messages_since_last_seen = len(self.confluence_notifications)
 
@@ -1,15 +1,17 @@
+import email
 import sys
 from unittest import TestCase
 import unittest
 import os
 
 from importlib import reload
-from mock import Mock, call
+from mock import Mock, call, patch
 from mockextras import stub
 
 sys.path = [os.path.abspath(os.path.join('..', os.pardir))] + sys.path
 from digesters.confluence.confluence_notification_digester import ConfluenceNotificationDigester
 from digesters.digestion_processor import DigestionProcessor
+from utils import EmailBodies, Utils
 
 MAIL_HDR = """From: \"Apache Confluence\" <ph@example.com>
 Content-Transfer-Encoding: 8bit
@@ -149,6 +151,20 @@ class TestConfluenceNotifications(TestCase):
         self.assertEqual(str(to_delete_from_notification_folder), "[1234, 1235, 1236]")
         self.assertEqual(len(final_notifications_store.notifications), 3)
 
+    def test_either_html_parser_pulls_out_the_same(self):
+
+        extracted = {}
+        for html_parser in ["html.parser", "lxml"]:
+            with patch.object(Utils, "html_parser", html_parser):
+                extracted[html_parser] = []
+                for notification in [COMMENT_ADDED, COMMENT_DELETED, PAGE_EDITED]:
+                    msg = email.message_from_string(notification)
+                    html_message, text_message = EmailBodies(msg).messages(True, True)
+                    extracted[html_parser].append(
+                        ConfluenceNotificationDigester.extract_notification(notification, msg, html_message, text_message))
+
+        self.assertEqual(extracted["html.parser"], extracted["lxml"])
+
 
 COMMENT_ADDED = """Date: Sat, 9 Apr 2016 06:37:04 +0000
 From: "surya ferdy (Confluence)" <confluence@apache.org>
@@ -0,0 +1,49 @@
+import importlib
+
+from instrumentation import span
+
+
+class DigesterRegistry(object):
+    """ The digesters, declared by name with what they're made with, like
+    add("digesters.github.github_notification_digester.GithubNotificationDigester", MetaStore("github_notifications")).
+    A digester's module (and whatever it imports: bs4, jinja2, arrow ...) is only imported, and the digester made (which
+    is when its state is loaded), the first time digesters() is called. That's when there's a notification email to
+    hand to them, or their digests are to be rewritten - not on a run with nothing new.
+    Like a list, digesters that are already made can be append()ed too (as older my_digesters_setup.py files do).
+    """
+
+    def __init__(self, digesters=None):
+        self.entries = []  # made digesters, and (name or function, args, kwargs) for those not made yet
+        self.made = True  # until something is add()ed
+        for digester in digesters or []:
+            self.append(digester)
+
+    def add(self, name, *args, **kwargs):
+        """
+        :param name: the digester class's full dotted name, or a function that returns the digester
+        :param args: what to make it with (MetaStores are cheap to make, they load nothing until asked)
+        """
+        self.entries.append((name, args, kwargs))
+        self.made = False
+        return self
+
+    def append(self, digester):
+        self.entries.append(digester)
+
+    def digesters(self):
+        """
+        :rtype: list of the digesters, in the order they were declared, made now if they weren't already
+        """
+        if not self.made:
+            with span("digesters.load"):
+                self.entries = [self.make(entry) if isinstance(entry, tuple) else entry for entry in self.entries]
+            self.made = True
+        return self.entries
+
+    @staticmethod
+    def make(entry):
+        name, args, kwargs = entry
+        if callable(name):
+            return name(*args, **kwargs)
+        module_name, class_name = name.rsplit(".", 1)
+        return getattr(importlib.import_module(module_name), class_name)(*args, **kwargs)
@@ -1,109 +1,605 @@
 import email
+import hashlib
 import imaplib
 import re
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser, BytesParser
 
 from imapclient import IMAPClient
 
-from utils import Utils
+from digesters.digester_registry import DigesterRegistry
+from digesters.header_matcher import HeaderMatcher
+from instrumentation import count, span
+from utils import EmailBodies, Utils
+
+# What unmatched emails moved as they are (with move_unmatched_as_is) are tagged with, rather than [I:D] in the subject
+UNMATCHED_KEYWORD = "ImapDigesterUnmatched"
+
+# How many unmatched emails go in one MULTIAPPEND
+MULTIAPPEND_BATCH_SIZE = 20
+
+# What a server with UIDPLUS answers an APPEND with: the folder's UIDVALIDITY and the appended email's UID
+APPENDUID = re.compile(rb'\[APPENDUID (\d+) (\d+)\]')
+
+
+def digest_key(digester):
+    """ What tells a digester's digest email apart from the others'. The subject alone doesn't: JIRA, Confluence and
+    HipChat all have 'Notification Digest', and there can be two JIRA (or Github) digesters with the same subject.
+    """
+    return digester.matching_digest_subject(), digester.matching_digest_sender()
+
 
 class DigestServer(object):
+    """ What a digester's rewrite_digest_emails() deletes the previous digest email and appends the new one through.
+    With digest_hashes, the delete is held back until the new one is appended, and neither is done if the new one
+    would come out the same as the previous one. digest_uid is the UID of the digest email there is afterwards, if
+    known (with digest_uidvalidity, if the server said it). deleted is True once the previous one has been deleted.
+    """
 
-    def __init__(self, server, mid, digest_folder_name):
+    def __init__(self, server, mid, digest_folder_name, digest_hashes=None, digester=None):
         self.digest_folder_name = digest_folder_name
         self.digest_inbox = server
         self.previous_message_id = mid
+        self.digest_hashes = digest_hashes
+        self.digester = digester
+        self.delete_pending = False
+        self.digest_uid = mid
+        self.digest_uidvalidity = None
+        self.deleted = False
 
     def delete_previous_message(self):
-        self.digest_inbox.delete_messages([self.previous_message_id])
+        if self.digest_hashes is None:
+            with span("imap.delete"):
+                self.digest_inbox.delete_messages([self.previous_message_id])
+            self.digest_uid = None
+            self.deleted = True
+        else:
+            self.delete_pending = True
 
     def append(self, message):
-        self.digest_inbox.append(self.digest_folder_name, message.encode("utf-8"))
+        message = message.encode("utf-8")
+        if self.digest_hashes is not None:
+            key = digest_key(self.digester)
+            digest_hash = self.digest_hash(message)
+            if self.delete_pending and self.digest_hashes.unchanged(key, digest_hash):
+                self.delete_pending = False
+                count("digests.unchanged")
+                return
+        with span("imap.append"):
+            response = self.digest_inbox.append(self.digest_folder_name, message)
+        count("imap.append.bytes", len(message))
+        # Only now that the new one is there, so that if the append failed, the previous one (and its hash) is kept
+        self.finish()
+        if self.digest_hashes is not None:
+            self.digest_hashes.appended(key, digest_hash)
+        self.digest_uid = None
+        appended = APPENDUID.search(response) if isinstance(response, bytes) else None
+        if appended is not None:
+            self.digest_uidvalidity = int(appended.group(1))
+            self.digest_uid = int(appended.group(2))
+
+    def finish(self):
+        """ Do the delete that was held back, if there was no append after it
+        """
+        if self.delete_pending:
+            self.delete_pending = False
+            with span("imap.delete"):
+                self.digest_inbox.delete_messages([self.previous_message_id])
+            self.digest_uid = None
+            self.deleted = True
+
+    def digest_hash(self, message):
+        # The MIME boundary is random for each run, so it's left out
+        return hashlib.sha1(message.replace(self.digester.notification_boundary_rand.encode("utf-8"), b"")).hexdigest()
+
+
+class UidCheckpoint(object):
+    """ Remembers the highest UID handled in the notification folder, so that a run only looks at new mail.
+    That only holds while the folder's UIDVALIDITY stays the same, otherwise everything is looked at again.
+    With uidnext (what SELECT said the folder's next UID will be), nothing_new() can tell without a SEARCH.
+    """
+
+    def __init__(self, store_writer, uidvalidity, uidnext=None):
+        self.store_writer = store_writer
+        self.uidvalidity = uidvalidity
+        self.uidnext = uidnext
+        self.last_uid = 0
+        self.changed = True
+        saved = store_writer.get_from_binary("uid-checkpoint")
+        if saved is not None and saved["uidvalidity"] == uidvalidity:
+            self.last_uid = saved["last_uid"]
+            self.changed = False
+
+    def nothing_new(self):
+        """
+        :rtype: True if no email has arrived since the last one handled (some may have been deleted since)
+        """
+        return self.last_uid > 0 and self.uidnext is not None and self.uidnext <= self.last_uid + 1
+
+    def reselected(self, uidvalidity, uidnext=None):
+        """ The notification folder was selected again (after a reconnect, say)
+        """
+        self.uidnext = uidnext
+        if uidvalidity != self.uidvalidity:
+            self.uidvalidity = uidvalidity
+            self.last_uid = 0
+            self.changed = True
+
+    def search_criteria(self):
+        if self.last_uid == 0:
+            return 'NOT DELETED'
+        return ['UID', str(self.last_uid + 1) + ':*', 'NOT', 'DELETED']
+
+    def new_uids(self, uids):
+        # 'n:*' always includes the highest UID in the folder, even if that is below n
+        return [uid for uid in uids if uid > self.last_uid]
+
+    def handled_up_to(self, uid):
+        if uid > self.last_uid:
+            self.last_uid = uid
+            self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        self.changed = False
+        self.store_writer.store_as_binary("uid-checkpoint", {"uidvalidity": self.uidvalidity,
+                                                             "last_uid": self.last_uid})
+
+
+class DigestUids(object):
+    """ Remembers the UID of each digester's digest email (from APPENDUID, for servers with UIDPLUS), so that the
+    next run can FETCH those directly rather than look through the digest folder for them. Like UidCheckpoint, that
+    only holds while the digest folder's UIDVALIDITY stays the same.
+    """
+
+    def __init__(self, store_writer, uidvalidity):
+        self.store_writer = store_writer
+        self.uidvalidity = uidvalidity
+        self.uids = {}
+        self.changed = False
+        saved = store_writer.get_from_binary("digest-uids")
+        if saved is not None and saved["uidvalidity"] == uidvalidity:
+            self.uids = saved["uids"]
+
+    def reselected(self, uidvalidity):
+        """ The digest folder was selected again (after a reconnect, say)
+        """
+        if uidvalidity != self.uidvalidity:
+            self.uidvalidity = uidvalidity
+            self.uids = {}
+            self.changed = True
+
+    def uid(self, key):
+        return self.uids.get(key)
+
+    def record(self, key, uid, uidvalidity=None):
+        if uidvalidity is not None and uidvalidity != self.uidvalidity:
+            uid = None
+        if self.uids.get(key) == uid:
+            return
+        if uid is None:
+            del self.uids[key]
+        else:
+            self.uids[key] = uid
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        self.changed = False
+        self.store_writer.store_as_binary("digest-uids", {"uidvalidity": self.uidvalidity, "uids": self.uids})
+
+
+class DigestHashes(object):
+    """ Remembers a hash of each digester's digest email as last appended, so that DigestServer can leave the
+    previous one be when the new one is the same.
+    """
+
+    def __init__(self, store_writer):
+        self.store_writer = store_writer
+        self.hashes = store_writer.get_from_binary("digest-hashes") or {}
+        self.changed = False
+
+    def unchanged(self, key, digest_hash):
+        return self.hashes.get(key) == digest_hash
+
+    def appended(self, key, digest_hash):
+        if self.hashes.get(key) != digest_hash:
+            self.hashes[key] = digest_hash
+            self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        self.changed = False
+        self.store_writer.store_as_binary("digest-hashes", self.hashes)
 
 
 class DigestionProcessor(object):
 
     def __init__(self, notification_folder, digest_folder, digesters,
-                 print_summary, sender_to_implicate, move_unmatched, digest_folder_name):
+                 print_summary, sender_to_implicate, move_unmatched, digest_folder_name,
+                 fetch_batch_size=100, headers_first=False, uid_checkpoint=None, state_journal=None,
+                 worker_pool=None, digest_hashes=None, digest_uids=None, move_unmatched_as_is=False,
+                 same_account=False):
         super(DigestionProcessor, self)
+        self.move_unmatched_as_is = move_unmatched_as_is
+        self.same_account = same_account
+        self.digest_uids = digest_uids
+        self.digest_hashes = digest_hashes
+        self.worker_pool = worker_pool
+        self.state_journal = state_journal
+        self.uid_checkpoint = uid_checkpoint
+        self.headers_first = headers_first
+        self.fetch_batch_size = fetch_batch_size
         self.digest_folder_name = digest_folder_name
-        self.digesters = digesters
+        # A list of digesters, or a DigesterRegistry to make them when they're first needed
+        self.digester_registry = digesters if isinstance(digesters, DigesterRegistry) else DigesterRegistry(digesters)
+        self.made_header_matcher = None
         self.move_unmatched = move_unmatched
         self.sender_to_implicate = sender_to_implicate
         self.print_summary = print_summary
         self.digest_folder = digest_folder
         self.notification_folder = notification_folder
+        self.unmatched_mails = []
+        self.unmatched_uids = []  # to be moved by the server, see moves_unmatched_on_server()
+        self.to_delete = []
+        self.already_looked_at = set()
+        self.digested = set()  # digesters handed a notification since their digests were last rewritten
+
+    @property
+    def digesters(self):
+        return self.digester_registry.digesters()
+
+    @property
+    def header_matcher(self):
+        if self.made_header_matcher is None:
+            self.made_header_matcher = HeaderMatcher(self.digesters)
+        return self.made_header_matcher
+
+    def reconnected(self, notification_folder, notification_folder_info, digest_folder, digest_folder_info):
+        """ Carry on with new connections (a daemon's, after a connection problem), and with what selecting the two
+        folders again said about them
+        """
+        self.notification_folder = notification_folder
+        self.digest_folder = digest_folder
+        if self.uid_checkpoint is not None:
+            self.uid_checkpoint.reselected(notification_folder_info[b'UIDVALIDITY'],
+                                           notification_folder_info.get(b'UIDNEXT'))
+        if self.digest_uids is not None:
+            self.digest_uids.reselected(digest_folder_info[b'UIDVALIDITY'])
 
+    def shut_down_workers(self):
+        """ Wait for the worker processes (with --workers) to exit, when there are no more notifications for them
+        """
+        if self.worker_pool is not None:
+            self.worker_pool.shutdown()
 
     def doit(self):
-        messages = self.notification_folder.search('NOT DELETED')
-        response = self.notification_folder.fetch(messages, ['FLAGS', 'RFC822.SIZE'])
-        unmatched_mails = []
-        to_delete = []
+        """
+        :rtype: True if anything was deleted (from either folder), for there to be anything to expunge
+        """
+        if self.uid_checkpoint is not None and self.uid_checkpoint.nothing_new():
+            # Nothing has arrived since last time, so nothing to search for, and no digester needs making
+            return False
+        self.digest_notifications()
+        return self.rewrite_digests(just_new=True)
+
+    def digest_notifications(self):
+        """ Hand new emails in the notification folder to the digesters. Their digests are rewritten later, in
+        rewrite_digests(), which is also when the emails are deleted from the notification folder.
+        :rtype: the number of emails looked at
+        """
+        with span("imap.search"):
+            if self.uid_checkpoint is None:
+                messages = self.notification_folder.search('NOT DELETED')
+            else:
+                messages = self.uid_checkpoint.new_uids(
+                    self.notification_folder.search(self.uid_checkpoint.search_criteria()))
+
+        # A processor kept around for another run (daemon mode) must not look at the same emails twice. They count as
+        # looked at only once their batch is done with, so that a batch whose FETCH failed (the connection was lost,
+        # say) is fetched again after the daemon reconnects, rather than skipped - and passed by the checkpoint.
+        self.already_looked_at.intersection_update(messages)
+        messages = sorted(set(messages) - self.already_looked_at)
+
+        # Loop through email in notification folder, fetching bodies a batch of UIDs at a time
+        for batch in Utils.chunks(messages, self.fetch_batch_size):
+            self.digest_batch(batch)
+            self.already_looked_at.update(batch)
+            if self.uid_checkpoint is not None:
+                self.uid_checkpoint.handled_up_to(batch[-1])
 
-        # Loop through email in notification folder
-        for msgid, data in response.items():
-            rfc_msgid = self.notification_folder.fetch(msgid, ["INTERNALDATE", "BODY", "RFC822"])[msgid]
-            rfc822content = rfc_msgid[b'RFC822'].decode('ISO-8859-1')
+        return len(messages)
+
+    def digest_batch(self, batch):
+        """ Fetch a batch of the notification emails, and hand them to the digesters
+        :param batch: list of UIDs, in order
+        """
+        if self.headers_first:
+            batch = self.worth_downloading(batch)
+            if len(batch) == 0:
+                return
+        with span("imap.fetch"):
+            response = self.notification_folder.fetch(batch, ["INTERNALDATE", "RFC822"])
+        # Not those gone since the search (deleted by another client)
+        notifications = [(msgid, response[msgid][b'RFC822']) for msgid in batch if msgid in response]
+        count("imap.fetch.emails", len(notifications))
+        count("imap.fetch.bytes", sum(len(rfc822content) for msgid, rfc822content in notifications))
+        extractions = self.start_extractions(notifications)
+        for msgid, rfc822content in notifications:
 
             # Debugging strange transcrpion error?
             # Well this catch Exception may need to be commented out
             # so that you can see the full (root cause) stack trace
 
             try:
-                self.process_incoming_notification(msgid, self.digesters, rfc822content, to_delete,
-                                                   unmatched_mails, self.move_unmatched)
+                self.process_incoming_notification(msgid, self.digesters, rfc822content, self.to_delete,
+                                                   self.unmatched_mails, self.move_unmatched,
+                                                   extractions.get(msgid))
             except Exception as e:
-                modified_mail = re.sub("\nSubject:", "\nSubject: [" + str(e) + "]", rfc822content)
-                unmatched_mails.append(modified_mail)
+                modified_mail = rfc822content.replace(b"\nSubject:",
+                                                      b"\nSubject: [" + str(e).encode('utf-8') + b"]")
+                self.unmatched_mails.append(modified_mail)
 
+    def rewrite_digests(self, just_new=False):
+        """ Rewrite the digest emails, move unmatched emails, and delete the notification emails that were digested
+        :param just_new: only rewrite the digests of digesters that were handed notifications since last time. The
+        others' would come out the same (rewrite_digest_emails() does nothing when there's nothing new), so this
+        saves looking for their digest emails - and, when there were none at all, making the digesters.
+        :rtype: True if anything was deleted (from either folder), for there to be anything to expunge
+        """
+        deleted = len(self.to_delete) > 0
 
         # Rewrite emails in the digest folder (the one the end-user actually reads)
-        for digester in self.digesters:
-            subj_to_match = 'HEADER Subject "' + digester.matching_digest_subject() + '"'
-            from_to_match = 'HEADER From "' + digester.matching_digest_sender() + '"'
-            search_criteria = 'NOT DELETED ' + subj_to_match + " " + from_to_match
-            try:
-                messages = self.digest_folder.search(search_criteria)
-            except imaplib.IMAP4.abort:
-                messages = self.digest_folder.search(search_criteria)
-            response = self.digest_folder.fetch(messages, ['FLAGS', 'RFC822.SIZE'])
-            previously_seen = False
-            previous_message_id = None
-            for msgid, data in response.items():
-                previous_message_id = msgid
-                previously_seen = '\\Seen' in data[b'FLAGS']
-            digest_inbox_proxy = DigestServer(self.digest_folder, previous_message_id, self.digest_folder_name)
-            digester.rewrite_digest_emails(digest_inbox_proxy, previous_message_id is not None, previously_seen,
-                                           self.sender_to_implicate)
+        digesters = self.digesters_if_made() if just_new else self.digesters
+        indexes = None
+        if just_new:
+            indexes = [index for index, digester in enumerate(digesters) if digester in self.digested]
+        with span("imap.find_digests"):
+            previous_digests = self.previous_digests(indexes)
+        for index, digester in enumerate(digesters):
+            if indexes is not None and index not in indexes:
+                continue
+            previous_message_id, previously_seen = previous_digests.get(index, (None, False))
+            digest_inbox_proxy = DigestServer(self.digest_folder, previous_message_id, self.digest_folder_name,
+                                              self.digest_hashes, digester)
+            with span("digester." + type(digester).__name__ + ".rewrite"):
+                digester.rewrite_digest_emails(digest_inbox_proxy, previous_message_id is not None, previously_seen,
+                                               self.sender_to_implicate)
+                digest_inbox_proxy.finish()
+            deleted = deleted or digest_inbox_proxy.deleted
+            if self.digest_uids is not None:
+                self.digest_uids.record(digest_key(digester), digest_inbox_proxy.digest_uid,
+                                        digest_inbox_proxy.digest_uidvalidity)
+            digester.prepare_for_next_run()
+        self.digested = set()
 
         # Move Unmatched files so the human can see them
-        for unmatched in unmatched_mails:
+        with span("imap.move_unmatched"):
+            if len(self.unmatched_uids) > 0:
+                self.move_unmatched_on_server()
+                deleted = deleted or len(self.to_delete) > 0
+            if self.move_unmatched_as_is:
+                self.append_unmatched_as_is()
+            else:
+                self.append_unmatched()
+
+        # Remember how far we got, so the next run only looks at newer emails (and what the digests came out as)
+
+        if self.uid_checkpoint is not None:
+            self.uid_checkpoint.save()
+        if self.digest_hashes is not None:
+            self.digest_hashes.save()
+        if self.digest_uids is not None:
+            self.digest_uids.save()
+
+        # Write what the digesters (and the checkpoint) stored this run, all together, before the originals go
+
+        if self.state_journal is not None:
+            with span("metastore.commit"):
+                self.state_journal.commit()
+
+        # Delete Originals
+
+        with span("imap.delete"):
+            self.notification_folder.delete_messages(self.to_delete)
+
+        self.unmatched_mails = []
+        self.to_delete = []
+
+        # Print summary for posterity
+
+        if self.print_summary:
+            for digester in self.digesters_if_made():
+                digester.print_summary()
+
+        return deleted
+
+    def digesters_if_made(self):
+        """
+        :rtype: the digesters, or none if they haven't been made yet (no notification has come their way)
+        """
+        if not self.digester_registry.made:
+            return []
+        return self.digesters
+
+    def moves_unmatched_on_server(self):
+        """
+        :rtype: True if unmatched emails are moved by the server, with no need to download them. For that they're to
+        be moved as they are, within the one account.
+        """
+        return self.move_unmatched and self.move_unmatched_as_is and self.same_account
+
+    def move_unmatched_on_server(self):
+        uids = self.unmatched_uids
+        self.unmatched_uids = []
+        try:
+            self.notification_folder.add_flags(uids, [UNMATCHED_KEYWORD])
+            if self.notification_folder.has_capability('MOVE'):
+                self.notification_folder.move(uids, self.digest_folder_name)
+            else:
+                self.notification_folder.copy(uids, self.digest_folder_name)
+                self.to_delete.extend(uids)
+        except IMAPClient.Error as e:
+            print("Can't move " + str(len(uids)) + " unmatched email(s), error:" + str(e))
+
+    def append_unmatched(self):
+        for unmatched in self.unmatched_mails:
             # unm = re.sub("\nFrom: .*\r\n", "\nFrom: " + self.sender_to_implicate + "\r\n", unm)
             # unm = re.sub("\nTo: .*\r\n", "\nTo: " + self.sender_to_implicate + "\r\n", unm)
 
 
             # modified_mail = re.sub("\\nSubject:", "\\nSubject: [I:D]", unmatched)
-            modified_mail = unmatched.replace("\nSubject:", "\nSubject: [I:D]")
+            if type(unmatched) is str:
+                unmatched = unmatched.encode('utf-8')  # handed to process_incoming_notification() as a str
+            modified_mail = unmatched.replace(b"\nSubject:", b"\nSubject: [I:D]")
             # print("UNMATCHED:::")
             # print(modified_mail)
             # b = bytes(modified_mail, "utf8")
             # print("-=-=-=-=-=-=-=-=")
             # print(str(b))
             try:
-                self.digest_folder.append(self.digest_folder_name, modified_mail.encode('utf-8'))
+                self.digest_folder.append(self.digest_folder_name, modified_mail)
             except IMAPClient.AbortError as e:
-                print("Can't move '" + self.get_subject(modified_mail) + "', error:" + str(e))
+                print("Can't move '" + self.get_subject(modified_mail.decode('ISO-8859-1')) + "', error:" + str(e))
                 break
 
-        # Delete Originals
+    def append_unmatched_as_is(self):
+        """ Unmatched emails (from another account) APPENDed as they are, tagged with UNMATCHED_KEYWORD. Several to
+        an APPEND, if the digest server has MULTIAPPEND.
+        """
+        unmatched_mails = [unmatched.encode('utf-8') if type(unmatched) is str else unmatched
+                           for unmatched in self.unmatched_mails]
+        try:
+            if self.digest_folder.has_capability('MULTIAPPEND'):
+                for batch in Utils.chunks(unmatched_mails, MULTIAPPEND_BATCH_SIZE):
+                    self.digest_folder.multiappend(self.digest_folder_name,
+                                                   [{"msg": unmatched, "flags": [UNMATCHED_KEYWORD]}
+                                                    for unmatched in batch])
+            else:
+                for unmatched in unmatched_mails:
+                    self.digest_folder.append(self.digest_folder_name, unmatched, flags=[UNMATCHED_KEYWORD])
+        except IMAPClient.Error as e:
+            print("Can't move unmatched emails, error:" + str(e))
 
-        self.notification_folder.delete_messages(to_delete)
+    def previous_digests(self, indexes=None):
+        """ Finds every digester's digest email in the digest folder (or just those of the digesters at indexes). The
+        ones whose UID digest_uids knows are FETCHed by UID, all together. For the rest, there's one SEARCH (an OR of
+        each one's Subject and From), and one FETCH of the Subject and From of what it found, to tell which is whose -
+        rather than a SEARCH (and a FETCH) for each digester, or a FETCH of everything in the folder.
+        :rtype: dict of the index of each digester that has one -> (its UID, whether it has been read). If there's
+        more than one, the most recent one (the highest UID).
+        """
+        previous_digests = {}
+        if indexes is not None and len(indexes) == 0:
+            return previous_digests
+        if self.digest_uids is not None:
+            known_uids = {}
+            for index, digester in enumerate(self.digesters):
+                if indexes is not None and index not in indexes:
+                    continue
+                uid = self.digest_uids.uid(digest_key(digester))
+                if uid is not None:
+                    known_uids[index] = uid
+            if len(known_uids) > 0:
+                response = self.fetch_from_digest_folder(sorted(set(known_uids.values())), ['FLAGS'])
+                for index, uid in known_uids.items():
+                    flags = response.get(uid, {}).get(b'FLAGS', (b'\\Deleted',))
+                    if b'\\Deleted' not in flags:
+                        previous_digests[index] = (uid, b'\\Seen' in flags)
 
-        # Print summary for posterity
+        still_to_find = [index for index in (range(len(self.digesters)) if indexes is None else indexes)
+                         if index not in previous_digests]
+        if len(still_to_find) == 0:
+            return previous_digests
+        wanted = []
+        for index in still_to_find:
+            digester = self.digesters[index]
+            header_criteria = ['HEADER', 'Subject', digester.matching_digest_subject(),
+                               'HEADER', 'From', digester.matching_digest_sender()]
+            if header_criteria not in wanted:
+                wanted.append(header_criteria)
+        with span("imap.search"):
+            uids = self.digest_folder.search(['OR'] * (len(wanted) - 1) + wanted + ['UNDELETED'])
+        if len(uids) == 0:
+            return previous_digests
+        response = self.fetch_from_digest_folder(uids, ['FLAGS', 'BODY.PEEK[HEADER.FIELDS (SUBJECT FROM)]'])
 
-        if self.print_summary:
-            for digester in self.digesters:
-                digester.print_summary()
+        for msgid in sorted(response):
+            data = response[msgid]
+            flags = data.get(b'FLAGS', ())
+            if b'\\Deleted' in flags:
+                continue
+            header_block = b''
+            for key, value in data.items():
+                if key.startswith(b'BODY[HEADER'):
+                    header_block = value
+            headers = BytesHeaderParser().parsebytes(header_block)
+            # What IMAP's SEARCH HEADER does: a case-insensitive substring match
+            subject = self.decoded_header(headers['Subject']).lower()
+            sender = self.decoded_header(headers['From']).lower()
+            for index in still_to_find:
+                digester = self.digesters[index]
+                if digester.matching_digest_subject().lower() in subject \
+                        and digester.matching_digest_sender().lower() in sender:
+                    previous_digests[index] = (msgid, b'\\Seen' in flags)
+        return previous_digests
+
+    def fetch_from_digest_folder(self, messages, items):
+        try:
+            return self.digest_folder.fetch(messages, items)
+        except imaplib.IMAP4.abort:
+            return self.digest_folder.fetch(messages, items)
+
+    @staticmethod
+    def decoded_header(value):
+        if value is None:
+            return ""
+        return str(make_header(decode_header(value)))
+
+    def worth_downloading(self, batch):
+        """ Fetch just the headers for a batch of notification emails, and decide which are worth downloading in
+        full. That's those that a digester might want, and (if they're to be moved) the unmatched ones too.
+        """
+        with span("imap.fetch.headers"):
+            response = self.notification_folder.fetch(batch, ["BODY.PEEK[HEADER]"])
+        wanted = []
+        for msgid in batch:
+            if msgid not in response:
+                continue
+            header_block = response[msgid][b'BODY[HEADER]']
+            if len(self.matching_digesters(self.digesters, header_block.decode('ISO-8859-1'))) > 0:
+                wanted.append(msgid)
+            elif self.moves_unmatched_on_server():
+                self.unmatched_uids.append(msgid)
+            elif self.move_unmatched:
+                wanted.append(msgid)
+            else:
+                self.report_unmatched(BytesHeaderParser().parsebytes(header_block))
+        return wanted
+
+    def start_extractions(self, notifications):
+        """ With a worker pool, start the extract_notification() half of processing notifications (the HTML parsing,
+        mostly) in the worker processes, for those whose digester has one. process_incoming_notification() then
+        applies them in UID order, so state is changed in the same order as without workers.
+        :rtype: dict of msgid to (the digester the extraction is for, its Future)
+        """
+        extractions = {}
+        if self.worker_pool is None:
+            return extractions
+        for msgid, rfc822content in notifications:
+            matching = self.matching_digesters(self.digesters, Utils.header_block(rfc822content).decode('ISO-8859-1'))
+            if len(matching) == 0:
+                continue
+            target = matching[0][1] or matching[0][0]
+            if target.extracts_notifications:
+                extractions[msgid] = (target, self.worker_pool.submit(extract_notification,
+                                                                      type(target).extract_notification, rfc822content,
+                                                                      target.needs_html_message(),
+                                                                      target.needs_text_message()))
+        return extractions
 
     def get_subject(self, rfc822content):
         for line in rfc822content.split("\\n"):
@@ -111,42 +607,78 @@ class DigestionProcessor(object):
                 return line[len("Subject: "):]
         return "[i:d] - unknown subject"
 
+    def matching_digesters(self, digesters, rfc822content):
+        """ (digester, sub_digester) pairs, in the order the digesters were given, that have an incoming header that
+        matches the email. rfc822content can be the whole email, or just its header block.
+        """
+        with span("match"):
+            if digesters is not self.digesters:
+                return HeaderMatcher(digesters).matches(rfc822content)
+            return self.header_matcher.matches(rfc822content)
+
     def process_incoming_notification(self, msgid, digesters, rfc822content, to_delete,
-                                      unmatched_to_move, move_unmatched):
-        msg = email.message_from_string(rfc822content)
-        html_message = Utils.get_decoded_email_body(msg, True)
-        text_message = Utils.get_decoded_email_body(msg, False)
+                                      unmatched_to_move, move_unmatched, extraction=None):
+        """
+        :param rfc822content: the email as fetched (bytes), or as a str
+        :param extraction: (digester, Future) from start_extractions(), if the email's been given to a worker
+        """
+        raw = rfc822content
+        if type(raw) is bytes:
+            # Only emails that a digester wants are parsed (and decoded for it) in full
+            header_block = Utils.header_block(raw)
+            matching = self.matching_digesters(digesters, header_block.decode('ISO-8859-1'))
+            with span("mime.parse"):
+                if len(matching) > 0:
+                    msg = BytesParser().parsebytes(raw)
+                    rfc822content = raw.decode('ISO-8859-1')
+                else:
+                    msg = BytesHeaderParser().parsebytes(header_block)
+        else:
+            matching = self.matching_digesters(digesters, rfc822content)
+            with span("mime.parse"):
+                msg = email.message_from_string(rfc822content)
 
-        if type(text_message) is bytes:
-            text_message = text_message.decode("utf-8")
+        bodies = EmailBodies(msg)
 
         processed = False
-        for digester in digesters:
+        for digester, sub_digester in matching:
+            target = sub_digester or digester
+            if extraction is not None and extraction[0] is target:
+                # How long was spent waiting for a worker, rather than how long the worker took
+                with span("digester." + type(target).__name__ + ".extract_wait"):
+                    extracted = extraction[1].result()
+                with span("digester." + type(target).__name__ + ".apply"):
+                    processed = target.apply_notification(extracted)
+            else:
+                with span("mime.decode"):
+                    html_message, text_message = bodies.messages(target.needs_html_message(),
+                                                                 target.needs_text_message())
+                with span("digester." + type(target).__name__ + ".process"):
+                    processed = target.process_new_notification(rfc822content, msg, html_message, text_message)
             if processed:
+                self.digested.add(digester)
                 break
-            matching_incoming_headers = digester.matching_incoming_headers()
-            for matching_header in matching_incoming_headers:
-
-                # Note, matching_header contains things like:
-                # From: .* <jira@apache.org>
-                #       ^ regex!!
-
-                # Note2, rfc822content contains everything as a string, including the headers
-                # ...
-                # From: "Thomas Neidhart (JIRA)" <jira@apache.org>
-                # To: <you@example.com>
-                # Message-ID: <JIRA.12911300.1446902881000.65833.1447445412298@Atlassian.JIRA>
-                # ...
-
-                if re.search(matching_header, rfc822content) is not None or rfc822content.find(matching_header) != -1:
-                    processed = digester.process_new_notification(rfc822content, msg, html_message, text_message)
-                    break
 
         if processed:
             to_delete.append(msgid)
         else:
-            if move_unmatched:
-                unmatched_to_move.append(rfc822content)
+            if move_unmatched and self.moves_unmatched_on_server():
+                self.unmatched_uids.append(msgid)
+            elif move_unmatched:
+                unmatched_to_move.append(raw)
                 to_delete.append(msgid)
             else:
-                print("Unmatched email from: " + msg['From'].strip() + ", subject: " + msg['Subject'].strip())
+                self.report_unmatched(msg)
+
+    @staticmethod
+    def report_unmatched(msg):
+        print("Unmatched email from: " + str(msg['From']).strip() + ", subject: " + str(msg['Subject']).strip())
+
+
+def extract_notification(extract, rfc822content, html_needed, text_needed):
+    """ What a worker process does (see DigestionProcessor.start_extractions): parse an email, as fetched, and hand it
+    to a digester's extract_notification()
+    """
+    msg = BytesParser().parsebytes(rfc822content)
+    html_message, text_message = EmailBodies(msg).messages(html_needed, text_needed)
+    return extract(rfc822content.decode('ISO-8859-1'), msg, html_message, text_message)
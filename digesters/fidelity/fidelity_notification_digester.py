@@ -14,6 +14,9 @@ class FidelityNotificationDigester(BaseDigester):
         self.balances = self.store_writer.get_from_binary("fidelity-balances")
         if self.balances is None:
             self.balances = {}
+        self.prepare_for_next_run()
+
+    def prepare_for_next_run(self):
         self.previously_notified_article_count = len(self.balances)
 
     def process_new_notification(self, rfc822content, msg, html_message, text_message):
@@ -44,6 +47,12 @@ class FidelityNotificationDigester(BaseDigester):
         # Save
         self.store_writer.store_as_binary("fidelity-balances", self.balances)
 
+    def needs_html_message(self):
+        return False
+
+    def needs_text_message(self):
+        return False
+
     def matching_incoming_headers(self):
         return ["From: Fidelity Investments<Fidelity.Alerts@Fidelity.com>"]
 
@@ -1,17 +1,26 @@
+import heapq
 import io
 import re
 from email.header import decode_header
 
 import arrow
-from jinja2 import Template
 
 from digesters.base_digester import BaseDigester
 
 
 class GithubNotificationDigester(BaseDigester):
+    """ The notifications kept (and shown in the digest) can be bounded: at most max_topics issues/pull
+    requests/commits, the ones with the most recent notifications, at most max_events_per_topic notifications for each,
+    and (with max_age_days) none that have had nothing for that long before the newest notification. None (the
+    default, for each) for no limit.
+    """
+
     def __init__(self, store_writer, return_path_email="noreply@github.com", from_email="notifications@github.com",
-                 site="github.com", known_as="Github"):
+                 site="github.com", known_as="Github", max_topics=None, max_events_per_topic=None, max_age_days=None):
         super(GithubNotificationDigester, self).__init__()
+        self.max_topics = max_topics
+        self.max_events_per_topic = max_events_per_topic
+        self.max_age_days = max_age_days
         self.site = site
         self.known_as = known_as
         self.from_email = from_email
@@ -22,6 +31,9 @@ class GithubNotificationDigester(BaseDigester):
         self.github_notifications = self.store_writer.get_from_binary("github-notifications")
         if self.github_notifications is None:
             self.github_notifications = {}
+        # A heap of (mostRecent, topic), for the topic with the oldest most recent notification to be evicted first.
+        # Made when first needed. Entries for a topic whose mostRecent has changed since (or that's gone) are skipped.
+        self.topics_by_recency = None
 
         self.most_recently_seen = self.store_writer.get_from_binary("most-recently-seen")
         if self.most_recently_seen is None:
@@ -72,6 +84,9 @@ class GithubNotificationDigester(BaseDigester):
 
         return True
 
+    def prepare_for_next_run(self):
+        self.new_notifications = {}
+
     @staticmethod
     def make_new_noticiation(closedVia, closed, issueComment, commitComment, message, nick, openPR, prComment,
                              review, subj, topic, who):
@@ -127,6 +142,7 @@ class GithubNotificationDigester(BaseDigester):
         # Deleted email (by the user) means they don't want to see THOSE notifications listed in a Digest again.
         if has_previous_message == False:
             self.github_notifications = {}
+            self.topics_by_recency = None
 
         # If the last mail has been read, then everything in it has been seen
         if previously_seen:
@@ -144,41 +160,7 @@ class GithubNotificationDigester(BaseDigester):
 
         num_messages_since_last_seen = self.add_time_differences_and_line_to(notifs_to_print)
 
-        templ = """
-{% if not_first_email %}<span>You have previously read notifications up to: {{most_recent_seen_str}}</span>{% endif %}
-<table>
-  <tr style="background-color: #acf;">
-    <th>When</th><th>Issues/Pull Requests &amp; Their Notifications</th>
-  </tr>
-{% for when, topic in notifs_to_print|dictsort(false, by='key')|reverse %}
-{% if topic['line_here'] %}
-  <tr>
-    <td colspan="2" style="border-bottom: 1pt solid red; border-top: 1pt solid red;">
-      <center>^ New/Updated Notifications Since You Last Checked ^</center>
-    </td>
-  </tr>
-{% endif %}
-  <tr style="{{loop.cycle('','background-color: #def;')}}">
-    <td valign="top">{{ topic.when.replace('---','<br/>') }}</td>
-    <td>
-      <table style="border-top: none">
-        <tr>
-          <td style="border-bottom: 2px solid lightgrey;">
-            <a href="https://{{site}}/{{topic['path']}}">{{ topic['type'] }}: {{ topic['subj'] }}</a>
-          </td>
-        </tr>
-{% for t, detail in topic['ts']|dictsort(false, by='key')|reverse %}
-        <tr>
-          <td{{' style="font-weight: bold;"' if t>most_recent_seen}}>{{ detail['who'] }} ({{ detail['what'] }}{{ detail['diff'] }}) {{detail["msg"]}}</td>
-        </tr>
-{% endfor %}
-       </table>
-    </td>
-  </tr>
-{% endfor %}
-</table>"""
-
-        template = Template(templ)
+        template = self.get_template("github/template.html")
         seen_formated = arrow.get(self.most_recently_seen).to("local").format("MMM DD YYYY hh:mm A")
         email_html = template.render(notifs_to_print=notifs_to_print,
                                      site=self.site,
@@ -211,17 +193,54 @@ class GithubNotificationDigester(BaseDigester):
         self.store_writer.store_as_binary("most-recently-seen", self.most_recently_seen)
 
     def add_new_notifications_to_those_grouped_by_topic_and_calc_most_recent_for_each_topic(self):
+        if self.topics_by_recency is None:
+            self.index_topics_by_recency()
         for ts, notif in self.new_notifications.items():
             if (notif["topic"] not in self.github_notifications):
                 self.github_notifications[notif["topic"]] = {"ts": {}, "mostRecent": 0}
             if (ts > self.github_notifications[notif["topic"]]["mostRecent"]):
                 self.github_notifications[notif["topic"]]["mostRecent"] = ts
+                heapq.heappush(self.topics_by_recency, (ts, notif["topic"]))
             self.github_notifications[notif["topic"]]["subj"] = notif["subj"]
             self.github_notifications[notif["topic"]]["ts"][ts] = {
                 "who": notif["who"],
                 "what": notif["what"],
                 "msg": notif["msg"]
             }
+            self.drop_oldest_events(self.github_notifications[notif["topic"]])
+        if len(self.new_notifications) > 0:
+            self.evict_topics(max(self.new_notifications))
+
+    def index_topics_by_recency(self):
+        # Once per process - and a chance to bring a store from before there were limits within them
+        self.topics_by_recency = [(detail["mostRecent"], topic) for topic, detail in self.github_notifications.items()]
+        heapq.heapify(self.topics_by_recency)
+        for detail in self.github_notifications.values():
+            self.drop_oldest_events(detail)
+
+    def drop_oldest_events(self, detail):
+        if self.max_events_per_topic is not None and len(detail["ts"]) > self.max_events_per_topic:
+            for ts in sorted(detail["ts"])[:len(detail["ts"]) - self.max_events_per_topic]:
+                del detail["ts"][ts]
+
+    def evict_topics(self, newest):
+        """ Drop topics (those whose most recent notification is oldest first) until within max_topics and
+        max_age_days. Each one dropped is a pop from the heap, without looking at the rest.
+        """
+        cutoff = None if self.max_age_days is None else newest - self.max_age_days * 24 * 60 * 60
+        while len(self.topics_by_recency) > 0:
+            ts, topic = self.topics_by_recency[0]
+            detail = self.github_notifications.get(topic)
+            if detail is not None and detail["mostRecent"] == ts:
+                too_many = self.max_topics is not None and len(self.github_notifications) > self.max_topics
+                too_old = cutoff is not None and ts < cutoff
+                if not too_many and not too_old:
+                    break
+                del self.github_notifications[topic]
+            heapq.heappop(self.topics_by_recency)
+        # Mostly entries that were skipped, for topics with newer notifications since
+        if len(self.topics_by_recency) > 2 * len(self.github_notifications) + 100:
+            self.index_topics_by_recency()
 
     def map_topics_by_their_most_recent_notification(self):
         # map topics by their most recent notification
@@ -268,6 +287,9 @@ class GithubNotificationDigester(BaseDigester):
         mostRecentNotification['line_here'] = False
         return num_messages_since_last_seen
 
+    def needs_html_message(self):
+        return False
+
     def matching_incoming_headers(self):
         return ["\nReturn-Path: " + self.return_path_email, "\nFrom: .* <" + self.from_email + ">"]
 
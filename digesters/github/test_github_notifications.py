@@ -143,6 +143,43 @@ class TestGithubNotifications(TestCase):
         self.assertEqual(str(to_delete_from_notification_folder), "[1234, 1235]")
         self.assertEqual(len(final_notifs_store.notifs), 1)
 
+    def test_only_the_most_recent_topics_and_notifications_are_kept(self):
+
+        store_writer = Mock()
+        store_writer.get_from_binary.return_value = None
+        digester = GithubNotificationDigester(store_writer, max_topics=2, max_events_per_topic=2)
+
+        def notif(topic, who):
+            return {"topic": topic, "subj": topic + " subj", "who": who, "what": "commented", "msg": "hi"}
+
+        digester.new_notifications = {100: notif("a/b-1", "x"), 400: notif("a/b-2", "y"), 300: notif("a/b-3", "z"),
+                                      200: notif("a/b-2", "w")}
+        digester.add_new_notifications_to_those_grouped_by_topic_and_calc_most_recent_for_each_topic()
+        self.assertEqual(sorted(digester.github_notifications), ["a/b-2", "a/b-3"])
+
+        digester.new_notifications = {500: notif("a/b-3", "v"), 600: notif("a/b-3", "u")}
+        digester.add_new_notifications_to_those_grouped_by_topic_and_calc_most_recent_for_each_topic()
+        self.assertEqual(sorted(digester.github_notifications["a/b-3"]["ts"]), [500, 600])
+        self.assertEqual(digester.github_notifications["a/b-3"]["mostRecent"], 600)
+
+        digester.max_age_days = 1
+        digester.new_notifications = {600 + 24 * 60 * 60: notif("a/b-4", "t")}
+        digester.add_new_notifications_to_those_grouped_by_topic_and_calc_most_recent_for_each_topic()
+        self.assertEqual(sorted(digester.github_notifications), ["a/b-3", "a/b-4"])
+
+    def test_nothing_is_dropped_unless_a_limit_is_given(self):
+
+        store_writer = Mock()
+        store_writer.get_from_binary.return_value = None
+        digester = GithubNotificationDigester(store_writer)
+
+        digester.new_notifications = dict((ts, {"topic": "a/b-" + str(ts % 700), "subj": "subj", "who": "x",
+                                                "what": "commented", "msg": "hi"}) for ts in range(1, 70001))
+        digester.add_new_notifications_to_those_grouped_by_topic_and_calc_most_recent_for_each_topic()
+
+        self.assertEqual(len(digester.github_notifications), 700)
+        self.assertEqual(len(digester.github_notifications["a/b-1"]["ts"]), 100)
+
     def test_two_related_notifis_can_be_rolled_up_with_a_prior_notification(self):
 
         expected_payload = """<span>You have previously read notifications up to: Apr 01 2016 09:20 PM</span>
@@ -0,0 +1,123 @@
+import re
+
+from utils import Utils
+
+# A matching_incoming_headers() pattern for a sender, like 'From: .* <jira@apache.org>' or
+# 'From: Citi Alerts <alerts@citibank.com>'. The address in it is what gets indexed. Ones without the angle brackets,
+# like 'From: alerts@barclaycard.com', would match longer addresses too, so they are not indexed.
+ADDRESS_PATTERN = re.compile(r'^\n?(From|Return-Path): [^<]*<([\w.-]+@[\w-]+(?:\.[\w-]+)+)>$')
+
+# Addresses as they appear in an email's header lines.
+ADDRESS = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+
+# Back references, which would refer to another pattern's groups once patterns are combined into one regex
+BACK_REFERENCE = re.compile(r'\\\d|\(\?P=')
+
+
+class HeaderRule(object):
+
+    def __init__(self, order, digester, sub_digester, pattern):
+        self.order = order
+        self.digester = digester
+        self.sub_digester = sub_digester
+        self.pattern = pattern
+        try:
+            self.regex = re.compile(pattern)
+        except re.error:
+            self.regex = None
+
+    def combinable(self):
+        """
+        :rtype: True if the pattern can go in a regex with others' - no named groups (that another might reuse), no
+        back references, and no global inline flags (that have to be at the start of a regex)
+        """
+        if self.regex is None:
+            return True  # matched as a plain string only
+        if len(self.regex.groupindex) > 0 or BACK_REFERENCE.search(self.pattern) is not None:
+            return False
+        try:
+            re.compile("x|(?:" + self.pattern + ")")
+        except re.error:
+            return False
+        return True
+
+    def matches(self, headers):
+        # Note, pattern contains things like:
+        # From: .* <jira@apache.org>
+        #       ^ regex!!
+
+        # Note2, headers contains the whole header block as a string
+        # ...
+        # From: "Thomas Neidhart (JIRA)" <jira@apache.org>
+        # To: <you@example.com>
+        # Message-ID: <JIRA.12911300.1446902881000.65833.1447445412298@Atlassian.JIRA>
+        # ...
+        return (self.regex is not None and self.regex.search(headers) is not None) or headers.find(self.pattern) != -1
+
+
+class HeaderMatcher(object):
+    """ Works out which digesters want an email, from their matching_incoming_headers(), looking at the email's
+    header block only. Built once for a list of digesters: patterns are compiled up front, sender addresses in them
+    are indexed in a dict, and the rest are screened with a single combined regex before being tried one by one.
+    Patterns that can't be combined with others (see HeaderRule.combinable) are always tried, with their own regex.
+    """
+
+    def __init__(self, digesters):
+        self.address_rules = {}
+        self.other_rules = []
+        self.unscreened_rules = []
+        order = 0
+        for digester in digesters:
+            subordinates = digester.subordinate_digesters()
+            for sub_digester in (subordinates if len(subordinates) > 0 else [None]):
+                for pattern in (sub_digester or digester).matching_incoming_headers():
+                    rule = HeaderRule(order, digester, sub_digester, pattern)
+                    order += 1
+                    address = ADDRESS_PATTERN.match(pattern)
+                    if address is not None:
+                        self.address_rules.setdefault(address.group(2).lower(), []).append(rule)
+                    elif rule.combinable():
+                        self.other_rules.append(rule)
+                    else:
+                        self.unscreened_rules.append(rule)
+
+        alternatives = []
+        for rule in self.other_rules:
+            if rule.regex is not None:
+                alternatives.append("(?:" + rule.pattern + ")")
+            alternatives.append(re.escape(rule.pattern))
+        self.other_rules_screen = None
+        if len(alternatives) > 0:
+            try:
+                self.other_rules_screen = re.compile("|".join(alternatives))
+            except re.error:
+                self.unscreened_rules.extend(self.other_rules)
+                self.other_rules = []
+
+    def matches(self, rfc822content):
+        """
+        :param rfc822content: the whole email, or just its header block
+        :rtype: list of (digester, sub_digester) that match, in the order the digesters were given. For a digester
+        with subordinate_digesters(), there's one for each of those that matched, in their order (for the next to be
+        tried if one doesn't process the email), otherwise sub_digester is None.
+        """
+        headers = Utils.header_block(rfc822content)
+
+        candidates = []
+        for line in headers.split("\n"):
+            if "From: " in line or "Return-Path: " in line:
+                for address in ADDRESS.findall(line):
+                    candidates.extend(self.address_rules.get(address.lower(), []))
+        if self.other_rules_screen is not None and self.other_rules_screen.search(headers) is not None:
+            candidates.extend(self.other_rules)
+        candidates.extend(self.unscreened_rules)
+
+        matching = []
+        matched = set()
+        for rule in sorted(candidates, key=lambda r: r.order):
+            if (id(rule.digester), id(rule.sub_digester)) in matched:
+                continue
+            if rule.matches(headers):
+                matched.add((id(rule.digester), id(rule.sub_digester)))
+                matching.append((rule.digester, rule.sub_digester))
+        return matching
@@ -2,9 +2,9 @@
 
 
 import arrow
-from bs4 import BeautifulSoup
 
 from digesters.base_digester import BaseDigester
+from digesters.time_sorted_dict import TimeSortedDict
 
 TEMPLATE = """<html>
 <head>
@@ -42,14 +42,16 @@ TEMPLATE = """<html>
 
 
 class HipchatNotificationDigester(BaseDigester):
+
+    extracts_notifications = True
+    needed_html_elements = [("div", {"id": "chats"})]
+
     def __init__(self, store_writer):
         super(HipchatNotificationDigester, self).__init__()
         self.store_writer = store_writer
         self.new_message_count = 0
         self.new_articles = 0
-        self.hc_notifications = self.store_writer.get_from_binary("hipchat-notifications")
-        if self.hc_notifications is None:
-            self.hc_notifications = {}
+        self.hc_notifications = TimeSortedDict.from_store(self.store_writer.get_from_binary("hipchat-notifications"))
 
         self.most_recently_seen = self.store_writer.get_from_binary("most-recently-seen")
         if self.most_recently_seen is None:
@@ -57,15 +59,21 @@ class HipchatNotificationDigester(BaseDigester):
 
         self.new_notifications = {}
 
+        self.prepare_for_next_run()
+
+    def prepare_for_next_run(self):
         self.previously_notified_article_count = len(self.hc_notifications)
         if self.previously_notified_article_count > 0:
-            self.previously_notified_article_most_recent = max(self.hc_notifications)
+            self.previously_notified_article_most_recent = self.hc_notifications.newest()
         else:
             self.previously_notified_article_most_recent = 0
 
     def process_new_notification(self, rfc822content, msg, html_message, text_message):
+        return self.apply_notification(self.extract_notification(rfc822content, msg, html_message, text_message))
+
+    @staticmethod
+    def extract_notification(rfc822content, msg, html_message, text_message):
 
-        self.new_message_count += 1
         subject = msg['Subject']
         if "sent you a 1-1 message" in subject:
             room = "Direct Message"
@@ -74,16 +82,25 @@ class HipchatNotificationDigester(BaseDigester):
         when = arrow.get(msg['Date'].split(',', 1)[1].strip(), 'D MMM YYYY HH:mm:ss ZZ').timestamp
 
         if html_message:
-            soup = BeautifulSoup(html_message, 'html.parser')
+            soup = HipchatNotificationDigester.make_soup(html_message)
             div = soup.find("div", {"id": "chats"}).find("div")
 
-            self.hc_notifications[when] = {
+            return when, {
                 "room": room,
                 "div": str(div)
             }
-            return True
 
-        return False
+        return None
+
+    def apply_notification(self, extracted):
+
+        self.new_message_count += 1
+        if extracted is None:
+            return False
+
+        when, notification = extracted
+        self.hc_notifications[when] = notification
+        return True
 
     def rewrite_digest_emails(self, digest_folder_proxy, has_previous_message, previously_seen, sender_to_implicate):
 
@@ -93,7 +110,7 @@ class HipchatNotificationDigester(BaseDigester):
 
         # Deleted email (by the user) means they don't want to see THOSE notifications listed in a Digest again.
         if has_previous_message == False:
-            self.hc_notifications = {}
+            self.hc_notifications = TimeSortedDict()
 
         if has_previous_message == False:
             if self.previously_notified_article_count > 0:
@@ -101,16 +118,9 @@ class HipchatNotificationDigester(BaseDigester):
 
         template_end, template_start = self.get_template_start_and_end(TEMPLATE)
 
-        past_bookmark = 0
-        unseen = 0
-        for when in sorted(iter(self.hc_notifications.keys()), reverse=True):
-            mostRecentSeen = self.most_recently_seen
-            if when < mostRecentSeen:
-                past_bookmark += 1
-            else:
-                unseen += 1
-            if past_bookmark > 30:  # only show thirty after the bookmark
-                self.hc_notifications.pop(when, None)
+        unseen = self.hc_notifications.count_since(self.most_recently_seen)
+        # only show thirty after the bookmark
+        self.hc_notifications.keep_newest(30, before=self.most_recently_seen)
 
         email_html = self.make_html_payload(template_end, template_start, self.hc_notifications).replace("<br/>","")
 
@@ -143,11 +153,11 @@ class HipchatNotificationDigester(BaseDigester):
         email_html = template_start
 
         ix = 0
-        for anum in sorted(iter(hc_notifications.keys()), reverse=True):
+        for anum, notification in hc_notifications.newest_first():
             if anum == self.most_recently_seen and ix > 0:
                 email_html += '<div style="border-bottom: 1.5pt solid red; border-top: 1.5pt solid red;"><center>^ New Questions Since You Last Checked ^</center></div>\n'
-            email_html += '<div class="ecxhc-chat-from" style="margin-left: 150px;text-align:left;width:200px;padding:10px 0 10px 10px;">' + hc_notifications[anum]["room"] + '</div>\n'
-            email_html += "<div>\n" + hc_notifications[anum]["div"] + "</div>\n"
+            email_html += '<div class="ecxhc-chat-from" style="margin-left: 150px;text-align:left;width:200px;padding:10px 0 10px 10px;">' + notification["room"] + '</div>\n'
+            email_html += "<div>\n" + notification["div"] + "</div>\n"
             ix = + 1
         email_html += template_end
 
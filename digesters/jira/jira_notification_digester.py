@@ -6,14 +6,20 @@ import re
 from email.header import decode_header
 import arrow
 import simplejson
-from bs4 import BeautifulSoup
-from jinja2 import Template
 from collections import Counter
 
 from digesters.base_digester import BaseDigester
+from digesters.time_sorted_dict import TimeSortedDict
 
 
 class JiraNotificationDigester(BaseDigester):
+
+    extracts_notifications = True
+    needed_html_elements = [("td", {"id": "header-text-container"}),
+                            ("table", {"class": "keyvalue-table"}),
+                            ("td", {"class": "page-title-pattern-first-line"}),
+                            ("td", {"class": "text-paragraph-pattern-container"})]
+
     def __init__(self, store_writer, from_email_address, jira_short_name):
         super(JiraNotificationDigester, self).__init__()
         self.jira_short_name = jira_short_name
@@ -21,9 +27,7 @@ class JiraNotificationDigester(BaseDigester):
         self.store_writer = store_writer
         self.new_message_count = 0
         self.new_articles = 0
-        self.jira_notifications = self.store_writer.get_from_binary("jira-notifications")
-        if self.jira_notifications is None:
-            self.jira_notifications = {}
+        self.jira_notifications = TimeSortedDict.from_store(self.store_writer.get_from_binary("jira-notifications"))
 
         self.most_recently_seen = self.store_writer.get_from_binary("most-recently-seen")
         if self.most_recently_seen is None:
@@ -31,15 +35,21 @@ class JiraNotificationDigester(BaseDigester):
 
         self.new_notifications = {}
 
+        self.prepare_for_next_run()
+
+    def prepare_for_next_run(self):
         self.previously_notified_article_count = len(self.jira_notifications)
         if self.previously_notified_article_count > 0:
-            self.previously_notified_article_most_recent = max(self.jira_notifications)
+            self.previously_notified_article_most_recent = self.jira_notifications.newest()
         else:
             self.previously_notified_article_most_recent = 0
 
     def process_new_notification(self, rfc822content, msg, html_message, text_message):
+        return self.apply_notification(self.extract_notification(rfc822content, msg, html_message, text_message))
+
+    @staticmethod
+    def extract_notification(rfc822content, msg, html_message, text_message):
 
-        self.new_message_count += 1
         when = arrow.get(msg['Date'].split(',', 1)[1].strip(), 'D MMM YYYY HH:mm:ss ZZ').timestamp
 
         from_ = msg['From']
@@ -48,7 +58,7 @@ class JiraNotificationDigester(BaseDigester):
         who = re.search('(.*) \(JIRA\)', from_).group(1).replace('"','')
 
         if html_message:
-            soup = BeautifulSoup(html_message, 'html.parser')
+            soup = JiraNotificationDigester.make_soup(html_message)
 
             event_text = soup.find("td", {"id": "header-text-container"}).text.strip()
 
@@ -89,7 +99,7 @@ class JiraNotificationDigester(BaseDigester):
                     comment += "..."
 
             ##
-            self.jira_notifications[when] = {
+            return when, {
                  "project_name": project_name,
                  "who": who,
                  "issue_id": issue_id,
@@ -98,14 +108,23 @@ class JiraNotificationDigester(BaseDigester):
                  "kvtable" : key_vals,
                  "comment" : comment
             }
-
-            # print simplejson.dumps(self.jira_notifications[when], sort_keys=True) + "\n\n"
-
-            return True
         else:
             print("Was expecting HTML for \"" + msg['Subject'] + "\" - not processing")
 
-        return False
+        return None
+
+    def apply_notification(self, extracted):
+
+        self.new_message_count += 1
+        if extracted is None:
+            return False
+
+        when, notification = extracted
+        self.jira_notifications[when] = notification
+
+        # print simplejson.dumps(self.jira_notifications[when], sort_keys=True) + "\n\n"
+
+        return True
 
     def rewrite_digest_emails(self, digest_folder_proxy, has_previous_message, previously_seen, sender_to_implicate):
 
@@ -117,55 +136,9 @@ class JiraNotificationDigester(BaseDigester):
             if self.previously_notified_article_count > 0:
                 self.most_recently_seen = self.previously_notified_article_most_recent
 
-        templ = """<html><body>{% if not_first_email %}<span>You have previously read notifications up to: {{most_recent_seen_str}}</span>{% endif %}
-        <table>
-          <tr style="background-color: #acf;">
-            <th>Notifications</th>
-          </tr>
-        {% for when, notif in notifs_to_print|dictsort(false, by='key')|reverse %}{% if notif['line_here'] %}          <tr><td colspan="2" style="border-bottom: 1pt solid red; border-top: 1pt solid red;"><center>^ New Notifications Since You Last Checked ^</center></td></tr>{% endif %}          <tr style="{{loop.cycle('','background-color: #def;')}}">
-            <td>
-                <table>
-                    <tr>
-                        <td>What:</td><td>{{notif['event']}}</td>
-                    </tr>
-                    <tr>
-                        <td>Project:</td><td>{{notif['project_name']}}</td>
-                    </tr>
-                    <tr>
-                        <td>Issue:</td><td><a href="{{notif['issue_url']}}">{{notif['issue_id']}}</a></td>
-                    </tr>
-                    {% if notif['kvtable']|length > 0 %}
-                    <tr>
-                        <td>Fields:</td>
-                        <td>
-                            <table>
-                            {% for kv in notif['kvtable'] %}
-                            <tr><td>{{kv['k']}}</td><td>{{kv['v']}}</td></tr>
-                            {% endfor %}
-                            </table>
-                        </td>
-                    </tr>
-                    {% endif %}
-                    {% if notif['comment'] %}
-                    <tr>
-                        <td>Comment:</td>
-                        <td>
-                            {{notif['comment'].replace('\\n','<br/>')}}
-                        </td>
-                    </tr>
-                    {% endif %}
-                </table>
-            </td>
-          </tr>{% endfor %}
-        </table></body></html>""".replace("\n        ", "\n")
-
-        template = Template(templ)
-
-        cnt = 0
-        for when in sorted(iter(self.jira_notifications.keys()), reverse=True):
-            cnt += 1
-            if 90 < cnt:  # only show thirty
-                self.jira_notifications.pop(when, None)
+        template = self.get_template("jira/template.html")
+
+        self.jira_notifications.keep_newest(90)  # only show ninety
 
         num_messages_since_last_seen = self.add_line_for_notifications_seen_already()
 
@@ -187,12 +160,10 @@ class JiraNotificationDigester(BaseDigester):
 
     def add_line_for_notifications_seen_already(self):
         num_messages_since_last_seen = 0
-        line_here_done = False
-        for ts0, notif in sorted(iter(self.jira_notifications.items()), reverse=False):
-            if self.most_recently_seen != 0 and ts0 >= self.most_recently_seen and line_here_done is False:
-                notif['line_here'] = True
-                line_here_done = True
-                num_messages_since_last_seen += 1
+        first_unseen = self.jira_notifications.first_since(self.most_recently_seen)
+        if self.most_recently_seen != 0 and first_unseen is not None:
+            self.jira_notifications[first_unseen]['line_here'] = True
+            num_messages_since_last_seen += 1
         if self.most_recently_seen == 0:
             num_messages_since_last_seen = len(self.jira_notifications)
 
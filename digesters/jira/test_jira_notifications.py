@@ -1,16 +1,18 @@
+import email
 import sys
 from unittest import TestCase
 import unittest
 import os
 
 from importlib import reload
-from mock import Mock, call
+from mock import Mock, call, patch
 from mockextras import stub
 
 sys.path = [os.path.abspath(os.path.join('..', os.pardir))] + sys.path
 
 from digesters.jira.jira_notification_digester import JiraNotificationDigester
 from digesters.digestion_processor import DigestionProcessor
+from utils import EmailBodies, Utils
 
 
 MAIL_HDR = """From: "Atlassian JIRA" <ph@example.com>
@@ -213,6 +215,20 @@ class TestJiraNotifications(TestCase):
         self.assertEqual(str(to_delete_from_notification_folder), "[1234, 1235, 1236]")
         self.assertEqual(len(final_notifications_store.notifications), 3)
 
+    def test_either_html_parser_pulls_out_the_same(self):
+
+        extracted = {}
+        for html_parser in ["html.parser", "lxml"]:
+            with patch.object(Utils, "html_parser", html_parser):
+                extracted[html_parser] = []
+                for notification in [NEW_ISSUE, CHANGED_ISSUE, COMMENTED_ISSUE]:
+                    msg = email.message_from_string(notification)
+                    html_message, text_message = EmailBodies(msg).messages(True, True)
+                    extracted[html_parser].append(
+                        JiraNotificationDigester.extract_notification(notification, msg, html_message, text_message))
+
+        self.assertEqual(extracted["html.parser"], extracted["lxml"])
+
 
 NEW_ISSUE = """Date: Thu, 14 Apr 2016 16:45:00 +0000 (UTC)
 From: "Paul Hammant (JIRA)" <jira@atlassian.com>
@@ -4,21 +4,25 @@
 import re
 
 import arrow
-from bs4 import BeautifulSoup
-from jinja2 import Template
 
 from digesters.base_digester import BaseDigester
+from digesters.time_sorted_dict import TimeSortedDict
+
+# What extract_notification() returns for reminders about invitations, which are processed but not digested
+REMINDER = "reminder"
 
 
 class LinkedinInvitationDigester(BaseDigester):
+
+    extracts_notifications = True
+    needed_html_elements = [("img", {})]
+
     def __init__(self, store_writer):
         super(LinkedinInvitationDigester, self).__init__()
         self.store_writer = store_writer
         self.new_message_count = 0
         self.new_articles = 0
-        self.linkedin_invitations = self.store_writer.get_from_binary("linkedin-invitations")
-        if self.linkedin_invitations is None:
-            self.linkedin_invitations = {}
+        self.linkedin_invitations = TimeSortedDict.from_store(self.store_writer.get_from_binary("linkedin-invitations"))
 
         self.most_recently_seen = self.store_writer.get_from_binary("most-recently-seen")
         if self.most_recently_seen is None:
@@ -26,13 +30,20 @@ class LinkedinInvitationDigester(BaseDigester):
 
         self.new_notifications = {}
 
+        self.prepare_for_next_run()
+
+    def prepare_for_next_run(self):
         self.previously_notified_article_count = len(self.linkedin_invitations)
         if self.previously_notified_article_count > 0:
-            self.previously_notified_article_most_recent = max(self.linkedin_invitations)
+            self.previously_notified_article_most_recent = self.linkedin_invitations.newest()
         else:
             self.previously_notified_article_most_recent = 0
 
     def process_new_notification(self, rfc822content, msg, html_message, text_message):
+        return self.apply_notification(self.extract_notification(rfc822content, msg, html_message, text_message))
+
+    @staticmethod
+    def extract_notification(rfc822content, msg, html_message, text_message):
 
         text_message = text_message.replace("\r\n", "\n")
 
@@ -40,9 +51,8 @@ class LinkedinInvitationDigester(BaseDigester):
             msg["Subject"].endswith("connections, experience, and more") or \
                 "has accepted your invitation" in text_message:
             # No need to be reminded, bugged.
-            return True
+            return REMINDER
 
-        self.new_message_count += 1
         when = arrow.get(msg['Date'].split(',', 1)[1].strip(), 'D MMM YYYY HH:mm:ss ZZ').timestamp
 
         fromm = re.search('(.*) <invitations@linkedin.com>', msg["From"])
@@ -55,7 +65,7 @@ class LinkedinInvitationDigester(BaseDigester):
 
             src = "x"
             if html_message:
-                soup = BeautifulSoup(html_message, 'html.parser')
+                soup = LinkedinInvitationDigester.make_soup(html_message)
                 headshot_img = soup.find("img", {"alt": who})
                 if headshot_img:
                     src_ = headshot_img['src']
@@ -63,7 +73,7 @@ class LinkedinInvitationDigester(BaseDigester):
                 else:
                     src = "https://upload.wikimedia.org/wikipedia/commons/8/85/Border_collie.jpg"
 
-                self.linkedin_invitations[when] = {
+                return when, {
                      "img_src": src,
                      "who": who,
                      "spiel": spiel,
@@ -71,9 +81,20 @@ class LinkedinInvitationDigester(BaseDigester):
                      "profile_url": profile_url
                 }
 
-                return True
+        return None
 
-        return False
+    def apply_notification(self, extracted):
+
+        if extracted == REMINDER:
+            return True
+
+        self.new_message_count += 1
+        if extracted is None:
+            return False
+
+        when, invitation = extracted
+        self.linkedin_invitations[when] = invitation
+        return True
 
     def rewrite_digest_emails(self, digest_folder_proxy, has_previous_message, previously_seen, sender_to_implicate):
 
@@ -85,29 +106,9 @@ class LinkedinInvitationDigester(BaseDigester):
             if self.previously_notified_article_count > 0:
                 self.most_recently_seen = self.previously_notified_article_most_recent
 
-        templ = """<html><body>{% if not_first_email %}<span>You have previously read invitations up to: {{most_recent_seen_str}}</span>{% endif %}
-        <table>
-          <tr style="background-color: #acf;">
-            <th colspan="2">Invitations</th>
-          </tr>
-{% for when, inv in invsToPrint|dictsort(false, by='key')|reverse %}{% if inv['line_here'] %}          <tr><td colspan="2" style="border-bottom: 1pt solid red; border-top: 1pt solid red;"><center>^ New Invitations Since You Last Checked ^</center></td></tr>{% endif %}          <tr style="{{loop.cycle('','background-color: #def;')}}">
-            <td><img style="max-width:100px;height:auto" src="{{ inv['img_src']}}"/></td>
-            <td>
-              <strong>{{inv['who']}}</strong><br>
-              {{inv['spiel'].replace('\n','<br/>\n')}}<br>
-              <a href="{{inv['accept_url']}}">Accept Invitation</a>
-              <a href="{{inv['profile_url']}}">View Profile</a>
-            </td>
-          </tr>{% endfor %}
-        </table></body></html>""".replace("\n        ","\n")
-
-        template = Template(templ)
-
-        cnt = 0
-        for when in sorted(iter(self.linkedin_invitations.keys()), reverse=True):
-            cnt = cnt + 1
-            if cnt > 30:  # only show thirty
-                self.linkedin_invitations.pop(when, None)
+        template = self.get_template("linkedin/template.html")
+
+        self.linkedin_invitations.keep_newest(30)  # only show thirty
 
         num_messages_since_last_seen = self.add_line_for_invitations_seen_already()
 
@@ -127,12 +128,10 @@ class LinkedinInvitationDigester(BaseDigester):
 
     def add_line_for_invitations_seen_already(self):
         num_messages_since_last_seen = 0
-        line_here_done = False
-        for ts0, inv in sorted(iter(self.linkedin_invitations.items()), reverse=False):
-            if self.most_recently_seen != 0 and ts0 >= self.most_recently_seen and line_here_done == False:
-                inv['line_here'] = True
-                line_here_done = True
-                num_messages_since_last_seen = num_messages_since_last_seen +1
+        first_unseen = self.linkedin_invitations.first_since(self.most_recently_seen)
+        if self.most_recently_seen != 0 and first_unseen is not None:
+            self.linkedin_invitations[first_unseen]['line_here'] = True
+            num_messages_since_last_seen = num_messages_since_last_seen +1
         if self.most_recently_seen == 0:
             num_messages_since_last_seen = len(self.linkedin_invitations)
 
@@ -160,11 +159,11 @@ class LinkedinInvitationDigester(BaseDigester):
         email_html = template_start
 
         ix = 0
-        for anum in sorted(iter(hc_notifications.keys()), reverse=True):
+        for anum, notification in hc_notifications.newest_first():
             if anum == self.most_recently_seen and ix > 0:
                 email_html += '<div style="border-bottom: 1.5pt solid red; border-top: 1.5pt solid red;"><center>^ New Questions Since You Last Checked ^</center></div>\n'
-            email_html += '<div class="ecxhc-chat-from" style="margin-left: 150px;text-align:left;width:200px;padding:10px 0 10px 10px;">' + hc_notifications[anum]["room"] + '</div>\n'
-            email_html += "<div>\n" + hc_notifications[anum]["div"] + "</div>\n"
+            email_html += '<div class="ecxhc-chat-from" style="margin-left: 150px;text-align:left;width:200px;padding:10px 0 10px 10px;">' + notification["room"] + '</div>\n'
+            email_html += "<div>\n" + notification["div"] + "</div>\n"
             ix = + 1
         email_html += template_end
 
@@ -1,8 +1,9 @@
 
 
+import os
 import re
-from bs4 import BeautifulSoup
 from digesters.base_digester import BaseDigester
+from digesters.time_sorted_dict import TimeSortedDict
 
 
 class StackExchangeNotificationDigester(BaseDigester):
@@ -12,6 +13,12 @@ class StackExchangeNotificationDigester(BaseDigester):
     # (it won't recognize the subject line of the incoming emails)
     # Therefore have AT LEAST TWO - like so http://imgur.com/YswesOB
 
+    extracts_notifications = True
+    needed_html_elements = [("table", {"width": "90%"})]
+
+    # template.html, read when first needed. Not a jinja2 one - it's split at <InsertHere/>
+    template = None
+
     def __init__(self, store_writer, filter_name):
         super(StackExchangeNotificationDigester, self).__init__()
         self.store_writer = store_writer
@@ -26,23 +33,40 @@ class StackExchangeNotificationDigester(BaseDigester):
         self.article_dict = store_writer.get_from_binary("articles")
 
         if self.article_dict is None:
-            self.article_dict = {"articles": {}, "most_recent_seen": 0}
+            self.article_dict = {"articles": TimeSortedDict(), "most_recent_seen": 0}
+        elif not isinstance(self.article_dict["articles"], TimeSortedDict):
+            # Stored before, with question numbers as strings (which sort "9" after "10")
+            self.article_dict["articles"] = TimeSortedDict((int(anum), text)
+                                                           for anum, text in self.article_dict["articles"].items())
+            self.article_dict["most_recent_seen"] = int(self.article_dict["most_recent_seen"])
+
+        self.prepare_for_next_run()
 
+    def prepare_for_next_run(self):
         self.previously_notified_article_count = len(self.article_dict["articles"])
         if self.previously_notified_article_count > 0:
-            self.previously_notified_article_most_recent = max(self.article_dict["articles"])
+            self.previously_notified_article_most_recent = self.article_dict["articles"].newest()
         else:
             self.previously_notified_article_most_recent = 0
 
     def process_new_notification(self, rfc822content, msg, html_message, text_message):
+        return self.apply_notification(self.extract_notification(rfc822content, msg, html_message, text_message))
+
+    @staticmethod
+    def extract_notification(rfc822content, msg, html_message, text_message):
+        return StackExchangeNotificationDigester.extract_articles_from_html(html_message)
+
+    def apply_notification(self, extracted):
 
         self.new_message_count += 1
-        self.extract_articles_from_html(html_message)
+        for article_num, text in extracted:
+            self.article_dict["articles"][int(article_num)] = text
         return True
 
-    def extract_articles_from_html(self, html_email):
+    @staticmethod
+    def extract_articles_from_html(html_email):
 
-        soup = BeautifulSoup(html_email, 'html.parser')
+        soup = StackExchangeNotificationDigester.make_soup(html_email)
 
         # the first table isn't the one we are interested in
         second_table = soup.select('table[width=90%]')[1]
@@ -50,6 +74,8 @@ class StackExchangeNotificationDigester(BaseDigester):
         # get rows that are actually article links
         posting_trs = second_table.select('tbody')[0].find_all('tr', recursive=False)
 
+        articles = []
+
         # Last in sequence of <tr> is not an link to a article, it's an unsubscribe message
         for x in range(0, len(posting_trs) - 1):
             href_ = posting_trs[x].select('p[class=item-link]')[0].find("a")['href'][7:]
@@ -57,7 +83,9 @@ class StackExchangeNotificationDigester(BaseDigester):
 
             text = posting_trs[x].encode_contents()
 
-            self.article_dict["articles"][article_num] = text
+            articles.append((article_num, text))
+
+        return articles
 
     def rewrite_digest_emails(self, digest_folder_proxy, has_previous_message, previously_seen, sender_to_implicate):
 
@@ -69,21 +97,15 @@ class StackExchangeNotificationDigester(BaseDigester):
             if self.previously_notified_article_count > 0:
                 self.article_dict["most_recent_seen"] = self.previously_notified_article_most_recent
 
-        with open("digesters/stackexchange/template.html", "r") as templateFile:
-            template = templateFile.read()
-        template_end, template_start = self.get_template_start_and_end(template)
-
-        past_bookmark = 0
-        unseen = 0
-        for anum in sorted(iter(self.article_dict["articles"].keys()), reverse=True):
-            anum = int(anum)
-            most_recent_seen = self.article_dict["most_recent_seen"]
-            if anum < most_recent_seen:
-                past_bookmark += 1
-            else:
-                unseen += 1
-            if past_bookmark > 30:  # only show thirty after the bookmark
-                self.article_dict["articles"].pop(anum, None)
+        if StackExchangeNotificationDigester.template is None:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "template.html"), "r") as templateFile:
+                StackExchangeNotificationDigester.template = templateFile.read()
+        template_end, template_start = self.get_template_start_and_end(StackExchangeNotificationDigester.template)
+
+        most_recent_seen = self.article_dict["most_recent_seen"]
+        unseen = self.article_dict["articles"].count_since(most_recent_seen)
+        # only show thirty after the bookmark
+        self.article_dict["articles"].keep_newest(30, before=most_recent_seen)
 
         email_html = self.make_html_payload(template_end, template_start, self.article_dict)
 
@@ -115,10 +137,9 @@ class StackExchangeNotificationDigester(BaseDigester):
         email_html = template_start
 
         ix = 0
-        for anum in sorted(iter(article_dict["articles"].keys()), reverse=True):
+        for anum, anum_ in article_dict["articles"].newest_first():
             if anum == article_dict["most_recent_seen"] and ix > 0:
                 email_html += '<tr><td colspan="2" style="border-bottom: 1.5pt solid red; border-top: 1.5pt solid red;"><center>^ New Questions Since You Last Checked ^</center></td></tr>\n'
-            anum_ = article_dict["articles"][anum]
             email_html += "<tr>\n" + anum_.decode("utf-8") + "</tr>\n"
             ix = + 1
         email_html += template_end
@@ -0,0 +1,43 @@
+from unittest import TestCase
+import unittest
+
+from mock import Mock
+
+from digesters.digester_registry import DigesterRegistry
+
+
+class TestDigesterRegistry(TestCase):
+
+    def test_digesters_added_by_name_are_only_made_when_first_needed(self):
+
+        store_writer = Mock()
+        store_writer.get_from_binary.return_value = None
+
+        registry = DigesterRegistry()
+        registry.add("digesters.reddit.reddit_notification_digester.RedditNotificationDigester", store_writer, "paul_h")
+
+        self.assertEqual(store_writer.mock_calls, [])
+
+        digesters = registry.digesters()
+
+        self.assertEqual(type(digesters[0]).__name__, "RedditNotificationDigester")
+        self.assertEqual(digesters[0].userId, "paul_h")
+        self.assertIs(registry.digesters()[0], digesters[0])
+        self.assertEqual(store_writer.get_from_binary.call_count, 2)
+
+    def test_added_and_appended_digesters_keep_their_order(self):
+
+        first = Mock()
+        second = Mock()
+        make_second = Mock(return_value=second)
+
+        registry = DigesterRegistry([first])
+        registry.add(make_second, "some arg", known_as="Second")
+
+        make_second.assert_not_called()
+        self.assertEqual(registry.digesters(), [first, second])
+        make_second.assert_called_once_with("some arg", known_as="Second")
+
+
+if __name__ == '__main__':
+    unittest.main()
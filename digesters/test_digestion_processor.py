@@ -0,0 +1,734 @@
+from concurrent.futures import ProcessPoolExecutor
+from unittest import TestCase
+import os
+import unittest
+
+from imapclient import IMAPClient
+from mock import Mock, call
+from mockextras import stub
+
+from digesters.base_digester import BaseDigester
+from digesters.digester_registry import DigesterRegistry
+from digesters.digestion_processor import DigestHashes, DigestionProcessor, DigestServer, DigestUids, UidCheckpoint
+
+NOTIFICATION = """From: Someone <someone@example.com>
+Subject: Something happened
+Date: Sat, 2 Apr 2016 06:36:07 -0700
+
+Something happened, honest.
+"""
+
+
+NEWSLETTER = """From: Newsletter <news@example.com>
+Subject: Lots of stuff you did not ask for
+Date: Sat, 2 Apr 2016 06:36:07 -0700
+
+Megabytes of it.
+"""
+
+
+NESTED_MULTIPART = """From: Someone <someone@example.com>
+Subject: Something happened, with an attachment
+Date: Sat, 2 Apr 2016 06:36:07 -0700
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="outer"
+
+--outer
+Content-Type: multipart/alternative; boundary="inner"
+
+--inner
+Content-Type: text/plain; charset="utf-8"
+Content-Transfer-Encoding: quoted-printable
+
+Something happened, honest =E2=80=93 really.
+--inner
+Content-Type: text/html; charset="utf-8"
+
+<p>Something happened</p>
+--inner--
+--outer
+Content-Type: application/octet-stream
+
+AAAA
+--outer--
+"""
+
+
+def fetch_response(uids, emails=None):
+    emails = emails or {}
+    return dict((uid, {b'RFC822': emails.get(uid, NOTIFICATION).encode('ISO-8859-1'), b'INTERNALDATE': None})
+                for uid in uids)
+
+
+def fetch_header_response(uids, emails):
+    return dict((uid, {b'BODY[HEADER]': emails[uid][:emails[uid].index("\n\n") + 2].encode('ISO-8859-1')})
+                for uid in uids)
+
+
+class SomeoneDigester(BaseDigester):
+
+    def __init__(self):
+        super(SomeoneDigester, self).__init__()
+        self.processed = []
+        self.bodies = []
+
+    def process_new_notification(self, rfc822content, msg, html_message, text_message):
+        self.processed.append(msg['Subject'])
+        self.bodies.append((html_message, text_message))
+        return True
+
+    def rewrite_digest_emails(self, digest_folder_proxy, has_previous_message, previously_seen, sender_to_implicate):
+        pass
+
+    def matching_incoming_headers(self):
+        return ["From: .* <someone@example.com>"]
+
+    def matching_digest_subject(self):
+        return "Someone Digest"
+
+    def matching_digest_sender(self):
+        return "Someone"
+
+    def print_summary(self):
+        pass
+
+
+class ExtractingDigester(SomeoneDigester):
+
+    extracts_notifications = True
+
+    def process_new_notification(self, rfc822content, msg, html_message, text_message):
+        return self.apply_notification(self.extract_notification(rfc822content, msg, html_message, text_message))
+
+    @staticmethod
+    def extract_notification(rfc822content, msg, html_message, text_message):
+        return msg['Subject'], os.getpid()
+
+    def apply_notification(self, extracted):
+        subject, pid = extracted
+        self.processed.append(subject)
+        self.bodies.append(pid)
+        return True
+
+
+class RewritingDigester(SomeoneDigester):
+
+    def __init__(self, digest):
+        super(RewritingDigester, self).__init__()
+        self.digest = digest
+
+    def rewrite_digest_emails(self, digest_folder_proxy, has_previous_message, previously_seen, sender_to_implicate):
+        if has_previous_message:
+            digest_folder_proxy.delete_previous_message()
+        digest_folder_proxy.append('Subject: Someone Digest\nContent-Type: multipart/alternative; boundary="'
+                                   + self.notification_boundary_rand + '"\n\n' + self.digest)
+
+
+def digest_folder_response(*emails):
+    """ What fetching the digest folder's emails' Subject and From comes back as, for (uid, subject, sender, flags)s
+    """
+    return dict((uid, {b'FLAGS': flags,
+                       b'BODY[HEADER.FIELDS (SUBJECT FROM)]': ('Subject: ' + subject + '\r\nFrom: ' + sender
+                                                               + '\r\n\r\n').encode('utf-8')})
+                for uid, subject, sender, flags in emails)
+
+
+def imapclient_fetch(response):
+    """ A FETCH that, like IMAPClient's, only returns what the server said about the UIDs it was given
+    """
+    return lambda uids, items: dict((uid, data) for uid, data in response.items()
+                                    if not isinstance(uids, str) and uid in uids)
+
+
+def rewrite_digest(digester, digest_hashes):
+    digest_folder = Mock()
+    digest_folder.search.return_value = [99]
+    digest_folder.fetch.return_value = digest_folder_response((99, 'Someone Digest', '"Someone" <ph@example.com>', ()))
+    DigestionProcessor(Mock(), digest_folder, [digester], False, "ph@example.com", False, "INBOX",
+                       digest_hashes=digest_hashes).rewrite_digests()
+    return digest_folder
+
+
+def digest_hashes_after(digester):
+    """ The DigestHashes that the next run would start with, after a run that rewrote digester's digest
+    """
+    store_writer = Mock()
+    store_writer.get_from_binary.return_value = None
+    rewrite_digest(digester, DigestHashes(store_writer))
+
+    next_store_writer = Mock()
+    next_store_writer.get_from_binary.side_effect = stub(
+        (call('digest-hashes'), store_writer.store_as_binary.call_args[0][1])
+    )
+    return DigestHashes(next_store_writer)
+
+
+class TestDigestionProcessor(TestCase):
+
+    def test_notifications_are_fetched_in_batches_in_uid_order(self):
+
+        notification_folder = Mock()
+        notification_folder.search.return_value = [5, 1, 3, 2, 4]
+        notification_folder.fetch.side_effect = lambda uids, items: fetch_response(uids)
+
+        digest_folder = Mock()
+
+        digestion_processor = DigestionProcessor(notification_folder, digest_folder, [], False, "ph@example.com",
+                                                 False, "INBOX", fetch_batch_size=2)
+        digestion_processor.doit()
+
+        self.assertEqual(notification_folder.fetch.mock_calls, [
+            call([1, 2], ["INTERNALDATE", "RFC822"]),
+            call([3, 4], ["INTERNALDATE", "RFC822"]),
+            call([5], ["INTERNALDATE", "RFC822"])
+        ])
+        notification_folder.delete_messages.assert_called_once_with([])
+
+    def test_headers_first_only_downloads_emails_that_a_digester_wants(self):
+
+        emails = {1: NOTIFICATION, 2: NEWSLETTER, 3: NOTIFICATION}
+
+        def fetch(uids, items):
+            if items == ["BODY.PEEK[HEADER]"]:
+                return fetch_header_response(uids, emails)
+            return fetch_response(uids, emails)
+
+        notification_folder = Mock()
+        notification_folder.search.return_value = [1, 2, 3]
+        notification_folder.fetch.side_effect = fetch
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = []
+        digest_folder.fetch.return_value = {}
+
+        digester = SomeoneDigester()
+        digestion_processor = DigestionProcessor(notification_folder, digest_folder, [digester], False,
+                                                 "ph@example.com", False, "INBOX", headers_first=True)
+        digestion_processor.doit()
+
+        self.assertEqual(notification_folder.fetch.mock_calls, [
+            call([1, 2, 3], ["BODY.PEEK[HEADER]"]),
+            call([1, 3], ["INTERNALDATE", "RFC822"])
+        ])
+        self.assertEqual(digester.processed, ["Something happened", "Something happened"])
+        notification_folder.delete_messages.assert_called_once_with([1, 3])
+
+    def test_uid_checkpoint_means_only_newer_emails_are_looked_at(self):
+
+        store_writer = Mock()
+        store_writer.get_from_binary.side_effect = stub(
+            (call('uid-checkpoint'), {"uidvalidity": 7, "last_uid": 3})
+        )
+
+        notification_folder = Mock()
+        notification_folder.search.return_value = [3, 4, 5]  # 'UID 4:*' can include the last one handled
+        notification_folder.fetch.side_effect = lambda uids, items: fetch_response(uids)
+
+        # The digest folder's UIDs are searched for too, and mustn't end up in the checkpoint
+        digest_folder = Mock()
+        digest_folder.search.return_value = [98, 99]
+        digest_folder.fetch.return_value = {98: {b'FLAGS': ()}, 99: {b'FLAGS': ()}}
+
+        digester = SomeoneDigester()
+        digestion_processor = DigestionProcessor(notification_folder, digest_folder, [digester], False,
+                                                 "ph@example.com", False, "INBOX",
+                                                 uid_checkpoint=UidCheckpoint(store_writer, 7))
+        digestion_processor.doit()
+
+        notification_folder.search.assert_called_once_with(['UID', '4:*', 'NOT', 'DELETED'])
+        self.assertEqual(notification_folder.fetch.mock_calls, [call([4, 5], ["INTERNALDATE", "RFC822"])])
+        self.assertEqual(digester.processed, ["Something happened", "Something happened"])
+        self.assertEqual(store_writer.mock_calls, [
+            call.get_from_binary('uid-checkpoint'),
+            call.store_as_binary('uid-checkpoint', {"uidvalidity": 7, "last_uid": 5})
+        ])
+
+    def test_nothing_is_searched_for_or_made_when_uidnext_shows_nothing_new(self):
+
+        store_writer = Mock()
+        store_writer.get_from_binary.side_effect = stub(
+            (call('uid-checkpoint'), {"uidvalidity": 7, "last_uid": 5})
+        )
+
+        make_digester = Mock()
+        digesters = DigesterRegistry()
+        digesters.add(make_digester)
+
+        notification_folder = Mock()
+        digest_folder = Mock()
+
+        digestion_processor = DigestionProcessor(notification_folder, digest_folder, digesters, False, "ph@example.com",
+                                                 False, "INBOX", uid_checkpoint=UidCheckpoint(store_writer, 7, 6))
+        digestion_processor.doit()
+
+        make_digester.assert_not_called()
+        self.assertEqual(notification_folder.mock_calls, [])
+        self.assertEqual(digest_folder.mock_calls, [])
+
+    def test_a_run_with_nothing_new_does_not_look_in_the_digest_folder_or_make_digesters(self):
+
+        make_digester = Mock()
+        digesters = DigesterRegistry()
+        digesters.add(make_digester)
+
+        notification_folder = Mock()
+        notification_folder.search.return_value = []
+        digest_folder = Mock()
+
+        digestion_processor = DigestionProcessor(notification_folder, digest_folder, digesters, False, "ph@example.com",
+                                                 False, "INBOX")
+
+        self.assertFalse(digestion_processor.doit())
+        make_digester.assert_not_called()
+        self.assertEqual(digest_folder.mock_calls, [])
+
+    def test_only_the_digests_of_digesters_handed_notifications_are_rewritten(self):
+
+        notification_folder = Mock()
+        notification_folder.search.return_value = [1]
+        notification_folder.fetch.side_effect = lambda uids, items: fetch_response(uids)
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = []
+
+        someone = RewritingDigester("<p>Something happened</p>")
+        other = RewritingDigester("<p>Nothing happened</p>")
+        other.matching_incoming_headers = lambda: ["From: .* <other@example.com>"]
+
+        digestion_processor = DigestionProcessor(notification_folder, digest_folder, [other, someone], False,
+                                                 "ph@example.com", False, "INBOX")
+
+        self.assertTrue(digestion_processor.doit())
+        self.assertEqual(digest_folder.append.mock_calls, [
+            call("INBOX", ('Subject: Someone Digest\nContent-Type: multipart/alternative; boundary="'
+                           + someone.notification_boundary_rand + '"\n\n<p>Something happened</p>').encode("utf-8"))
+        ])
+
+    def test_uid_checkpoint_records_notification_uids_not_digest_folder_ones(self):
+
+        store_writer = Mock()
+        store_writer.get_from_binary.return_value = None
+
+        notification_folder = Mock()
+        notification_folder.search.return_value = [4]
+        notification_folder.fetch.side_effect = lambda uids, items: fetch_response(uids)
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = [99]
+        digest_folder.fetch.return_value = {99: {b'FLAGS': ()}}
+
+        digestion_processor = DigestionProcessor(notification_folder, digest_folder, [SomeoneDigester()], False,
+                                                 "ph@example.com", False, "INBOX",
+                                                 uid_checkpoint=UidCheckpoint(store_writer, 7))
+        digestion_processor.doit()
+
+        store_writer.store_as_binary.assert_called_once_with('uid-checkpoint', {"uidvalidity": 7, "last_uid": 4})
+
+    def test_uid_checkpoint_is_ignored_when_uidvalidity_changed(self):
+
+        store_writer = Mock()
+        store_writer.get_from_binary.side_effect = stub(
+            (call('uid-checkpoint'), {"uidvalidity": 7, "last_uid": 3})
+        )
+
+        uid_checkpoint = UidCheckpoint(store_writer, 8)
+
+        self.assertEqual(uid_checkpoint.search_criteria(), 'NOT DELETED')
+        self.assertEqual(uid_checkpoint.new_uids([1, 2]), [1, 2])
+
+    def test_a_processor_kept_for_another_run_does_not_look_at_the_same_emails_twice(self):
+
+        notification_folder = Mock()
+        notification_folder.fetch.side_effect = lambda uids, items: fetch_response(uids)
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = []
+        digest_folder.fetch.return_value = {}
+
+        digester = SomeoneDigester()
+        digestion_processor = DigestionProcessor(notification_folder, digest_folder, [digester], False,
+                                                 "ph@example.com", False, "INBOX")
+
+        notification_folder.search.return_value = [1, 2]
+        self.assertEqual(digestion_processor.digest_notifications(), 2)
+        # Not rewritten (or deleted) yet, so still in the folder next time around
+        notification_folder.search.return_value = [1, 2, 3]
+        self.assertEqual(digestion_processor.digest_notifications(), 1)
+        digestion_processor.rewrite_digests()
+
+        self.assertEqual(len(digester.processed), 3)
+        notification_folder.delete_messages.assert_called_once_with([1, 2, 3])
+
+    def test_a_batch_whose_fetch_failed_is_looked_at_again_next_time(self):
+
+        store_writer = Mock()
+        store_writer.get_from_binary.return_value = None
+
+        notification_folder = Mock()
+        notification_folder.search.return_value = [1, 2, 3]
+        notification_folder.fetch.side_effect = [fetch_response([1, 2]), IMAPClient.AbortError("connection lost")]
+
+        digester = SomeoneDigester()
+        digestion_processor = DigestionProcessor(notification_folder, Mock(), [digester], False, "ph@example.com",
+                                                 False, "INBOX", fetch_batch_size=2,
+                                                 uid_checkpoint=UidCheckpoint(store_writer, 7))
+
+        self.assertRaises(IMAPClient.AbortError, digestion_processor.digest_notifications)
+        self.assertEqual(digestion_processor.uid_checkpoint.last_uid, 2)
+
+        notification_folder.fetch.side_effect = lambda uids, items: fetch_response(uids)
+        self.assertEqual(digestion_processor.digest_notifications(), 1)
+        self.assertEqual(notification_folder.fetch.mock_calls[-1], call([3], ["INTERNALDATE", "RFC822"]))
+        self.assertEqual(len(digester.processed), 3)
+        self.assertEqual(digestion_processor.uid_checkpoint.last_uid, 3)
+
+    def test_a_reconnected_processor_starts_again_when_uidvalidity_changed(self):
+
+        store_writer = Mock()
+        store_writer.get_from_binary.side_effect = stub(
+            (call('uid-checkpoint'), {"uidvalidity": 7, "last_uid": 3}),
+            (call('digest-uids'), {"uidvalidity": 5, "uids": {("Someone Digest", "Someone"): 99}})
+        )
+
+        digestion_processor = DigestionProcessor(Mock(), Mock(), [], False, "ph@example.com", False, "INBOX",
+                                                 uid_checkpoint=UidCheckpoint(store_writer, 7),
+                                                 digest_uids=DigestUids(store_writer, 5))
+        notification_folder = Mock()
+        digest_folder = Mock()
+        digestion_processor.reconnected(notification_folder, {b'UIDVALIDITY': 8, b'UIDNEXT': 2}, digest_folder,
+                                        {b'UIDVALIDITY': 6})
+
+        self.assertIs(digestion_processor.notification_folder, notification_folder)
+        self.assertIs(digestion_processor.digest_folder, digest_folder)
+        self.assertEqual(digestion_processor.uid_checkpoint.search_criteria(), 'NOT DELETED')
+        self.assertIsNone(digestion_processor.digest_uids.uid(("Someone Digest", "Someone")))
+
+    def test_unmatched_emails_are_moved_byte_for_byte(self):
+
+        newsletter = NEWSLETTER.replace("Megabytes", "Caf\u00e9 news").encode('utf-8')
+
+        notification_folder = Mock()
+        notification_folder.search.return_value = [1]
+        notification_folder.fetch.return_value = {1: {b'RFC822': newsletter, b'INTERNALDATE': None}}
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = []
+        digest_folder.fetch.return_value = {}
+
+        digestion_processor = DigestionProcessor(notification_folder, digest_folder, [SomeoneDigester()], False,
+                                                 "ph@example.com", True, "INBOX")
+        digestion_processor.doit()
+
+        digest_folder.append.assert_called_once_with("INBOX", newsletter.replace(b"\nSubject:", b"\nSubject: [I:D]"))
+        notification_folder.delete_messages.assert_called_once_with([1])
+
+    def test_workers_extract_notifications_that_are_applied_in_uid_order(self):
+
+        emails = dict((uid, NOTIFICATION.replace("Something happened", "Thing " + str(uid))) for uid in range(1, 9))
+
+        notification_folder = Mock()
+        notification_folder.search.return_value = list(range(8, 0, -1))
+        notification_folder.fetch.side_effect = lambda uids, items: fetch_response(uids, emails)
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = []
+        digest_folder.fetch.return_value = {}
+
+        digester = ExtractingDigester()
+        worker_pool = ProcessPoolExecutor(2)
+        digestion_processor = DigestionProcessor(notification_folder, digest_folder, [digester], False,
+                                                 "ph@example.com", False, "INBOX", worker_pool=worker_pool)
+        digestion_processor.doit()
+        digestion_processor.shut_down_workers()
+
+        self.assertEqual(digester.processed, ["Thing " + str(uid) for uid in range(1, 9)])
+        self.assertNotIn(os.getpid(), digester.bodies)
+        notification_folder.delete_messages.assert_called_once_with(list(range(1, 9)))
+        self.assertRaises(RuntimeError, worker_pool.submit, os.getpid)
+
+    def test_the_next_matching_subordinate_digester_is_tried_if_one_does_not_process_the_email(self):
+
+        declining = SomeoneDigester()
+        declining.process_new_notification = Mock(return_value=False)
+        accepting = SomeoneDigester()
+        owner = SomeoneDigester()
+        owner.subordinate_digesters = lambda: [declining, accepting]
+
+        digestion_processor = DigestionProcessor(Mock(), Mock(), [owner], False, "ph@example.com", False, "INBOX")
+        to_delete = []
+        digestion_processor.process_incoming_notification(1234, digestion_processor.digesters, NOTIFICATION,
+                                                          to_delete, [], False)
+
+        self.assertEqual(declining.process_new_notification.call_count, 1)
+        self.assertEqual(accepting.processed, ["Something happened"])
+        self.assertEqual(owner.processed, [])
+        self.assertEqual(to_delete, [1234])
+
+    def test_html_and_text_are_found_in_nested_multiparts(self):
+
+        digester = SomeoneDigester()
+        digestion_processor = DigestionProcessor(None, None, [digester], False, "ph@example.com", False, "INBOX")
+        digestion_processor.process_incoming_notification(1234, [digester], NESTED_MULTIPART, [], [], False)
+
+        self.assertEqual(digester.bodies, [(b"<p>Something happened</p>", "Something happened, honest \u2013 really.")])
+
+    def test_html_is_not_decoded_for_digesters_that_do_not_need_it(self):
+
+        digester = SomeoneDigester()
+        digester.needs_html_message = lambda: False
+        digestion_processor = DigestionProcessor(None, None, [digester], False, "ph@example.com", False, "INBOX")
+        digestion_processor.process_incoming_notification(1234, [digester], NESTED_MULTIPART, [], [], False)
+
+        self.assertEqual(digester.bodies, [(None, "Something happened, honest \u2013 really.")])
+
+    def test_a_digest_that_comes_out_the_same_is_not_replaced(self):
+
+        digest_hashes = digest_hashes_after(RewritingDigester("<p>Two things happened</p>"))
+
+        digest_folder = rewrite_digest(RewritingDigester("<p>Two things happened</p>"), digest_hashes)
+
+        self.assertEqual(digest_folder.delete_messages.mock_calls, [])
+        self.assertEqual(digest_folder.append.mock_calls, [])
+
+    def test_a_digest_that_changed_replaces_the_previous_one(self):
+
+        digest_hashes = digest_hashes_after(RewritingDigester("<p>Two things happened</p>"))
+
+        digester = RewritingDigester("<p>Three things happened</p>")
+        digest_folder = rewrite_digest(digester, digest_hashes)
+
+        self.assertEqual(digest_folder.mock_calls[2:], [
+            call.append("INBOX", ('Subject: Someone Digest\nContent-Type: multipart/alternative; boundary="'
+                                  + digester.notification_boundary_rand
+                                  + '"\n\n<p>Three things happened</p>').encode("utf-8")),
+            call.delete_messages([99])
+        ])
+
+    def test_a_digest_whose_append_failed_is_not_taken_to_have_replaced_the_previous_one(self):
+
+        digest_hashes = digest_hashes_after(RewritingDigester("<p>Two things happened</p>"))
+
+        digest_folder = Mock()
+        digest_folder.append.side_effect = IMAPClient.AbortError("connection lost")
+        digest_server = DigestServer(digest_folder, 99, "INBOX", digest_hashes,
+                                     RewritingDigester("<p>Three things happened</p>"))
+        digest_server.delete_previous_message()
+
+        self.assertRaises(IMAPClient.AbortError, digest_server.append, "<p>Three things happened</p>")
+        digest_folder.delete_messages.assert_not_called()
+
+        # So the previous one, still there, is still known to say two things
+        digest_folder = rewrite_digest(RewritingDigester("<p>Two things happened</p>"), digest_hashes)
+        self.assertEqual(digest_folder.append.mock_calls, [])
+
+    def test_digesters_with_the_same_digest_subject_have_a_digest_hash_each(self):
+
+        store_writer = Mock()
+        store_writer.get_from_binary.return_value = None
+        digest_hashes = DigestHashes(store_writer)
+
+        someone = RewritingDigester("<p>Something happened</p>")
+        other = RewritingDigester("<p>Nothing happened</p>")
+        other.matching_digest_sender = lambda: "Other"  # a 'Someone Digest' too
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = [98, 99]
+        digest_folder.fetch.return_value = digest_folder_response(
+            (98, 'Someone Digest', '"Someone" <ph@example.com>', ()),
+            (99, 'Someone Digest', '"Other" <ph@example.com>', ()))
+
+        for run in range(2):
+            DigestionProcessor(Mock(), digest_folder, [someone, other], False, "ph@example.com", False, "INBOX",
+                               digest_hashes=digest_hashes).rewrite_digests()
+
+        # Only the first run replaced them
+        self.assertEqual(digest_folder.delete_messages.mock_calls, [call([98]), call([99])])
+        self.assertEqual(len(digest_folder.append.mock_calls), 2)
+
+    def test_previous_digests_are_found_with_one_search_and_one_fetch_of_the_digest_folder(self):
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = [5, 7, 9, 12]  # 12 deleted by another client since
+        digest_folder.fetch.side_effect = imapclient_fetch(digest_folder_response(
+            (7, 'Someone Digest (2 new)', '"Someone" <ph@example.com>', (b'\\Seen',)),
+            (3, 'Newsletter', '"Newsletter" <news@example.com>', ()),
+            (9, 'Someone Digest (3 new)', '"Someone" <ph@example.com>', ()),
+            (12, 'Someone Digest (4 new)', '"Someone" <ph@example.com>', (b'\\Deleted',)),
+            (5, 'Other Digest', '"Other" <ph@example.com>', (b'\\Seen',))
+        ))
+        other = SomeoneDigester()
+        other.matching_digest_subject = lambda: "Other Digest"
+        other.matching_digest_sender = lambda: "Other"
+        nobody = SomeoneDigester()
+        nobody.matching_digest_subject = lambda: "Nobody Digest"
+
+        digestion_processor = DigestionProcessor(Mock(), digest_folder, [SomeoneDigester(), nobody, other], False,
+                                                 "ph@example.com", False, "INBOX")
+
+        self.assertEqual(digestion_processor.previous_digests(), {0: (9, False), 2: (5, True)})
+        digest_folder.search.assert_called_once_with([
+            'OR', 'OR',
+            ['HEADER', 'Subject', 'Someone Digest', 'HEADER', 'From', 'Someone'],
+            ['HEADER', 'Subject', 'Nobody Digest', 'HEADER', 'From', 'Someone'],
+            ['HEADER', 'Subject', 'Other Digest', 'HEADER', 'From', 'Other'],
+            'UNDELETED'])
+        digest_folder.fetch.assert_called_once_with([5, 7, 9, 12],
+                                                    ['FLAGS', 'BODY.PEEK[HEADER.FIELDS (SUBJECT FROM)]'])
+
+    def test_an_empty_digest_folder_is_not_fetched_from(self):
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = []
+
+        digestion_processor = DigestionProcessor(Mock(), digest_folder, [SomeoneDigester()], False, "ph@example.com",
+                                                 False, "INBOX")
+
+        self.assertEqual(digestion_processor.previous_digests(), {})
+        self.assertEqual(digest_folder.fetch.mock_calls, [])
+
+    def test_a_digest_whose_uid_is_known_is_fetched_directly(self):
+
+        store_writer = Mock()
+        store_writer.get_from_binary.side_effect = stub(
+            (call('digest-uids'), {"uidvalidity": 7, "uids": {("Someone Digest", "Someone"): 42}})
+        )
+
+        digest_folder = Mock()
+        digest_folder.fetch.return_value = {42: {b'FLAGS': (b'\\Seen',)}}
+
+        digestion_processor = DigestionProcessor(Mock(), digest_folder, [SomeoneDigester()], False, "ph@example.com",
+                                                 False, "INBOX", digest_uids=DigestUids(store_writer, 7))
+
+        self.assertEqual(digestion_processor.previous_digests(), {0: (42, True)})
+        digest_folder.fetch.assert_called_once_with([42], ['FLAGS'])
+
+    def test_a_digest_whose_known_uid_has_gone_is_looked_for(self):
+
+        store_writer = Mock()
+        store_writer.get_from_binary.side_effect = stub(
+            (call('digest-uids'), {"uidvalidity": 7, "uids": {("Someone Digest", "Someone"): 42}})
+        )
+
+        def fetch(messages, items):
+            if messages == [42]:
+                return {}
+            return digest_folder_response((43, 'Someone Digest', '"Someone" <ph@example.com>', ()))
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = [43]
+        digest_folder.fetch.side_effect = fetch
+
+        digestion_processor = DigestionProcessor(Mock(), digest_folder, [SomeoneDigester()], False, "ph@example.com",
+                                                 False, "INBOX", digest_uids=DigestUids(store_writer, 7))
+
+        self.assertEqual(digestion_processor.previous_digests(), {0: (43, False)})
+
+    def test_the_appenduid_of_a_rewritten_digest_is_remembered(self):
+
+        store_writer = Mock()
+        store_writer.get_from_binary.return_value = None
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = [99]
+        digest_folder.fetch.return_value = digest_folder_response(
+            (99, 'Someone Digest', '"Someone" <ph@example.com>', ()))
+        digest_folder.append.return_value = b'[APPENDUID 7 100] APPEND completed'
+
+        DigestionProcessor(Mock(), digest_folder, [RewritingDigester("<p>Two things happened</p>")], False,
+                           "ph@example.com", False, "INBOX",
+                           digest_uids=DigestUids(store_writer, 7)).rewrite_digests()
+
+        store_writer.store_as_binary.assert_called_once_with('digest-uids',
+                                                             {"uidvalidity": 7,
+                                                              "uids": {("Someone Digest", "Someone"): 100}})
+
+    def test_digesters_with_the_same_digest_subject_each_remember_their_own_digest_uid(self):
+
+        store_writer = Mock()
+        store_writer.get_from_binary.return_value = None
+        digest_uids = DigestUids(store_writer, 7)
+
+        someone = RewritingDigester("<p>Something happened</p>")
+        other = RewritingDigester("<p>Nothing happened</p>")
+        other.matching_digest_sender = lambda: "Other"  # a 'Someone Digest' too
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = []
+        digest_folder.append.side_effect = [b'[APPENDUID 7 10] APPEND completed', b'[APPENDUID 7 11] APPEND completed']
+        digestion_processor = DigestionProcessor(Mock(), digest_folder, [someone, other], False, "ph@example.com",
+                                                 False, "INBOX", digest_uids=digest_uids)
+        digestion_processor.rewrite_digests()
+
+        digest_folder.fetch.return_value = {10: {b'FLAGS': ()}, 11: {b'FLAGS': (b'\\Seen',)}}
+        self.assertEqual(digestion_processor.previous_digests(), {0: (10, False), 1: (11, True)})
+        digest_folder.fetch.assert_called_once_with([10, 11], ['FLAGS'])
+
+    def test_unmatched_emails_are_moved_by_the_server_within_one_account(self):
+
+        emails = {1: NOTIFICATION, 2: NEWSLETTER}
+
+        def fetch(uids, items):
+            if items == ["BODY.PEEK[HEADER]"]:
+                return fetch_header_response(uids, emails)
+            return fetch_response(uids, emails)
+
+        notification_folder = Mock()
+        notification_folder.search.return_value = [1, 2]
+        notification_folder.fetch.side_effect = fetch
+        notification_folder.has_capability.side_effect = lambda capability: capability == 'MOVE'
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = []
+        digest_folder.fetch.return_value = {}
+
+        digestion_processor = DigestionProcessor(notification_folder, digest_folder, [SomeoneDigester()], False,
+                                                 "ph@example.com", True, "INBOX", headers_first=True,
+                                                 move_unmatched_as_is=True, same_account=True)
+        digestion_processor.doit()
+
+        self.assertEqual(notification_folder.fetch.mock_calls, [
+            call([1, 2], ["BODY.PEEK[HEADER]"]),
+            call([1], ["INTERNALDATE", "RFC822"])
+        ])
+        notification_folder.add_flags.assert_called_once_with([2], ["ImapDigesterUnmatched"])
+        notification_folder.move.assert_called_once_with([2], "INBOX")
+        notification_folder.delete_messages.assert_called_once_with([1])
+        self.assertEqual(digest_folder.append.mock_calls, [])
+
+    def test_unmatched_emails_are_copied_by_the_server_without_move(self):
+
+        notification_folder = Mock()
+        notification_folder.search.return_value = [2]
+        notification_folder.fetch.side_effect = lambda uids, items: fetch_response(uids, {2: NEWSLETTER})
+        notification_folder.has_capability.return_value = False
+
+        digestion_processor = DigestionProcessor(notification_folder, Mock(), [], False, "ph@example.com", True,
+                                                 "INBOX", move_unmatched_as_is=True, same_account=True)
+        digestion_processor.doit()
+
+        notification_folder.copy.assert_called_once_with([2], "INBOX")
+        notification_folder.delete_messages.assert_called_once_with([2])
+
+    def test_unmatched_emails_from_another_account_are_appended_together_as_they_are(self):
+
+        notification_folder = Mock()
+        notification_folder.search.return_value = [2, 3]
+        notification_folder.fetch.side_effect = lambda uids, items: fetch_response(uids, {2: NEWSLETTER, 3: NEWSLETTER})
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = []
+        digest_folder.fetch.return_value = {}
+        digest_folder.has_capability.side_effect = lambda capability: capability == 'MULTIAPPEND'
+
+        digestion_processor = DigestionProcessor(notification_folder, digest_folder, [SomeoneDigester()], False,
+                                                 "ph@example.com", True, "INBOX", move_unmatched_as_is=True)
+        digestion_processor.doit()
+
+        newsletter = {"msg": NEWSLETTER.encode('ISO-8859-1'), "flags": ["ImapDigesterUnmatched"]}
+        digest_folder.multiappend.assert_called_once_with("INBOX", [newsletter, newsletter])
+        self.assertEqual(digest_folder.append.mock_calls, [])
+        notification_folder.delete_messages.assert_called_once_with([2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+from unittest import TestCase
+import unittest
+
+from mock import Mock
+
+from digesters.header_matcher import HeaderMatcher
+
+NOTIFICATION = """Return-Path: <bounces@example.com>
+From: "Someone (Tracker)" <tracker@example.com>
+Subject: [Tracker] Something happened
+Date: Sat, 2 Apr 2016 06:36:07 -0700
+
+Forwarded, originally:
+From: Citi Alerts <alerts@citibank.com>
+"""
+
+
+def digester(*patterns, **kwargs):
+    mock_digester = Mock()
+    mock_digester.matching_incoming_headers.return_value = list(patterns)
+    mock_digester.subordinate_digesters.return_value = kwargs.get("subordinates", [])
+    return mock_digester
+
+
+class TestHeaderMatcher(TestCase):
+
+    def test_all_matching_digesters_are_returned_in_the_order_given(self):
+
+        by_subject = digester("Subject: \\[Tracker\\] .*")
+        by_sender = digester("From: .* <tracker@example.com>")
+        not_matching = digester("From: .* <other@example.com>")
+
+        matcher = HeaderMatcher([not_matching, by_subject, by_sender])
+
+        self.assertEqual(matcher.matches(NOTIFICATION), [(by_subject, None), (by_sender, None)])
+
+    def test_only_the_header_block_is_looked_at(self):
+
+        citi = digester("From: Citi Alerts <alerts@citibank.com>")
+
+        self.assertEqual(HeaderMatcher([citi]).matches(NOTIFICATION), [])
+
+    def test_patterns_are_matched_as_plain_strings_too(self):
+
+        plain = digester("Subject: [Tracker] Something happened")  # as a regex, [Tracker] is one character
+
+        self.assertEqual(HeaderMatcher([plain]).matches(NOTIFICATION), [(plain, None)])
+
+    def test_each_matching_subordinate_digester_is_returned_with_its_owner_in_order(self):
+
+        citi = digester("From: Citi Alerts <alerts@citibank.com>")
+        tracker = digester("From: .* <tracker@example.com>")
+        also_tracker = digester("Subject: \\[Tracker\\]")
+        owner = digester(subordinates=[citi, tracker, also_tracker])
+
+        self.assertEqual(HeaderMatcher([owner]).matches(NOTIFICATION), [(owner, tracker), (owner, also_tracker)])
+
+    def test_patterns_that_cannot_be_combined_into_one_regex_are_matched_on_their_own(self):
+
+        named = digester("Subject: \\[(?P<tracker>\\w+)\\] Something")
+        same_name = digester("Subject: \\[(?P<tracker>\\w+)\\] Nothing")
+        flagged = digester("(?i)subject: \\[tracker\\]")
+        not_matching = digester("Subject: Else")
+
+        matcher = HeaderMatcher([named, same_name, flagged, not_matching])
+
+        self.assertEqual(matcher.matches(NOTIFICATION), [(named, None), (flagged, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
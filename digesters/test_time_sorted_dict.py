@@ -0,0 +1,42 @@
+import pickle
+from unittest import TestCase
+import unittest
+
+from digesters.time_sorted_dict import TimeSortedDict
+
+
+class TestTimeSortedDict(TestCase):
+
+    def test_records_are_kept_in_time_order_whatever_order_they_arrive_in(self):
+
+        history = TimeSortedDict.from_store({300: "c", 100: "a"})
+        history[400] = "d"
+        history[200] = "b"
+        history.pop(300)
+
+        self.assertEqual(history, {100: "a", 200: "b", 400: "d"})
+        self.assertEqual(history.newest(), 400)
+        self.assertEqual(history.oldest(), 100)
+        self.assertEqual(history.newest_first(), [(400, "d"), (200, "b"), (100, "a")])
+        self.assertEqual(history.first_since(150), 200)
+        self.assertEqual(history.count_since(150), 2)
+        self.assertIsNone(TimeSortedDict().newest())
+
+        stored = pickle.loads(pickle.dumps(history))
+        self.assertIs(type(stored), TimeSortedDict)
+        self.assertEqual(stored.newest_first(), history.newest_first())
+
+    def test_all_since_the_bookmark_are_kept_with_the_newest_before_it(self):
+
+        history = TimeSortedDict((when, str(when)) for when in range(10))
+
+        history.keep_newest(2, before=6)
+        self.assertEqual(sorted(history), [4, 5, 6, 7, 8, 9])
+
+        history.keep_newest(3)
+        self.assertEqual(sorted(history), [7, 8, 9])
+        self.assertEqual(history.oldest(), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+from bisect import bisect_left, insort
+
+
+class TimeSortedDict(dict):
+    """ A digester's history - {timestamp: record} - that also keeps its keys in order, so the newest and oldest are
+    at hand, and the newest k, or those since a bookmark, don't need the whole history sorted again on every rewrite.
+    It's still a dict (and equal to one with the same items), and it's stored by MetaStore like one, keys in order.
+    Keys have to be comparable to each other, and to the bookmarks asked about.
+    """
+
+    def __init__(self, items=()):
+        super(TimeSortedDict, self).__init__(items)
+        self.in_order = sorted(dict.keys(self))  # linear when they were stored in order
+
+    @classmethod
+    def from_store(cls, stored):
+        """
+        :param stored: what MetaStore had - one of these, a plain dict (stored before there were these), or None
+        """
+        if isinstance(stored, cls):
+            return stored
+        return cls(stored or {})
+
+    def __reduce__(self):
+        return self.__class__, ([(key, dict.__getitem__(self, key)) for key in self.in_order],)
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            if len(self.in_order) == 0 or self.in_order[-1] < key:
+                self.in_order.append(key)
+            else:
+                insort(self.in_order, key)
+        super(TimeSortedDict, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(TimeSortedDict, self).__delitem__(key)
+        del self.in_order[bisect_left(self.in_order, key)]
+
+    def pop(self, key, *default):
+        if key in self:
+            del self.in_order[bisect_left(self.in_order, key)]
+        return super(TimeSortedDict, self).pop(key, *default)
+
+    def popitem(self):
+        key = self.newest()
+        if key is None:
+            raise KeyError("popitem(): dictionary is empty")
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        super(TimeSortedDict, self).clear()
+        self.in_order = []
+
+    def copy(self):
+        return self.__class__(self)
+
+    def newest(self):
+        """
+        :rtype: the most recent key, or None if empty
+        """
+        return self.in_order[-1] if len(self.in_order) > 0 else None
+
+    def oldest(self):
+        """
+        :rtype: the least recent key, or None if empty
+        """
+        return self.in_order[0] if len(self.in_order) > 0 else None
+
+    def newest_first(self):
+        """
+        :rtype: list of (key, record), most recent first - as templates iterate them
+        """
+        return [(key, dict.__getitem__(self, key)) for key in reversed(self.in_order)]
+
+    def first_since(self, bookmark):
+        """
+        :rtype: the least recent key that's not before the bookmark, or None if there isn't one
+        """
+        ix = bisect_left(self.in_order, bookmark)
+        return self.in_order[ix] if ix < len(self.in_order) else None
+
+    def count_since(self, bookmark):
+        """
+        :rtype: how many keys are not before the bookmark
+        """
+        return len(self.in_order) - bisect_left(self.in_order, bookmark)
+
+    def keep_newest(self, count, before=None):
+        """ Drops all but the newest count records - of those before the bookmark, if one is given (those since it
+        are all kept). Costs as much as there are to drop.
+        :param count: how many to keep
+        :param before: bookmark
+        """
+        end = len(self.in_order) if before is None else bisect_left(self.in_order, before)
+        dropped = self.in_order[:max(0, end - count)]
+        if len(dropped) > 0:
+            del self.in_order[:len(dropped)]
+            for key in dropped:
+                super(TimeSortedDict, self).__delitem__(key)
@@ -0,0 +1,58 @@
+class SharedConnection(object):
+    """ One logged in IMAPClient, for both the notification folder and the digest folder, when they're in the same
+    account. Each has a FolderProxy, which SELECTs its folder before anything is done in it, if it isn't the one
+    that's selected already.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.selected = None
+        self.logged_out = False
+
+    def folder(self, folder_name):
+        return FolderProxy(self, folder_name)
+
+    def select(self, folder_name, again=False):
+        if again or self.selected != folder_name:
+            # Cleared first, so that a SELECT that fails isn't taken as having worked
+            self.selected = None
+            info = self.client.select_folder(folder_name)
+            self.selected = folder_name
+            return info
+        return None
+
+    def logout(self):
+        if not self.logged_out:
+            self.logged_out = True
+            self.client.logout()
+
+
+class FolderProxy(object):
+    """ Stands in for an IMAPClient that has folder_name selected
+    """
+
+    # What has nothing to do with the selected folder
+    NOT_IN_A_FOLDER = {"append", "capabilities", "has_capability"}
+
+    def __init__(self, connection, folder_name):
+        self.connection = connection
+        self.folder_name = folder_name
+
+    def select_folder(self):
+        """
+        :rtype: what IMAPClient.select_folder() said about the folder
+        """
+        return self.connection.select(self.folder_name, again=True)
+
+    def logout(self):
+        self.connection.logout()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.connection.client, name)
+        if not callable(attribute) or name in FolderProxy.NOT_IN_A_FOLDER:
+            return attribute
+
+        def in_folder(*args, **kwargs):
+            self.connection.select(self.folder_name)
+            return attribute(*args, **kwargs)
+        return in_folder
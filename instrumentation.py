@@ -0,0 +1,76 @@
+import json
+import time
+from contextlib import contextmanager
+
+
+class Instrumentation(object):
+    """ Where the time in a run goes: for each stage (a span), how many times it happened and how long that took in
+    all, plus counters (like how many bytes were fetched). Nothing is recorded unless use() has been called.
+    Spans can be inside others (a digester's "rewrite" includes its "template.render", say).
+    """
+
+    # Set by use(), for span() and count() to record into
+    current = None
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.spans = {}  # name -> [count, seconds]
+        self.counters = {}
+
+    @classmethod
+    def use(cls):
+        cls.current = Instrumentation()
+        return cls.current
+
+    def add_span(self, name, seconds):
+        span_so_far = self.spans.setdefault(name, [0, 0.0])
+        span_so_far[0] += 1
+        span_so_far[1] += seconds
+
+    def add_count(self, name, n):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        """
+        :rtype: dict of what was recorded, ready for json.dumps()
+        """
+        return {
+            "started": self.started,
+            "seconds": round(time.time() - self.started, 6),
+            "spans": dict((name, {"count": span_so_far[0], "seconds": round(span_so_far[1], 6)})
+                          for name, span_so_far in self.spans.items()),
+            "counters": dict(self.counters)
+        }
+
+    def write_report(self, path):
+        """ Append the report, as one line of JSON, to path ("-" for standard out), and start again from nothing. In
+        daemon mode that's once per cycle.
+        """
+        line = json.dumps(self.report(), sort_keys=True)
+        if path == "-":
+            print(line)
+        else:
+            with open(path, "a") as file_io:
+                file_io.write(line + "\n")
+        self.reset()
+
+
+@contextmanager
+def span(name):
+    instrumentation = Instrumentation.current
+    if instrumentation is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        instrumentation.add_span(name, time.perf_counter() - started)
+
+
+def count(name, n=1):
+    if Instrumentation.current is not None:
+        Instrumentation.current.add_count(name, n)
@@ -1,26 +1,79 @@
+import copy
+import glob
+import hashlib
 import os
 import pickle
+import sqlite3
+from contextlib import contextmanager
+
+from instrumentation import span
 
 class MetaStore(object):
 
+    # Set by use_sqlite(), for state to go in one SQLite database instead of a pickle file per name
+    sqlite_store = None
+
+    # Set by use_journal(), to hold back everything stored until the journal is committed
+    journal = None
+
+    # Set by use_template_cache(), for digesters' compiled templates to be kept for the next run, with the rest
+    template_cache = None
+
     def __init__(self, path_prefix):
         self.prefix = ".store/" + path_prefix
+        self.prefix_made = False
+
+    @classmethod
+    def use_sqlite(cls, path=".store/state.sqlite"):
+        cls.sqlite_store = SqliteStateStore(path)
+
+    @classmethod
+    def use_journal(cls, path=".store/journal.p"):
+        cls.journal = MetaStoreJournal(path)
+        return cls.journal
+
+    @classmethod
+    def use_template_cache(cls, path=".store/jinja2"):
+        cls.template_cache = path
+
+    def make_prefix(self):
+        if not self.prefix_made:
+            os.makedirs(self.prefix, exist_ok=True)
+            self.prefix_made = True
 
     def write_to_file(self, file_name, text):
-        if not os.path.exists(self.prefix):
-            os.makedirs(self.prefix)
+        self.make_prefix()
         file = open(self.prefix + "/" + file_name + ".html", 'w+')
         file.write(text)
         file.close()
 
     def store_as_binary(self, name, to_store):
-        if not os.path.exists(self.prefix):
-            os.makedirs(self.prefix)
-        file_io = open(self.prefix + "/" + name + ".p", "wb")
-        pickle.dump(to_store, file_io)
-        file_io.close()
+        if MetaStore.journal is not None:
+            MetaStore.journal.hold(self, name, to_store)
+        else:
+            with span("metastore.save"):
+                self.write_binary(name, to_store)
+
+    def write_binary(self, name, to_store):
+        if MetaStore.sqlite_store is not None:
+            MetaStore.sqlite_store.store(self.prefix, name, to_store)
+            return
+        self.make_prefix()
+        p_ = self.prefix + "/" + name + ".p"
+        write_pickle_and_sync(p_ + ".tmp", to_store)
+        # A crash (or a full disk) before this leaves the previous one as it was, rather than a truncated pickle
+        os.replace(p_ + ".tmp", p_)
 
     def get_from_binary(self, name):
+        if MetaStore.journal is not None and MetaStore.journal.holds(self, name):
+            return MetaStore.journal.held(self, name)
+        with span("metastore.load"):
+            return self.read_binary(name)
+
+    def read_binary(self, name):
+        if MetaStore.sqlite_store is not None:
+            return MetaStore.sqlite_store.get(self.prefix, name)
+
         p_ = self.prefix + "/" + name + ".p"
 
         if os.path.isfile(p_):
@@ -29,3 +82,187 @@ class MetaStore(object):
             file_io.close()
             return b
         return None
+
+
+def write_pickle_and_sync(path, to_store):
+    with open(path, "wb") as file_io:
+        pickle.dump(to_store, file_io)
+        file_io.flush()
+        os.fsync(file_io.fileno())
+
+
+class MetaStoreJournal(object):
+    """ Holds back what MetaStores store, so that everything from one run is written together by commit().
+    For pickle files, each is written to a temp file first, then the journal file (the list of renames to do) is
+    written, then the renames are done. If a run dies part way through the renames, the next one finishes them.
+    For the SQLite backend, commit() is a single transaction.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.held_back = {}  # (prefix, name) -> (meta_store, value), latest wins
+        self.recover()
+
+    def hold(self, meta_store, name, to_store):
+        self.held_back[(meta_store.prefix, name)] = (meta_store, to_store)
+
+    def holds(self, meta_store, name):
+        return (meta_store.prefix, name) in self.held_back
+
+    def held(self, meta_store, name):
+        return self.held_back[(meta_store.prefix, name)][1]
+
+    def commit(self):
+        if len(self.held_back) == 0:
+            return
+        if MetaStore.sqlite_store is not None:
+            with MetaStore.sqlite_store.transaction():
+                for (prefix, name), (meta_store, to_store) in self.held_back.items():
+                    MetaStore.sqlite_store.write(prefix, name, to_store)
+        else:
+            renames = []
+            for (prefix, name), (meta_store, to_store) in self.held_back.items():
+                meta_store.make_prefix()
+                p_ = prefix + "/" + name + ".p"
+                write_pickle_and_sync(p_ + ".tmp", to_store)
+                renames.append((p_ + ".tmp", p_))
+            write_pickle_and_sync(self.path + ".tmp", renames)
+            os.replace(self.path + ".tmp", self.path)
+            self.recover()
+        self.held_back = {}
+
+    def recover(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, "rb") as file_io:
+            renames = pickle.load(file_io)
+        for temp_path, path in renames:
+            if os.path.isfile(temp_path):
+                os.replace(temp_path, path)
+        os.remove(self.path)
+
+
+# The row for a whole value that isn't a dict, or for an empty dict of the right type when it is one
+WHOLE_VALUE = b""
+
+# Item keys of the rows for a dict within the dict (a history kept alongside a bookmark, say) - an empty dict of the
+# right type, then a row per item of it. Pickled keys never start with these.
+NESTED_DICT = b"{"
+NESTED_ITEM = b":"
+
+
+class SqliteStateStore(object):
+    """ What MetaStores store, in one SQLite database. A dict gets a row per item (keyed by prefix, name and the
+    item's key), so storing it again only writes the items that were added, changed or removed since. So does a dict
+    that's an item of one, like {"charges": {...}, "most_recent_seen": ...}.
+    Nothing is read until it's asked for. When the database is first created, the .store/*/*.p pickle files that
+    MetaStore wrote before are copied into it.
+    """
+
+    def __init__(self, path, migrate_from=".store"):
+        self.path = path
+        self.migrate_from = migrate_from
+        self.connection = None
+        self.stored = {}  # (prefix, name) -> {item key: hash of the item}, as last read or written
+
+    def connect(self):
+        if self.connection is None:
+            directory = os.path.dirname(self.path)
+            if directory != "" and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.connection = sqlite3.connect(self.path)
+            with self.transaction():
+                if self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'state'") \
+                        .fetchone() is None:
+                    self.connection.execute("CREATE TABLE state (prefix TEXT NOT NULL, name TEXT NOT NULL, "
+                                            "item_key BLOB NOT NULL, value BLOB NOT NULL, "
+                                            "PRIMARY KEY (prefix, name, item_key))")
+                    self.migrate_pickle_files()
+        return self.connection
+
+    @contextmanager
+    def transaction(self):
+        """ What's written in the with block is committed at the end of it. If it's rolled back instead, the hashes
+        of what was written are forgotten, for the next write to read what's really there again
+        """
+        try:
+            with self.connect():
+                yield
+        except BaseException:
+            self.stored = {}
+            raise
+
+    def migrate_pickle_files(self):
+        for pickle_file in sorted(glob.glob(os.path.join(self.migrate_from, "*", "*.p"))):
+            prefix = os.path.dirname(pickle_file)
+            name = os.path.basename(pickle_file)[:-len(".p")]
+            with open(pickle_file, "rb") as file_io:
+                self.write(prefix, name, pickle.load(file_io))
+
+    def get(self, prefix, name):
+        rows = self.connect().execute("SELECT item_key, value FROM state WHERE prefix = ? AND name = ? "
+                                      "ORDER BY rowid", (prefix, name)).fetchall()
+        self.stored[(prefix, name)] = dict((item_key, self.hash(value)) for item_key, value in rows)
+        if len(rows) == 0:
+            return None
+        items = dict((item_key, value) for item_key, value in rows)
+        value = pickle.loads(items.pop(WHOLE_VALUE))
+        if isinstance(value, dict):
+            nested_items = []
+            for item_key, item in items.items():
+                if item_key.startswith(NESTED_ITEM):
+                    nested_items.append((pickle.loads(item_key[1:]), pickle.loads(item)))
+                elif item_key.startswith(NESTED_DICT):
+                    value[pickle.loads(item_key[1:])] = pickle.loads(item)
+                else:
+                    value[pickle.loads(item_key)] = pickle.loads(item)
+            for (key, nested_key), item in nested_items:
+                value[key][nested_key] = item
+        return value
+
+    def store(self, prefix, name, value):
+        with self.transaction():
+            self.write(prefix, name, value)
+
+    @staticmethod
+    def empty_like(value):
+        """
+        :rtype: an empty dict of the same type as value
+        """
+        empty = copy.copy(value)
+        empty.clear()
+        return empty
+
+    def write(self, prefix, name, value):
+        if (prefix, name) not in self.stored:
+            self.stored[(prefix, name)] = dict(
+                (item_key, self.hash(item)) for item_key, item in self.connection.execute(
+                    "SELECT item_key, value FROM state WHERE prefix = ? AND name = ?", (prefix, name)))
+        before = self.stored[(prefix, name)]
+
+        rows = {}
+        if isinstance(value, dict):
+            rows[WHOLE_VALUE] = pickle.dumps(self.empty_like(value))
+            for key, item in value.items():
+                if isinstance(item, dict):
+                    rows[NESTED_DICT + pickle.dumps(key)] = pickle.dumps(self.empty_like(item))
+                    for nested_key, nested_item in item.items():
+                        rows[NESTED_ITEM + pickle.dumps((key, nested_key))] = pickle.dumps(nested_item)
+                else:
+                    rows[pickle.dumps(key)] = pickle.dumps(item)
+        else:
+            rows[WHOLE_VALUE] = pickle.dumps(value)
+
+        after = dict((item_key, self.hash(item)) for item_key, item in rows.items())
+        self.connection.executemany(
+            "INSERT INTO state (prefix, name, item_key, value) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (prefix, name, item_key) DO UPDATE SET value = excluded.value",
+            [(prefix, name, item_key, item) for item_key, item in rows.items() if before.get(item_key) != after[item_key]])
+        self.connection.executemany(
+            "DELETE FROM state WHERE prefix = ? AND name = ? AND item_key = ?",
+            [(prefix, name, item_key) for item_key in before if item_key not in after])
+        self.stored[(prefix, name)] = after
+
+    @staticmethod
+    def hash(pickled):
+        return hashlib.sha1(pickled).digest()
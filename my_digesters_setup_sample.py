@@ -1,70 +1,78 @@
-from digesters.confluence.confluence_notification_digester import ConfluenceNotificationDigester
-from digesters.fidelity.fidelity_notification_digester import FidelityNotificationDigester
-from digesters.github.github_notification_digester import GithubNotificationDigester
-from digesters.hipchat.hipchat_notification_digester import HipchatNotificationDigester
-from digesters.jira.jira_notification_digester import JiraNotificationDigester
-from digesters.linkedin.linkedin_invitation_digester import LinkedinInvitationDigester
-from digesters.reddit.reddit_notification_digester import RedditNotificationDigester
-from digesters.stackexchange.stack_exchange_notification_digester import StackExchangeNotificationDigester
-
 from metastore import MetaStore
-from digesters.charges.charge_card_digester import ChargeCardDigester
 
 # This file - my_digesters_setup_sample.py - is activated despite the 'sample' name, UNLESS
 # 'my_digesters_setup.py' is present. You would have made that yourself by copying this source file
 # and replacing this notice with "copied from ...". Yes, it is an unconventional way of configuring
 # an application (Python versus XML, JSON, YAML, TOML, properties/ini files), but it is what it is.
+#
+# Digesters are added by the name of their class, so that nothing of theirs is imported (or loaded from .store/)
+# on a run that has no new notification emails. digesters.append(SomeDigester(...)) works too, but then
+# SomeDigester has to be imported at the top of this file, for every run.
+
+def charge_cards():
+    from digesters.charges.charge_card_digester import ChargeCardDigester
+    return ChargeCardDigester(MetaStore("charge_cards")) \
+        .with_amex() \
+        .with_chase() \
+        .with_barclaycard() \
+        .with_bofa() \
+        .with_jpmorgan() \
+        .with_capitalone() \
+        .with_citi()
+
 
 def add_digesters(digesters):
 
     # StackExchange site filtered notifications
     # Customize for your filter(s) ...
-    digesters.append(StackExchangeNotificationDigester(MetaStore("stack_exchange_1"), "TBD"))
+    digesters.add("digesters.stackexchange.stack_exchange_notification_digester.StackExchangeNotificationDigester",
+                  MetaStore("stack_exchange_1"), "TBD")
 
     # Charge (Credit) card spending alerts (and more)
-    digesters.append(ChargeCardDigester(MetaStore("charge_cards"))
-                      .with_amex()
-                      .with_chase()
-                      .with_barclaycard()  # non-operational presently
-                      .with_bofa()
-                      .with_jpmorgan()  # non-operational presently
-                      .with_capitalone()  # non-operational presently
-                      .with_citi())
+    # Barclaycard, JPMorgan and CapitalOne are non-operational presently
+    digesters.add(charge_cards)
 
     # Regular Github.com notifications (you are watching a repo)
-    digesters.append(GithubNotificationDigester(MetaStore("github_notifications")))
+    digesters.add("digesters.github.github_notification_digester.GithubNotificationDigester",
+                  MetaStore("github_notifications"))
 
     # Github Enterprise installation notifications (you are watching a repo)
     # Note the params for this need customization, or nothing will match .....
-    digesters.append(GithubNotificationDigester(MetaStore("ghe_notifications"),
-                                            return_path_email="noreply-ghe@yourcompany.com",
-                                            from_email="ghe-notifications@yourcompany.com",
-                                            site="ghe.yourcompany.com",
-                                            known_as="GHE"))
+    digesters.add("digesters.github.github_notification_digester.GithubNotificationDigester",
+                  MetaStore("ghe_notifications"),
+                  return_path_email="noreply-ghe@yourcompany.com",
+                  from_email="ghe-notifications@yourcompany.com",
+                  site="ghe.yourcompany.com",
+                  known_as="GHE")
 
     # Atlassian HipChat (service) notifications
-    digesters.append(HipchatNotificationDigester(MetaStore("hipchat_notifications")))
+    digesters.add("digesters.hipchat.hipchat_notification_digester.HipchatNotificationDigester",
+                  MetaStore("hipchat_notifications"))
 
     # Fidelity Investments (investments) Balance notifications
-    digesters.append(FidelityNotificationDigester(MetaStore("fidelity_notifications")))
+    digesters.add("digesters.fidelity.fidelity_notification_digester.FidelityNotificationDigester",
+                  MetaStore("fidelity_notifications"))
 
     # Linkedin (service) Invitations
-    digesters.append(LinkedinInvitationDigester(MetaStore("linkedin_invitations")))
+    digesters.add("digesters.linkedin.linkedin_invitation_digester.LinkedinInvitationDigester",
+                  MetaStore("linkedin_invitations"))
 
     # Atlassian Confluence Installation Notifications
     # Customize to the Confluence you're aiming at .....
-    digesters.append(ConfluenceNotificationDigester(MetaStore("confluence_notifications"),
-                                                    "confluence@apache.org", "Apache"))
+    digesters.add("digesters.confluence.confluence_notification_digester.ConfluenceNotificationDigester",
+                  MetaStore("confluence_notifications"), "confluence@apache.org", "Apache")
 
     # Customize to the JIRA you're aiming at .....
 
     # Atlassian's JIRA Installation Notifications
-    digesters.append(JiraNotificationDigester(MetaStore("jira_notifications"),
-                                                    "jira@atlassian.com", "Atlassian"))
+    digesters.add("digesters.jira.jira_notification_digester.JiraNotificationDigester",
+                  MetaStore("jira_notifications"), "jira@atlassian.com", "Atlassian")
     # Apache's JIRA Notifications
-    digesters.append(JiraNotificationDigester(MetaStore("apache_jira_notifications"),
-                                              "jira@apache.org", "Apache"))
+    digesters.add("digesters.jira.jira_notification_digester.JiraNotificationDigester",
+                  MetaStore("apache_jira_notifications"), "jira@apache.org", "Apache")
 
     # Reddit notifictions
-    digesters.append(RedditNotificationDigester(MetaStore("reddit_notifications_1"), "paul_h"))
-    digesters.append(RedditNotificationDigester(MetaStore("reddit_notifications_2"), "ph555"))
+    digesters.add("digesters.reddit.reddit_notification_digester.RedditNotificationDigester",
+                  MetaStore("reddit_notifications_1"), "paul_h")
+    digesters.add("digesters.reddit.reddit_notification_digester.RedditNotificationDigester",
+                  MetaStore("reddit_notifications_2"), "ph555")
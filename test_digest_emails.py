@@ -0,0 +1,181 @@
+import os
+import shutil
+import socket
+import tempfile
+from unittest import TestCase
+import unittest
+
+from imapclient import IMAPClient
+from mock import Mock, call, patch
+
+from digest_emails import get_command, log_in_to_notifications, log_out, run_as_daemon, wait_for_new_mail
+
+
+def subjects_response(*emails):
+    """ What fetching the Subject of command emails comes back as, for (uid, subject)s
+    """
+    return dict((uid, {b'BODY[HEADER.FIELDS (SUBJECT)]': ('Subject: ' + subject + '\r\n\r\n').encode('utf-8')})
+                for uid, subject in emails)
+
+
+class TestGetCommand(TestCase):
+
+    def setUp(self):
+        self.previous_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.previous_directory)
+        shutil.rmtree(self.directory)
+
+    def test_command_emails_are_found_with_one_search_and_one_fetch(self):
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = [4, 7, 9]
+        digest_folder.fetch.return_value = subjects_response((4, 'resume'), (7, 'Re: PAUSE'), (9, 'pause'))
+
+        self.assertEqual(get_command(digest_folder), "PAUSE")
+
+        digest_folder.search.assert_called_once_with(['OR', 'OR', 'SUBJECT', 'git-pull', 'SUBJECT', 'pause',
+                                                      'SUBJECT', 'resume', 'UNDELETED'])
+        digest_folder.fetch.assert_called_once_with([4, 7, 9], ['BODY.PEEK[HEADER.FIELDS (SUBJECT)]'])
+        # The resume email is left for the next run
+        digest_folder.delete_messages.assert_called_once_with([7, 9])
+        self.assertTrue(os.path.isfile("pause_if_present.txt"))
+
+    def test_nothing_is_fetched_when_there_are_no_command_emails(self):
+
+        digest_folder = Mock()
+        digest_folder.search.return_value = []
+
+        self.assertIsNone(get_command(digest_folder))
+
+        self.assertEqual(digest_folder.fetch.mock_calls, [])
+        self.assertEqual(digest_folder.delete_messages.mock_calls, [])
+
+
+class TestLogOut(TestCase):
+
+    def test_both_folders_are_expunged_before_either_is_logged_out(self):
+
+        connection = Mock()  # what the two folders are, when they're in the same account
+        connection.digest.expunge.side_effect = IMAPClient.AbortError("connection lost")
+
+        log_out(connection.notification, connection.digest, True)
+
+        self.assertEqual(connection.mock_calls, [call.digest.expunge(), call.notification.expunge(),
+                                                 call.digest.logout(), call.notification.logout()])
+
+
+class TestLogInToNotifications(TestCase):
+
+    @patch("digest_emails.time.sleep")
+    @patch("digest_emails.IMAPClient")
+    def test_a_login_that_works_first_time_does_not_wait(self, imap_client, sleep):
+
+        options = Mock(notifications_imap="imap.example.com", notifications_user="ph", notifications_pw="secret",
+                       notifications_ssl=True, notifications_cert_check_skip=False, notifications_port=None)
+
+        self.assertIs(log_in_to_notifications(options), imap_client.return_value)
+
+        imap_client.return_value.login.assert_called_once_with("ph", "secret")
+        sleep.assert_not_called()
+
+
+
+class TestWaitForNewMail(TestCase):
+
+    @patch("digest_emails.time.sleep")
+    def test_a_server_with_idle_is_idled_on(self, sleep):
+
+        notification_folder = Mock()
+        notification_folder.has_capability.return_value = True
+        notification_folder.idle_check.side_effect = socket.error("connection lost")
+
+        self.assertRaises(socket.error, wait_for_new_mail, notification_folder, 20)
+
+        notification_folder.has_capability.assert_called_once_with('IDLE')
+        self.assertEqual(notification_folder.mock_calls[1:], [call.idle(), call.idle_check(timeout=20),
+                                                              call.idle_done()])
+        sleep.assert_not_called()
+
+    @patch("digest_emails.time.sleep")
+    def test_a_server_without_idle_is_polled(self, sleep):
+
+        notification_folder = Mock()
+        notification_folder.has_capability.return_value = False
+
+        wait_for_new_mail(notification_folder, 20)
+
+        sleep.assert_called_once_with(20)
+        self.assertEqual(notification_folder.mock_calls[1:], [call.noop()])
+
+
+class TestRunAsDaemon(TestCase):
+
+    def setUp(self):
+        self.previous_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.now = 1000
+        self.options = Mock(poll_interval=60, rewrite_interval=30, timings=None)
+        self.processor = Mock()
+        self.waits = []
+
+        patches = [patch("digest_emails.time.time", side_effect=lambda: self.now),
+                   patch("digest_emails.time.sleep"),
+                   patch("digest_emails.wait_for_new_mail", side_effect=self.wait_for_new_mail),
+                   patch("digest_emails.make_processor", return_value=self.processor),
+                   patch("digest_emails.connect"),
+                   patch("digest_emails.get_command")]
+        self.time, self.sleep, self.wait, self.make_processor, self.connect, self.get_command = \
+            [p.start() for p in patches]
+        for p in patches:
+            self.addCleanup(p.stop)
+
+    def tearDown(self):
+        os.chdir(self.previous_directory)
+        shutil.rmtree(self.directory)
+
+    def wait_for_new_mail(self, notification_folder, timeout):
+        """ Something arrives 10s into every wait
+        """
+        self.waits.append(timeout)
+        self.now += min(timeout, 10)
+
+    def test_notifications_arriving_close_together_are_digested_together(self):
+
+        self.connect.return_value = Mock(), {}, Mock(), {}
+        self.get_command.side_effect = [None, "BASH-OPERATIONS"]
+        self.processor.digest_notifications.side_effect = [1, 1, 0, 0, 0, 0]
+
+        self.assertEqual(run_as_daemon(self.options), "BASH-OPERATIONS")
+
+        # The second notification, 10s after the first rewrite, waits for the next one 30s after it, and command
+        # emails are looked for once per poll interval (60s), not every cycle
+        self.assertEqual(self.waits, [60, 20, 10, 60, 60, 60])
+        self.assertEqual(self.processor.rewrite_digests.call_count, 2)
+        self.assertEqual(self.get_command.call_count, 2)
+        self.make_processor.assert_called_once()
+        self.processor.shut_down_workers.assert_called_once_with()
+
+    def test_the_daemon_reconnects_waiting_longer_each_time_the_server_is_still_down(self):
+
+        first_connection = Mock(), {}, Mock(), {}
+        second_connection = Mock(), {b'UIDVALIDITY': 8}, Mock(), {b'UIDVALIDITY': 6}
+        self.connect.side_effect = [first_connection, socket.error("connection refused"),
+                                    IMAPClient.Error("LOGIN failed"), second_connection]
+        self.get_command.side_effect = [None, "BASH-OPERATIONS"]
+        self.processor.digest_notifications.side_effect = [IMAPClient.AbortError("connection lost")] + [0] * 6
+
+        self.assertEqual(run_as_daemon(self.options), "BASH-OPERATIONS")
+
+        self.assertEqual(self.sleep.mock_calls, [call(1), call(2), call(4)])
+        self.assertEqual(self.connect.mock_calls[1:], [call(self.options, or_exit=False)] * 3)
+        self.processor.reconnected.assert_called_once_with(*second_connection)
+        second_connection[2].logout.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
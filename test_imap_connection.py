@@ -0,0 +1,48 @@
+from unittest import TestCase
+import unittest
+
+from mock import Mock, call
+
+from imap_connection import SharedConnection
+
+
+class TestSharedConnection(TestCase):
+
+    def test_a_folder_is_only_selected_again_when_the_other_one_was_used_since(self):
+
+        client = Mock()
+        connection = SharedConnection(client)
+        notification_folder = connection.folder("Notifications")
+        digest_folder = connection.folder("Digests")
+
+        notification_folder.search('NOT DELETED')
+        notification_folder.fetch([1], ['RFC822'])
+        digest_folder.append("Digests", b"Subject: Some Digest")
+        notification_folder.delete_messages([1])
+        digest_folder.fetch("1:*", ['FLAGS'])
+        digest_folder.expunge()
+
+        self.assertEqual(client.mock_calls, [
+            call.select_folder("Notifications"),
+            call.search('NOT DELETED'),
+            call.fetch([1], ['RFC822']),
+            call.append("Digests", b"Subject: Some Digest"),
+            call.delete_messages([1]),
+            call.select_folder("Digests"),
+            call.fetch("1:*", ['FLAGS']),
+            call.expunge()
+        ])
+
+    def test_the_connection_is_logged_out_of_once(self):
+
+        client = Mock()
+        connection = SharedConnection(client)
+
+        connection.folder("Digests").logout()
+        connection.folder("Notifications").logout()
+
+        client.logout.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import unittest
+
+from mock import Mock
+
+from digesters.digestion_processor import DigestionProcessor
+from instrumentation import Instrumentation, count, span
+
+
+class TestInstrumentation(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        Instrumentation.current = None
+        shutil.rmtree(self.directory)
+
+    def test_nothing_is_recorded_unless_in_use(self):
+
+        with span("imap.fetch"):
+            count("imap.fetch.bytes", 123)
+
+        self.assertIsNone(Instrumentation.current)
+
+    def test_a_report_per_cycle_is_appended_as_a_line_of_json(self):
+
+        instrumentation = Instrumentation.use()
+        path = os.path.join(self.directory, "timings.jsonl")
+
+        for uids in ([1, 2], [3]):
+            notification_folder = Mock()
+            notification_folder.search.return_value = uids
+            notification_folder.fetch.side_effect = lambda uids, items: dict(
+                (uid, {b'RFC822': b"Subject: Hello\n\nHi\n", b'INTERNALDATE': None}) for uid in uids)
+            DigestionProcessor(notification_folder, Mock(), [], False, "ph@example.com", False,
+                               "INBOX").digest_notifications()
+            instrumentation.write_report(path)
+
+        with open(path) as file_io:
+            reports = [json.loads(line) for line in file_io]
+        self.assertEqual([report["counters"] for report in reports], [
+            {"imap.fetch.emails": 2, "imap.fetch.bytes": 38},
+            {"imap.fetch.emails": 1, "imap.fetch.bytes": 19}
+        ])
+        self.assertEqual(sorted(reports[0]["spans"]), ["imap.fetch", "imap.search", "match", "mime.parse"])
+        self.assertEqual(reports[0]["spans"]["mime.parse"]["count"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import pickle
+import shutil
+import tempfile
+from unittest import TestCase
+import unittest
+
+from digesters.time_sorted_dict import TimeSortedDict
+from metastore import MetaStore, SqliteStateStore
+
+
+class TestSqliteStateStore(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "state.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_what_is_stored_comes_back_the_same(self):
+
+        store = SqliteStateStore(self.path, self.directory)
+        store.store(".store/github", "github-notifications", {"b": {"subj": "B"}, "a": {"subj": "A"}})
+        store.store(".store/github", "most-recently-seen", 1459603000)
+        store.store(".store/github", "nothing-yet", {})
+
+        store = SqliteStateStore(self.path, self.directory)
+        notifications = store.get(".store/github", "github-notifications")
+        self.assertEqual(notifications, {"b": {"subj": "B"}, "a": {"subj": "A"}})
+        self.assertEqual(list(notifications), ["b", "a"])
+        self.assertEqual(store.get(".store/github", "most-recently-seen"), 1459603000)
+        self.assertEqual(store.get(".store/github", "nothing-yet"), {})
+        self.assertIsNone(store.get(".store/github", "never-stored"))
+        self.assertIsNone(store.get(".store/jira", "github-notifications"))
+
+    def test_only_items_that_changed_are_written(self):
+
+        store = SqliteStateStore(self.path, self.directory)
+        store.store(".store/github", "github-notifications", {"a": 1, "b": 2, "c": 3})
+
+        store = SqliteStateStore(self.path, self.directory)
+        notifications = store.get(".store/github", "github-notifications")
+        notifications["b"] = 20
+        notifications["d"] = 4
+        del notifications["c"]
+        changes_before = store.connection.total_changes
+        store.store(".store/github", "github-notifications", notifications)
+
+        self.assertEqual(store.connection.total_changes - changes_before, 3)
+        self.assertEqual(SqliteStateStore(self.path, self.directory).get(".store/github", "github-notifications"),
+                         {"a": 1, "b": 20, "d": 4})
+
+    def test_a_history_kept_alongside_a_bookmark_is_written_an_item_at_a_time_too(self):
+
+        store = SqliteStateStore(self.path, self.directory)
+        articles = TimeSortedDict((anum, "article " + str(anum)) for anum in range(100))
+        store.store(".store/stack", "articles", {"articles": articles, "most_recent_seen": 99})
+
+        store = SqliteStateStore(self.path, self.directory)
+        stored = store.get(".store/stack", "articles")
+        self.assertEqual(stored, {"articles": articles, "most_recent_seen": 99})
+        self.assertIs(type(stored["articles"]), TimeSortedDict)
+        self.assertEqual(stored["articles"].newest(), 99)
+
+        stored["articles"][100] = "article 100"
+        stored["most_recent_seen"] = 100
+        changes_before = store.connection.total_changes
+        store.store(".store/stack", "articles", stored)
+
+        self.assertEqual(store.connection.total_changes - changes_before, 2)
+        self.assertEqual(SqliteStateStore(self.path, self.directory).get(".store/stack", "articles"), stored)
+
+    def test_what_a_rolled_back_write_wrote_is_written_again_next_time(self):
+
+        store = SqliteStateStore(self.path, self.directory)
+        store.store(".store/github", "most-recently-seen", 1459603000)
+
+        with self.assertRaises(OSError):
+            with store.transaction():
+                store.write(".store/github", "most-recently-seen", 1459604000)
+                raise OSError("disk full")
+        store.store(".store/github", "most-recently-seen", 1459604000)
+
+        self.assertEqual(SqliteStateStore(self.path, self.directory).get(".store/github", "most-recently-seen"),
+                         1459604000)
+
+    def test_pickle_files_are_copied_in_when_the_database_is_created(self):
+
+        os.makedirs(os.path.join(self.directory, "charge_cards"))
+        with open(os.path.join(self.directory, "charge_cards", "charges.p"), "wb") as file_io:
+            pickle.dump({"charges": {}, "most_recent_seen": 0}, file_io)
+
+        store = SqliteStateStore(self.path, self.directory)
+
+        self.assertEqual(store.get(os.path.join(self.directory, "charge_cards"), "charges"),
+                         {"charges": {}, "most_recent_seen": 0})
+
+
+class TestMetaStoreJournal(TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        MetaStore.journal = None
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_nothing_is_written_until_the_journal_is_committed(self):
+
+        journal = MetaStore.use_journal()
+        github = MetaStore("github_notifications")
+        github.store_as_binary("most-recently-seen", 1459603000)
+
+        self.assertFalse(os.path.exists(".store/github_notifications/most-recently-seen.p"))
+        self.assertEqual(github.get_from_binary("most-recently-seen"), 1459603000)
+
+        journal.commit()
+
+        self.assertEqual(os.listdir(".store"), ["github_notifications"])
+        self.assertEqual(os.listdir(".store/github_notifications"), ["most-recently-seen.p"])
+        MetaStore.journal = None
+        self.assertEqual(github.get_from_binary("most-recently-seen"), 1459603000)
+
+    def test_a_commit_that_died_part_way_is_finished_by_the_next_run(self):
+
+        os.makedirs(".store/fidelity_notifications")
+        with open(".store/fidelity_notifications/fidelity-balances.p.tmp", "wb") as file_io:
+            pickle.dump({1459603000: "1,234.56"}, file_io)
+        with open(".store/journal.p", "wb") as file_io:
+            pickle.dump([(".store/fidelity_notifications/fidelity-balances.p.tmp",
+                          ".store/fidelity_notifications/fidelity-balances.p")], file_io)
+
+        MetaStore.use_journal()
+
+        self.assertFalse(os.path.exists(".store/journal.p"))
+        self.assertEqual(MetaStore("fidelity_notifications").get_from_binary("fidelity-balances"),
+                         {1459603000: "1,234.56"})
+
+
+if __name__ == '__main__':
+    unittest.main()
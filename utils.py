@@ -1,6 +1,44 @@
+class Utils(object):
 
+    # The BeautifulSoup tree builder that make_soup() uses. None for lxml if it's installed (it's much the faster),
+    # or Python's own html.parser if not.
+    html_parser = None
+
+    @staticmethod
+    def make_soup(html, from_encoding=None, parse_only=None):
+        """ Parse an email's html, for digesters to pull bits out of
+        :param parse_only: a SoupStrainer (like an ElementsStrainer), to only parse some of it
+        """
+        # Imported here, as runs with nothing to digest have no use for it
+        from bs4 import BeautifulSoup
+        if Utils.html_parser is None:
+            try:
+                import lxml
+                Utils.html_parser = "lxml"
+            except ImportError:
+                Utils.html_parser = "html.parser"
+        return BeautifulSoup(html, Utils.html_parser, from_encoding=from_encoding, parse_only=parse_only)
+
+    @staticmethod
+    def chunks(items, size):
+        """ Split a list into consecutive lists of at most 'size' items (all of them if size is not positive)
+        """
+        if not size or size < 1:
+            size = max(len(items), 1)
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    @staticmethod
+    def header_block(rfc822content):
+        """ The headers of an email, up to and including the line break before the blank line that ends them
+        :param rfc822content: the email, as a str or as bytes
+        """
+        lf, crlf = ("\n\n", "\r\n\r\n") if isinstance(rfc822content, str) else (b"\n\n", b"\r\n\r\n")
+        ends = [end for end in (rfc822content.find(lf), rfc822content.find(crlf)) if end != -1]
+        if len(ends) == 0:
+            return rfc822content
+        end = min(ends)
+        return rfc822content[:end + (1 if rfc822content[end:end + 1] == lf[:1] else 2)]
 
-class Utils(object):
     # From https://gist.github.com/miohtama/5389146
     @staticmethod
     def get_decoded_email_body(msg, html_needed):
@@ -11,37 +49,78 @@ class Utils(object):
         :param message_body: Raw 7-bit message body input e.g. from imaplib. Double encoded in quoted-printable and latin-1
         :return: Message body as unicode string
         """
+        bodies = EmailBodies(msg)
+        if html_needed == True:
+            return bodies.html
+        if html_needed == False:
+            return bodies.text
+        return bodies.html if bodies.html_only else None
 
-        multipart = msg.is_multipart()
-        content_type_is_html = msg.get_content_type() == "text/html"
 
-        text = ""
-        if multipart:
-            html = None
-            for part in msg.get_payload():
-                if part.get_content_charset() is None:
-                    # We cannot know the character set, so return decoded "something"
-                    text = part.get_payload(decode=True)
-                    continue
+class EmailBodies(object):
+    """ The html and text bodies of an email, found with a single walk of its MIME parts (nested multiparts included).
+    Each is only decoded the first time it is asked for, and then just the once.
+    """
 
-                charset = part.get_content_charset()
+    def __init__(self, msg):
+        self.msg = msg
+        self.html_only = not msg.is_multipart() and msg.get_content_type() == "text/html"
+        self.html_part = None
+        self.text_part = None
+        self.decoded = {}
+        if msg.is_multipart():
+            self.find_parts(msg)
+        elif self.html_only:
+            # Better the html than nothing, for the text
+            self.html_part = msg
+            self.text_part = msg
+        else:
+            self.text_part = msg
 
-                if part.get_content_type() == 'text/plain' and html_needed == False:
-                    text = part.get_payload(decode=True)
-                    return text.strip()
+    def find_parts(self, multipart):
+        for part in multipart.get_payload():
+            if self.html_part is not None and self.text_part is not None:
+                return
+            if part.is_multipart() and part.get_content_maintype() == "multipart":
+                self.find_parts(part)
+            elif part.get_content_charset() is None:
+                # We cannot know the character set
+                continue
+            elif part.get_content_type() == 'text/plain' and self.text_part is None:
+                self.text_part = part
+            elif part.get_content_type() == 'text/html' and self.html_part is None:
+                self.html_part = part
 
-                if part.get_content_type() == 'text/html' and html_needed == True:
-                    html = part.get_payload(decode=True)
-                    return html.strip()
-        elif not multipart and content_type_is_html:
-            payload = msg.get_payload(decode=True)
-            return payload.strip()
-        else:
-            if html_needed == False:
-                chrset = msg.get_content_charset()
-                if chrset is not None:
-                    return msg.get_payload(decode=True).strip()
-                else:
-                    return msg.get_payload(decode=True)
-            else:
-                return None
+    def decode(self, part):
+        if part is None:
+            return None
+        if id(part) not in self.decoded:
+            payload = part.get_payload(decode=True)
+            if part.get_content_charset() is not None or part is self.html_part:
+                payload = payload.strip()
+            self.decoded[id(part)] = payload
+        return self.decoded[id(part)]
+
+    @property
+    def html(self):
+        """
+        :rtype: bytes, or None if there is no html part
+        """
+        return self.decode(self.html_part)
+
+    @property
+    def text(self):
+        """
+        :rtype: bytes, or None if there is no text/plain part (the html, for an email that is only html)
+        """
+        return self.decode(self.text_part)
+
+    def messages(self, html_needed, text_needed):
+        """
+        :rtype: (html_message, text_message) as digesters are handed them, with None for one that's not needed
+        """
+        html_message = self.html if html_needed else None
+        text_message = self.text if text_needed else None
+        if type(text_message) is bytes:
+            text_message = text_message.decode("utf-8")
+        return html_message, text_message